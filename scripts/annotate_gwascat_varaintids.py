@@ -10,6 +10,7 @@ import argparse
 import pandas as pd
 import numpy as np
 import re
+from common.variant_key import make_varids_pd
 
 def main():
 
@@ -186,7 +187,8 @@ def main():
     #
 
     # Make a variant_id
-    merged['variant_id_b38'] = merged.apply(make_var_id, axis=1)
+    merged['variant_id_b38'] = make_varids_pd(
+        merged['chrom_b38'], merged['pos_b38'], merged['ref'], merged['alt'])
 
     #
     # For rows with a risk allele reported, see if concordant with ref or alt
@@ -284,16 +286,6 @@ def extract_risk_allele(s):
 def combine_rows(items):
     return ';'.join(items)
 
-def make_var_id(row):
-    ''' Make variant ID
-    Args:
-        row (pd.series)
-    Returns:
-        str
-    '''
-    # print(row)
-    return '{chrom_b38}_{pos_b38}_{ref}_{alt}'.format(**row)
-
 def get_best_rsid(row):
     ''' Returns the best rsid from:
             1. SNP_ID_CURRENT
@@ -3,16 +3,54 @@
 #
 # Ed Mountjoy
 #
-# Calculates LD in 1000 Genomes using plink
+# Calculates LD in 1000 Genomes, either natively from the plink bed files or
+# using plink
 #
 
 import sys
 import os
+import glob
+import json
+import uuid
 import argparse
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import subprocess as sp
 from functools import reduce
+from collections import OrderedDict
 from concurrent.futures import ProcessPoolExecutor
+from common.plink_bed import load_bim
+from common.genotype_cache import GenotypeCache, detect_worker_memory_limit
+from common.journal import Journal
+from common.ld_store import LDStore
+from common.ld_engine import (calc_ld_variant, calc_ld_block, make_blocks,
+                               load_ancestries, weight_by_ancestry,
+                               CALC_VERSIONS)
+from common.ld_scheduler import schedule_variants, shard_variants, parse_variant
+
+# Reference genotypes cached by this process, created in each worker
+genotype_cache = None
+
+# Fixed schema of the LD output
+LD_DTYPES = OrderedDict([
+    ('index_variant_id', 'object'),
+    ('tag_variant_id', 'object'),
+    ('R_AFR', 'float64'),
+    ('R_AMR', 'float64'),
+    ('R_EAS', 'float64'),
+    ('R_EUR', 'float64'),
+    ('R_SAS', 'float64')
+])
+
+# Fixed schema of the population weighted LD output (--manifest)
+WEIGHTED_LD_DTYPES = OrderedDict([
+    ('index_variant_id', 'object'),
+    ('tag_variant_id', 'object'),
+    ('ancestry_key', 'object'),
+    ('R2_overall', 'float64')
+])
 
 def main():
 
@@ -20,44 +58,245 @@ def main():
     global args
     args = parse_args()
 
-    # Make output dir
-    os.makedirs(args.outdir, exist_ok=True)
-
     # Load a list of variant IDs
     varids = set([])
     with open(args.varfile, 'r') as in_h:
         for line in in_h:
             varids.add(line.rstrip())
+    ref_positions = load_reference_positions(varids)
+
+    # Keep this shard's genomic region of the full variant list. Each shard
+    # writes to its own directory, which merge_ld_shards.py combines.
+    if args.shard:
+        shard, n_shards = args.shard
+        varids = shard_variants(varids, ref_positions, args.ld_window * 1000,
+                                shard, n_shards)
+        args.outdir = os.path.join(args.outdir, make_shard_name(shard, n_shards))
+        print('Shard {0} of {1} has {2} variants'.format(
+            shard, n_shards, len(varids)))
+    shard_varids = sorted(varids)
+
+    # Make output dir
+    os.makedirs(args.outdir, exist_ok=True)
+
+    # Load the distinct population proportions of each index variant
+    if args.manifest:
+        global ancestries
+        ancestries = load_ancestries(args.manifest)
+
+    # Skip variants completed by a previous, interrupted run. Outputs that were
+    # being written when it stopped are recomputed.
+    global journal
+    journal = Journal(
+        os.path.join(args.outdir, '_journal'),
+        args.outdir,
+        {'varfile': os.path.abspath(args.varfile),
+         'bfile': os.path.abspath(args.bfile),
+         'pops': args.pops,
+         'ld_window': args.ld_window,
+         'min_r2': args.min_r2,
+         'out_format': args.out_format,
+         'manifest': os.path.abspath(args.manifest) if args.manifest else None,
+         'shard': list(args.shard) if args.shard else None}
+    )
+    for tempfile in glob.glob(os.path.join(args.outdir, '.*.tmp')):
+        os.remove(tempfile)
+    completed = journal.completed()
+    remove_unjournaled_shards(completed)
+    print('{0} of {1} variants already completed'.format(
+        len(varids & set(completed)), len(varids)))
+    varids = varids - set(completed)
+
+    # Reuse results for index variants calculated by previous releases
+    if args.ld_store:
+        store = LDStore(args.ld_store, args.panel_version, args.ld_window,
+                        args.min_r2, args.pops, CALC_VERSIONS[args.engine])
+        reused = varids & set(store.index())
+        if reused:
+            journal.record(store.export(reused, args.outdir))
+        print('{0} variants reused from the LD store'.format(len(reused)))
+        varids = varids - reused
+
+    # Split variants into chunks, sorted by chromosome and position, and
+    # balance them across workers by the number of variants in their windows
+    worker_chunks = schedule_variants(
+        varids,
+        ref_positions,
+        args.ld_window * 1000,
+        args.max_cores
+    )
+
+    # Run all in parallel, one task per worker
+    with ProcessPoolExecutor(max_workers=max(len(worker_chunks), 1)) as executor:
+        for _ in executor.map(run_worker, worker_chunks):
+            pass
+
+    # Add newly calculated results to the store
+    if args.ld_store:
+        stored = set(store.index())
+        store.publish({varid: outf
+                       for varid, outf in journal.completed().items()
+                       if varid not in stored})
+
+    # Record which variants this shard is responsible for, so that the merge
+    # can check they are all complete
+    if args.shard:
+        with open(os.path.join(args.outdir, '_SHARD.json'), 'w') as out_h:
+            json.dump({'shard': args.shard[0],
+                       'n_shards': args.shard[1],
+                       'varids': shard_varids}, out_h)
+
+    # Mark the run as complete
+    open(os.path.join(args.outdir, '_SUCCESS'), 'w').close()
+
+def run_worker(chunks):
+    ''' Runs all chunks assigned to a worker, in genomic order so that a
+        chromosome's reference data is used by consecutive tasks
+    '''
+    for chunk in chunks:
+
+        # Calculate LD for each variant, or each block of variants
+        if args.mode == 'block':
+            units = make_variant_blocks(chunk['varids'])
+            run_unit = run_block
+        else:
+            units = [[varid] for varid in chunk['varids']]
+            run_unit = run_single_variant
 
-    # Run all in parallel
-    with ProcessPoolExecutor(max_workers=args.max_cores) as executor:
-        executor.map(run_single_variant, varids)
+        # Save one parquet shard per chunk, or one tsv per variant
+        if args.out_format == 'parquet':
+            merged = pd.concat([run_unit(unit) for unit in units])
+            outf = write_chunk_ld(chunk, merged)
+            journal.record({varid: outf for varid in chunk['varids']})
+        else:
+            for unit in units:
+                merged = run_unit(unit)
+                journal.record({
+                    varid: write_variant_ld(
+                        varid,
+                        merged.loc[merged.index_variant_id == varid, :])
+                    for varid in unit
+                })
 
+    return 0
 
-def run_single_variant(varid):
+def run_single_variant(varids):
     ''' Runs the LD pipeline for a single variant
+    Args:
+        varids (list of str): the variant, as a list of one
+    Returns:
+        pd.DataFrame
     '''
+    varid = varids[0]
 
     # Calculate R for each population
     results = []
     for pop in args.pops:
 
         # Make command variables
-        inbfile = args.bfile.replace('POPULATION', pop).replace(
-            'CHROM', varid.split(':')[0])
+        inbfile = make_bfile_name(pop, varid)
         outtemp = os.path.join(
             args.outdir,
             varid.replace(':', '_') + '.plink'
         )
 
         # Calc LD
-        res = calc_ld(varid,
-                      inbfile,
-                      pop,
-                      args.ld_window,
-                      outtemp)
+        if args.engine == 'native':
+            res = calc_ld_native(varid,
+                                 inbfile,
+                                 pop,
+                                 args.ld_window)
+        else:
+            res = calc_ld(varid,
+                          inbfile,
+                          pop,
+                          args.ld_window,
+                          outtemp)
         results.append(res)
 
+    # Merge and filter
+    return merge_populations(results)
+
+def run_block(varids):
+    ''' Runs the LD pipeline for a block of nearby variants on one chromosome
+    Returns:
+        pd.DataFrame
+    '''
+
+    # Calculate R for each population, all variants at once
+    results = []
+    for pop in args.pops:
+        inbfile = make_bfile_name(pop, varids[0])
+        results.append(calc_ld_native_block(varids,
+                                            inbfile,
+                                            pop,
+                                            args.ld_window))
+
+    # Merge and filter
+    return merge_populations(results)
+
+def make_variant_blocks(varids):
+    ''' Groups variant IDs into blocks of nearby variants, each spanning at
+        most args.block_size kb
+    Args:
+        varids (list of str): variant IDs on one chromosome, sorted by pos
+    Returns:
+        list of lists of variant IDs
+    '''
+    positions = [parse_variant(varid)[1] for varid in varids]
+    return [varids[start:stop]
+            for start, stop in make_blocks(positions, args.block_size * 1000)]
+
+def load_reference_positions(varids):
+    ''' Loads the reference panel positions for each chromosome in the variant
+        list, from the first population's bim files
+    Returns:
+        dict of chrom -> sorted np.array of positions
+    '''
+    ref_positions = {}
+    for chrom in set(parse_variant(varid)[0] for varid in varids):
+        inbim = make_bfile_name(args.pops[0], chrom) + '.bim'
+        try:
+            ref_positions[chrom] = np.sort(load_bim(inbim)['pos'].values)
+        except FileNotFoundError:
+            ref_positions[chrom] = np.array([], dtype=int)
+    return ref_positions
+
+def make_shard_name(shard, n_shards):
+    ''' Makes the output directory name of a shard
+    '''
+    return 'shard-{0}-of-{1}'.format(shard, n_shards)
+
+def parse_shard(value):
+    ''' Parses --shard i/N
+    Returns:
+        (i, N)
+    '''
+    try:
+        shard, n_shards = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected i/N, e.g. 1/4, got {0}'.format(value))
+    if not 1 <= shard <= n_shards:
+        raise argparse.ArgumentTypeError(
+            'shard must be between 1 and {0}, got {1}'.format(n_shards, shard))
+    return shard, n_shards
+
+def make_bfile_name(pop, varid):
+    ''' Makes the plink file prefix for a population and a variant's (or
+        chromosome's) chromosome
+    '''
+    return args.bfile.replace('POPULATION', pop).replace(
+        'CHROM', varid.split(':')[0])
+
+def merge_populations(results):
+    ''' Merges per population results and removes tags with low R2 in all
+        populations
+    Args:
+        results (list of pd.DataFrame): output of calc_ld for each population
+    Returns:
+        pd.DataFrame
+    '''
     # Merge results together
     merged = reduce(lambda left, right: pd.merge(
         left, right, how='outer'), results)
@@ -73,14 +312,101 @@ def run_single_variant(varid):
     # DEBUG, i'm expected this to fail but don't know what the error will be
     # assert(merged.shape[0] > 0)
 
-    # Save
-    outf = os.path.join(
-        args.outdir,
-        varid.replace(':', '_') + '.ld.tsv.gz'
+    # Weight by each study ancestry and filter on the weighted R2. The max R2
+    # filter above is safe to apply first, as the weighted R2 can't exceed it.
+    if args.manifest:
+        merged = weight_by_ancestry(merged, ancestries, args.min_r2)
+
+    return merged
+
+def write_variant_ld(varid, merged):
+    ''' Saves the LD results for a single index variant. Writes to a temp
+        file first so that an interrupted write never leaves a partial output.
+    Returns:
+        output file path
+    '''
+    outname = varid.replace(':', '_') + '.ld.tsv.gz'
+    outf = os.path.join(args.outdir, outname)
+    outtemp = os.path.join(args.outdir, '.' + outname + '.tmp')
+    merged.to_csv(outtemp, sep='\t', index=None, compression='gzip')
+    os.replace(outtemp, outf)
+
+    return outf
+
+def write_chunk_ld(chunk, merged):
+    ''' Saves the LD results for a chunk of index variants as a parquet shard
+        with a fixed schema. Shards are named by chromosome.
+    Returns:
+        output file path
+    '''
+    dtypes = WEIGHTED_LD_DTYPES if args.manifest else LD_DTYPES
+    table = pa.Table.from_pandas(
+        merged.loc[:, list(dtypes.keys())].astype(dtype=dtypes),
+        schema=pa.schema([
+            (name, pa.string() if dtype == 'object' else pa.float64())
+            for name, dtype in dtypes.items()
+        ]),
+        preserve_index=False
     )
-    merged.to_csv(outf, sep='\t', index=None, compression='gzip')
+    outname = 'ld.chrom{0}.{1}.parquet'.format(chunk['chrom'], uuid.uuid4().hex)
+    outf = os.path.join(args.outdir, outname)
+    outtemp = os.path.join(args.outdir, '.' + outname + '.tmp')
+    pq.write_table(table, outtemp, compression='snappy',
+                   row_group_size=table.num_rows or None)
+    os.replace(outtemp, outf)
 
-    return 0
+    return outf
+
+def remove_unjournaled_shards(completed):
+    ''' Removes parquet shards that are not in the journal, i.e. from chunks
+        that were interrupted or failed validation, so that their variants are
+        not duplicated when recomputed
+    '''
+    valid = set(os.path.abspath(path) for path in completed.values())
+    for inf in glob.glob(os.path.join(args.outdir, 'ld.chrom*.parquet')):
+        if os.path.abspath(inf) not in valid:
+            os.remove(inf)
+
+def calc_ld_native(varid, bfile, pop, ld_window):
+    ''' Calcs LD for a single variant directly from the plink bed file
+    Args:
+        varid (str): variant ID as it appears in the plink bim
+        bfile (str): plink file prefix
+        pop (str): name of population
+        ld_window (int): window are variant to calc LD for
+    Returns:
+        pd.DataFrame
+    '''
+    bed = load_genotypes(pop, parse_variant(varid)[0], bfile)
+    return calc_ld_variant(bed, varid, pop, ld_window, kernel=args.kernel)
+
+def calc_ld_native_block(varids, bfile, pop, ld_window):
+    ''' Calcs LD for a block of nearby variants directly from the plink bed
+        file, sharing the decoding and normalisation of overlapping windows
+    Args:
+        varids (list of str): variant IDs as they appear in the plink bim
+        bfile (str): plink file prefix
+        pop (str): name of population
+        ld_window (int): window are variant to calc LD for
+    Returns:
+        pd.DataFrame
+    '''
+    bed = load_genotypes(pop, parse_variant(varids[0])[0], bfile)
+    return calc_ld_block(bed, varids, pop, ld_window, kernel=args.kernel)
+
+def load_genotypes(pop, chrom, bfile):
+    ''' Gets reference genotypes from this worker's cache, which holds every
+        population of a chromosome together
+    '''
+    global genotype_cache
+    if genotype_cache is None:
+        genotype_cache = GenotypeCache(
+            max_bytes=int(args.cache_mem_gb * 2**30),
+            packed_only=(args.kernel == 'popcount')
+        )
+    bfiles = OrderedDict((p, make_bfile_name(p, chrom)) for p in args.pops)
+    bfiles[pop] = bfile
+    return genotype_cache.get(pop, chrom, bfiles)
 
 def calc_ld(varid, bfile, pop, ld_window, outf):
     ''' Uses plink to calc LD for a single variant
@@ -145,8 +471,26 @@ def parse_args():
     parser.add_argument('--min_r2', metavar="<float>", help=("Minimum R2 to be kept"), type=float, required=True)
     parser.add_argument('--outdir', metavar="<str>", help=("Output directory"), type=str, required=True)
     parser.add_argument('--max_cores', metavar="<int>", help=("Maximum cores to use"), type=int, default=os.cpu_count())
+    parser.add_argument('--engine', metavar="<str>", help=("LD engine: read bed files natively or call plink (default: native)"), type=str, choices=['native', 'plink'], default='native')
+    parser.add_argument('--kernel', metavar="<str>", help=("Native engine kernel: decode genotypes to floats, or popcount on the packed bed genotypes (default: float)"), type=str, choices=['float', 'popcount'], default='float')
+    parser.add_argument('--mode', metavar="<str>", help=("Calculate LD for each variant separately, or for blocks of nearby variants together (default: variant)"), type=str, choices=['variant', 'block'], default='variant')
+    parser.add_argument('--block_size', metavar="<int>", help=("Maximum distance between the first and last variant in a block (kb, default: 1000)"), type=int, default=1000)
+    parser.add_argument('--cache_mem_gb', metavar="<float>", help=("Memory for reference genotypes and bim tables, per worker. A chromosome is cached only if all populations fit (GB, default: half of physical memory split between workers)"), type=float, default=None)
+    parser.add_argument('--out_format', metavar="<str>", help=("Write a gzipped tsv per variant, or parquet shards per chromosome (default: tsv)"), type=str, choices=['tsv', 'parquet'], default='tsv')
+    parser.add_argument('--manifest', metavar="<str>", help=("LD analysis manifest. If given, output the population weighted R2 for each distinct ancestry of each index variant, filtered on --min_r2"), type=str, default=None)
+    parser.add_argument('--ld_store', metavar="<str>", help=("Directory of LD results from previous runs, to reuse and add to (requires --out_format parquet)"), type=str, default=None)
+    parser.add_argument('--panel_version', metavar="<str>", help=("Reference panel version, used to key results in --ld_store"), type=str, default=None)
+    parser.add_argument('--shard', metavar="<i/N>", help=("Only calculate shard i of N, a contiguous genomic region of the variant list. Output is written to outdir/shard-i-of-N, combine shards with merge_ld_shards.py"), type=parse_shard, default=None)
     parser.add_argument('--delete_temp', help=("Remove temporary files"), action='store_true')
     args = parser.parse_args()
+    if args.mode == 'block' and args.engine != 'native':
+        parser.error('--mode block requires --engine native')
+    if args.ld_store and (args.out_format != 'parquet' or not args.panel_version):
+        parser.error('--ld_store requires --out_format parquet and --panel_version')
+    if args.ld_store and args.manifest:
+        parser.error('--ld_store stores unweighted results, it can not be used with --manifest')
+    if args.cache_mem_gb is None:
+        args.cache_mem_gb = detect_worker_memory_limit(args.max_cores) / 2**30
     return args
 
 if __name__ == '__main__':
@@ -7,12 +7,54 @@
 import sys
 import os
 import argparse
-import gzip
+import multiprocessing
+import numpy as np
+import scipy.sparse as sp
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from pprint import pprint
+from common.variant_key import encode_variants_pa
+from common.ld_scheduler import chrom_sort_key
+from parquet_writer import pd_dtype_to_pa_schema, LOOKUP_ROW_GROUP_SIZE
+
+# Columns read from the parquet inputs
+TOPLOCI_COLS = ['study_id', 'chrom', 'pos', 'ref', 'alt']
+LEAD_COLS = ['study_id', 'lead_chrom', 'lead_pos', 'lead_ref', 'lead_alt']
+TAG_COLS = ['tag_chrom', 'tag_pos', 'tag_ref', 'tag_alt']
+
+# Output columns and types
+OUT_DTYPES = OrderedDict([
+    ('A_study_id', 'object'),
+    ('A_chrom', 'object'),
+    ('A_pos', 'Int64'),
+    ('A_ref', 'object'),
+    ('A_alt', 'object'),
+    ('B_study_id', 'object'),
+    ('B_chrom', 'object'),
+    ('B_pos', 'Int64'),
+    ('B_ref', 'object'),
+    ('B_alt', 'object'),
+    ('set_type', 'object'),
+    ('A_distinct', 'Int64'),
+    ('AB_overlap', 'Int64'),
+    ('B_distinct', 'Int64')
+])
+
+# Rows of the incidence matrix multiplied at a time by the sparse engine
+SPARSE_BLOCK_ROWS = 2000
+
+# Leads per task. Chromosomes with more leads are split into blocks, so that
+# the largest chromosomes do not hold up the pool.
+TASK_LEADS = 5000
 
 def main():
 
     # Parse args
+    global args, window, only_save_overlapping
     args = parse_args()
     window = 5 * 1e6 # plus/minus 5Mb
     only_save_overlapping = True
@@ -23,76 +65,29 @@ def main():
 
     # Load set of valid (study, index) pairs
     study_index_set = set([])
-    with gzip.open(args.top_loci, 'r') as in_h:
-        in_h.readline() # Skip header
-        for line in in_h:
-            study_id, chrom, pos, ref, alt = line.decode().rstrip().split('\t')[:5]
-            index_var = '_'.join([chrom, pos, ref, alt])
-            study_index_set.add((study_id, index_var))
-
-    # Load finemap data
+    for batch in open_dataset(args.top_loci).to_batches(columns=TOPLOCI_COLS):
+        study_index_set.update(zip(
+            batch.column(0).to_pylist(),
+            make_varids(*batch.columns[1:]).to_pylist()
+        ))
+
+    # Load finemap data. Tag variants are stored as integer keys, as only the
+    # sizes of their sets are reported. Hashed keys are checked for collisions
+    # across both tables.
     print('Loading finemap...')
-    tag_dict_finemap = {}
-    with gzip.open(args.finemap, 'r') as in_h:
-        in_h.readline() # Skip header
-        for line in in_h:
-            line = line.decode()
-            (
-                study_id,
-                index_chrom,
-                index_pos,
-                index_ref,
-                index_alt,
-                tag_chrom,
-                tag_pos,
-                tag_ref,
-                tag_alt
-            ) = line.rstrip().split('\t')[:9]
-            index_var = '_'.join([index_chrom, index_pos, index_ref, index_alt])
-            tag_var = '_'.join([tag_chrom, tag_pos, tag_ref, tag_alt])
-            key = (study_id, index_var)
-            # Skip (stid, index) pairs that are not in the top loci table
-            if not key in study_index_set:
-                continue
-            # Add to dict
-            try:
-                tag_dict_finemap[key].add(tag_var)
-            except KeyError:
-                tag_dict_finemap[key] = set([tag_var])
+    hashed_keys = {}
+    tag_dict_finemap = load_tag_sets(open_dataset(args.finemap),
+                                     study_index_set, seen=hashed_keys)
 
-    # Load LD data
+    # Load LD data, skipping low R2
     print('Loading LD...')
-    tag_dict_ld = {}
-    with gzip.open(args.ld, 'r') as in_h:
-        in_h.readline() # Skip header
-        for line in in_h:
-            line = line.decode()
-            (
-                study_id,
-                index_chrom,
-                index_pos,
-                index_ref,
-                index_alt,
-                tag_chrom,
-                tag_pos,
-                tag_ref,
-                tag_alt,
-                r2
-            ) = line.rstrip().split('\t')[:10]
-            index_var = '_'.join([index_chrom, index_pos, index_ref, index_alt])
-            tag_var = '_'.join([tag_chrom, tag_pos, tag_ref, tag_alt])
-            key = (study_id, index_var)
-            # Skip (stid, index) pairs that are not in the top loci table
-            if not key in study_index_set:
-                continue
-            # Skip low R2
-            if not r2 or float(r2) < args.min_r2:
-                continue
-            # Add to dict
-            try:
-                tag_dict_ld[key].add(tag_var)
-            except KeyError:
-                tag_dict_ld[key] = set([tag_var])
+    if is_nested_ld_table(args.ld):
+        tag_dict_ld = load_nested_tag_sets(args.ld, study_index_set,
+                                           args.min_r2, seen=hashed_keys)
+    else:
+        tag_dict_ld = load_tag_sets(open_dataset(args.ld), study_index_set,
+                                    ds.field('overall_r2') >= args.min_r2,
+                                    seen=hashed_keys)
 
     # Merge finemap and LD. This will select finemapping over LD if available.
     print('Merging finemap and LD...')
@@ -108,69 +103,71 @@ def main():
 
     # Find overlaps
     print('Finding overlaps...')
-    overlap_data = []
-    header = ['study_id_A',
-              'index_variantid_b37_A',
-              'study_id_B',
-              'index_variantid_b37_B',
-              'set_type',
-              'distinct_A',
-              'overlap_AB',
-              'distinct_B']
 
     # set_types = {'finemapping': tag_dict_finemap,
     #              'ld_eur': tag_dict_ld,
     #              'combined': tag_dict}
     set_types = {'combined': tag_dict}
 
+    # Results are written as they are calculated, in task order, so rows are
+    # sorted by chromosome and the position of lead A. Only pairs where B is
+    # at or after A are calculated, the other orientation is mirrored from
+    # them when written. The output is written to a temp file and renamed
+    # once complete, so a failed run does not leave a valid partial table.
+    outtemp = os.path.join(os.path.dirname(args.outf),
+                           '.' + os.path.basename(args.outf) + '.tmp')
+    writer = pq.ParquetWriter(outtemp, pd_dtype_to_pa_schema(OUT_DTYPES),
+                              compression='snappy', flavor='spark')
+    try:
+        write_set_types(writer, set_types)
+        writer.close()
+    except BaseException:
+        writer.close()
+        os.remove(outtemp)
+        raise
+    os.replace(outtemp, args.outf)
+
+def write_set_types(writer, set_types):
+    ''' Calculates the overlaps of each set type and writes them to writer
+    '''
     # Process each set type separately
+    global set_dict, set_dict_chroms
     for set_key in set_types:
 
         set_dict = set_types[set_key]
 
-        # Partition by chromosome to speed things up
+        # Partition by chromosome and sort by position, parsing each lead's
+        # position once
         set_dict_chroms = {}
         for key in set_dict:
-            chrom, _ = parse_chrom_pos(key[1])
+            chrom, pos = parse_chrom_pos(key[1])
             try:
-                set_dict_chroms[chrom][key] = set_dict[key]
+                set_dict_chroms[chrom].append((int(pos), key))
             except KeyError:
-                set_dict_chroms[chrom] = {}
-                set_dict_chroms[chrom][key] = set_dict[key]
-
-        # Run each chromosome separately
-        c = 0
+                set_dict_chroms[chrom] = [(int(pos), key)]
         for chrom in set_dict_chroms:
-            set_dict_chrom = set_dict_chroms[chrom]
-
-            for study_A, var_A in set_dict_chrom.keys():
-                if c % 1000 == 0:
-                    print(' processing {0} {1} of {2}...'.format(set_key, c, len(set_dict)))
-                c += 1
-                for study_B, var_B in set_dict_chrom.keys():
-                    if varids_overlap_window(var_A, var_B, window):
-                        # Find overlap in sets
-                        distinct_A = set_dict_chrom[(study_A, var_A)].difference(set_dict_chrom[(study_B, var_B)])
-                        overlap_AB = set_dict_chrom[(study_A, var_A)].intersection(set_dict_chrom[(study_B, var_B)])
-                        distinct_B = set_dict_chrom[(study_B, var_B)].difference(set_dict_chrom[(study_A, var_A)])
-                        # Save result
-                        if len(overlap_AB) > 0 or only_save_overlapping == False:
-                            out_row = [study_A,
-                                       var_A,
-                                       study_B,
-                                       var_B,
-                                       set_key,
-                                       len(distinct_A),
-                                       len(overlap_AB),
-                                       len(distinct_B)]
-                            overlap_data.append(out_row)
-
-    # Write results
-    with gzip.open(args.outf, 'w') as out_h:
-        # Write header
-        out_h.write(('\t'.join(header) + '\n').encode())
-        for row in overlap_data:
-            out_h.write(('\t'.join([str(x) for x in row]) + '\n').encode())
+            set_dict_chroms[chrom].sort()
+
+        # Run chromosomes, and blocks of leads within large chromosomes, in
+        # parallel. Workers are forked, so they share the tag sets rather than
+        # receive copies. Results are collected in task order, so the output
+        # is the same whatever the number of workers, and at most two tasks
+        # per worker are pending at a time, so results are not buffered.
+        tasks = make_tasks(set_key, set_dict_chroms, TASK_LEADS)
+        print(' processing {0} loci of {1} in {2} tasks...'.format(
+            len(set_dict), set_key, len(tasks)))
+        if args.max_cores > 1 and len(tasks) > 1:
+            n_workers = min(args.max_cores, len(tasks))
+            with ProcessPoolExecutor(
+                    max_workers=n_workers,
+                    mp_context=multiprocessing.get_context('fork')) as executor:
+                write_overlaps(writer, tasks,
+                               map_ordered(executor, run_task, tasks,
+                                           2 * n_workers),
+                               args.orientation)
+        else:
+            write_overlaps(writer, tasks, map(run_task, tasks),
+                           args.orientation)
 
 def parse_chrom_pos(varid):
     ''' Gets chrom and pos from a variant ID
@@ -180,34 +177,347 @@ def parse_chrom_pos(varid):
     chrom, pos = varid.split('_')[:2]
     return chrom, pos
 
-def varids_overlap_window(var_A, var_B, window):
-    ''' Extracts chrom:pos info from two variant IDs and checks if they are
-        within a certain window of each other
+def open_dataset(path):
+    ''' Opens a parquet file or directory, including directories
+        partitioned by lead_chrom (ld.parquet written with the chrom layout).
+        Columns used as variant IDs are cast to strings where they are read.
+    '''
+    return ds.dataset(path, format='parquet', partitioning='hive')
+
+def make_varids(chrom, pos, ref, alt):
+    ''' Makes chrom_pos_ref_alt variant IDs from arrow arrays
+    '''
+    return pc.binary_join_element_wise(
+        pc.cast(chrom, pa.string()), pc.cast(pos, pa.string()),
+        pc.cast(ref, pa.string()), pc.cast(alt, pa.string()), '_')
+
+def load_tag_sets(dataset, study_index_set, row_filter=None, seen=None):
+    ''' Loads the tag variants of each (study, lead) from a flat table of
+        leads and tags, reading only the key columns
     Args:
-        var_A (chr_pos_a1_a2)
-        var_B (chr_pos_a1_a2)
-        window (int): bp window to consider an overlap
+        dataset (pyarrow.dataset): finemapping or LD table
+        study_index_set (set): (study_id, index_var) pairs to keep
+        row_filter (pyarrow.dataset.Expression): pushed down to the reader
+        seen (dict): hashed tag keys of other batches and tables, to check
+            for collisions (see variant_key.check_hash_collisions)
+    Returns:
+        dict of (study_id, index_var) -> set of integer tag keys
+    '''
+    tag_dict = {}
+    for batch in dataset.to_batches(columns=LEAD_COLS + TAG_COLS,
+                                    filter=row_filter):
+        keys = zip(batch.column(0).to_pylist(),
+                   make_varids(*batch.columns[1:5]).to_pylist())
+        tags = encode_variants_pa(*batch.columns[5:9], seen=seen).to_pylist()
+        for key, tag_var in zip(keys, tags):
+            # Skip (stid, index) pairs that are not in the top loci table
+            if not key in study_index_set:
+                continue
+            # Add to dict
+            try:
+                tag_dict[key].add(tag_var)
+            except KeyError:
+                tag_dict[key] = set([tag_var])
+    return tag_dict
+
+def is_nested_ld_table(path):
+    ''' Checks whether the LD table was written by process_ld.py
+        --out_format nested
+    '''
+    return all(os.path.isdir(os.path.join(path, name))
+               for name in ['loci', 'tagsets'])
+
+def load_nested_tag_sets(path, study_index_set, min_r2, seen=None):
+    ''' Loads the tag variants of each (study, lead) from the nested LD
+        table. Loci that share a tag set share the same set object.
+    Args:
+        path (str): nested LD table directory
+        study_index_set (set): (study_id, index_var) pairs to keep
+        min_r2 (float): minimum overall R2 of tags
+        seen (dict): hashed tag keys of other batches and tables, to check
+            for collisions (see variant_key.check_hash_collisions)
+    Returns:
+        dict of (study_id, index_var) -> set of integer tag keys
     '''
-    # Get positional info
-    chrom_A, pos_A = parse_chrom_pos(var_A)
-    chrom_B, pos_B = parse_chrom_pos(var_B)
-    # Check chroms are the same
-    if not chrom_A == chrom_B:
-        return False
-    # Check window
-    if abs(int(pos_A) - int(pos_B)) > window:
-        return False
+    # Tags of each tag set above min_r2
+    tagsets = {}
+    for batch in open_dataset(os.path.join(path, 'tagsets')).to_batches(
+            columns=['tagset_id', 'tags']):
+        tags = batch.column(1)
+        flat = pc.list_flatten(tags)
+        keep = pc.greater_equal(pc.struct_field(flat, 'overall_r2'), min_r2)
+        tagset_ids = pc.filter(
+            pc.take(batch.column(0), pc.list_parent_indices(tags)), keep)
+        tag_keys = encode_variants_pa(
+            *[pc.filter(pc.struct_field(flat, coln), keep) for coln in TAG_COLS],
+            seen=seen)
+        for tagset_id, tag_var in zip(tagset_ids.to_pylist(),
+                                      tag_keys.to_pylist()):
+            try:
+                tagsets[tagset_id].add(tag_var)
+            except KeyError:
+                tagsets[tagset_id] = set([tag_var])
+
+    # Loci with LD
+    tag_dict = {}
+    for batch in open_dataset(os.path.join(path, 'loci')).to_batches(
+            columns=LEAD_COLS + ['tagset_id'], filter=ds.field('ld_available')):
+        keys = zip(batch.column(0).to_pylist(),
+                   make_varids(*batch.columns[1:5]).to_pylist())
+        for key, tagset_id in zip(keys, batch.column(5).to_pylist()):
+            if key in study_index_set and tagset_id in tagsets:
+                tag_dict[key] = tagsets[tagset_id]
+    return tag_dict
+
+def make_tasks(set_key, set_dict_chroms, task_leads):
+    ''' Splits each chromosome's leads into blocks of at most task_leads
+    Returns:
+        list of (set_key, chrom, start, stop) in chromosome order, where
+        start and stop index set_dict_chroms[chrom]
+    '''
+    tasks = []
+    for chrom in sorted(set_dict_chroms, key=chrom_sort_key):
+        n_leads = len(set_dict_chroms[chrom])
+        for start in range(0, n_leads, task_leads):
+            tasks.append((set_key, chrom, start,
+                          min(start + task_leads, n_leads)))
+    return tasks
+
+def run_task(task):
+    ''' Finds the overlaps of leads in one block of a chromosome with all
+        other leads on the chromosome
+    Args:
+        task (set_key, chrom, start, stop): output of make_tasks
+    Returns:
+        pa.RecordBatch with the output schema, plus the A_index and B_index
+        of the leads in set_dict_chroms[chrom]
+    '''
+    set_key, chrom, start, stop = task
+    leads = set_dict_chroms[chrom]
+    if args.engine == 'sparse':
+        overlaps = overlaps_sparse(set_dict, leads, window, start, stop)
     else:
-        return True
+        overlaps = overlaps_sets(set_dict, leads, window,
+                                 only_save_overlapping, start, stop)
+    return make_overlap_batch(list(overlaps), leads, set_key)
+
+def make_overlap_batch(overlaps, leads, set_key):
+    ''' Makes a record batch of overlaps, with the lead variant IDs
+        decomposed
+    Args:
+        overlaps (list): (index_A, index_B, distinct_A, overlap_AB,
+                         distinct_B), indexes into leads
+        leads (list of (pos, (study_id, index_var))): leads on one chromosome
+        set_key (str): set type
+    Returns:
+        pa.RecordBatch with the output schema, plus A_index and B_index
+    '''
+    schema = pd_dtype_to_pa_schema(OUT_DTYPES)
+    columns = list(zip(*overlaps)) or [[]] * 5
+    data = {'set_type': [set_key] * len(overlaps),
+            'A_distinct': columns[2],
+            'AB_overlap': columns[3],
+            'B_distinct': columns[4]}
+    for prefix, indexes in [('A', columns[0]), ('B', columns[1])]:
+        keys = [leads[i][1] for i in indexes]
+        data[prefix + '_index'] = indexes
+        data[prefix + '_study_id'] = [key[0] for key in keys]
+        varids = pc.split_pattern(pa.array([key[1] for key in keys],
+                                           type=pa.string()),
+                                  '_', max_splits=3)
+        for i, coln in enumerate(['chrom', 'pos', 'ref', 'alt']):
+            data[prefix + '_' + coln] = pc.list_element(varids, i)
+    schema = schema.append(pa.field('A_index', pa.int64())) \
+                   .append(pa.field('B_index', pa.int64()))
+    return pa.RecordBatch.from_arrays(
+        [pc.cast(data[coln], schema.field(coln).type)
+         if isinstance(data[coln], (pa.Array, pa.ChunkedArray))
+         else pa.array(data[coln], type=schema.field(coln).type)
+         for coln in schema.names],
+        schema=schema
+    )
+
+def mirror_overlaps(table):
+    ''' Swaps leads A and B of each overlap, skipping a lead with itself
+    '''
+    table = table.filter(pc.not_equal(table['A_index'], table['B_index']))
+    swap = {'A': 'B', 'B': 'A'}
+    names = [swap[coln[0]] + coln[1:] if coln[:2] in ('A_', 'B_') else coln
+             for coln in table.schema.names]
+    return table.rename_columns(names).select(table.schema.names)
+
+def map_ordered(executor, fn, items, max_pending):
+    ''' As executor.map, but only submits a task when fewer than max_pending
+        are running or waiting to be collected, instead of all at once
+    Yields:
+        fn(item) for each item, in order
+    '''
+    pending = deque()
+    for item in items:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+def write_overlaps(writer, tasks, batches, orientation):
+    ''' Writes the overlaps of each task in order, combining them into row
+        groups of about LOOKUP_ROW_GROUP_SIZE rows
+    Args:
+        writer (pq.ParquetWriter): output
+        tasks (list): output of make_tasks
+        batches (iterable of pa.RecordBatch): output of run_task, one per task
+        orientation (str): 'upper' writes each pair once, with B at or after
+                           A. 'both' also writes each pair as (B, A).
+    '''
+    names = list(OUT_DTYPES.keys())
+    pending = []
+    buffer = []
+    n_rows = 0
+    for (_, _, _, stop), batch in zip(tasks, batches):
+        table = pa.Table.from_batches([batch])
+
+        # Mirrored rows belong with lead B, which may be in a later task.
+        # Keep them until that task's rows are written. The last task of a
+        # chromosome takes all that are left.
+        if orientation == 'both':
+            table = pa.concat_tables(pending + [table, mirror_overlaps(table)])
+            is_next = pc.greater_equal(table['A_index'], stop)
+            pending = [table.filter(is_next)]
+            table = (
+                table.filter(pc.invert(is_next))
+                .sort_by([('A_index', 'ascending'), ('B_index', 'ascending')])
+            )
+
+        buffer.append(table.select(names))
+        n_rows += table.num_rows
+        if n_rows >= LOOKUP_ROW_GROUP_SIZE:
+            writer.write_table(pa.concat_tables(buffer),
+                               row_group_size=LOOKUP_ROW_GROUP_SIZE)
+            buffer = []
+            n_rows = 0
+    if n_rows > 0:
+        writer.write_table(pa.concat_tables(buffer))
+
+def window_neighbours(leads, window, start=0, stop=None):
+    ''' Sweeps over leads sorted by position, so that only pairs within the
+        window are visited. As overlaps are symmetric, only the leads at or
+        after each lead are returned.
+    Args:
+        leads (list of (pos, key)): leads on one chromosome, sorted
+        window (int): bp window to consider an overlap
+        start, stop (int): only yield leads[start:stop]
+    Yields:
+        (index, range of indexes from index up to the end of its window), in
+        position order
+    '''
+    stop = len(leads) if stop is None else stop
+    hi = start
+    for i in range(start, stop):
+        # Move the window edge up to this lead
+        while hi < len(leads) and leads[hi][0] <= leads[i][0] + window:
+            hi += 1
+        yield i, range(i, hi)
+
+def overlaps_sets(set_dict, leads, window, only_save_overlapping=True,
+                  start=0, stop=None):
+    ''' Counts the overlap between the tag sets of each pair of leads within
+        the window, with python set operations
+    Args:
+        set_dict (dict): (study_id, index_var) -> set of tag variants
+        leads (list of (pos, (study_id, index_var))): leads on one
+                                                      chromosome, sorted
+        window (int): bp window to consider an overlap
+        only_save_overlapping (bool): skip pairs without shared tags
+        start, stop (int): only pairs with lead A in leads[start:stop]
+    Yields:
+        (index_A, index_B, distinct_A, overlap_AB, distinct_B) where B is at
+        or after A, in position order
+    '''
+    for index_A, indexes_B in window_neighbours(leads, window, start, stop):
+        set_A = set_dict[leads[index_A][1]]
+        for index_B in indexes_B:
+            set_B = set_dict[leads[index_B][1]]
+            # Find overlap in sets
+            distinct_A = set_A.difference(set_B)
+            overlap_AB = set_A.intersection(set_B)
+            distinct_B = set_B.difference(set_A)
+            if len(overlap_AB) > 0 or only_save_overlapping == False:
+                yield (index_A, index_B, len(distinct_A), len(overlap_AB),
+                       len(distinct_B))
+
+def overlaps_sparse(set_dict, leads, window, start=0, stop=None):
+    ''' Counts the overlap between the tag sets of each pair of leads within
+        the window, as the product M . M^T of a sparse (lead x tag) incidence
+        matrix. The product is taken in blocks of rows, each against the
+        columns from the block up to the end of its window, so only the band
+        above the diagonal is calculated. Only pairs with shared tags are
+        reported.
+    Args:
+        set_dict (dict): (study_id, index_var) -> set of integer tag keys
+        leads (list of (pos, (study_id, index_var))): leads on one
+                                                      chromosome, sorted
+        window (int): bp window to consider an overlap
+        start, stop (int): only pairs with lead A in leads[start:stop]
+    Yields:
+        (index_A, index_B, distinct_A, overlap_AB, distinct_B), in the same
+        order as overlaps_sets
+    '''
+    stop = len(leads) if stop is None else stop
+    if start >= stop:
+        return
+
+    # Only leads from leads[start] to the end of the window of
+    # leads[stop - 1] are needed
+    positions = np.array([pos for pos, _ in leads], dtype=np.int64)
+    lo = start
+    hi = np.searchsorted(positions, positions[stop - 1] + window, side='right')
+    positions = positions[lo:hi]
+    keys = [key for _, key in leads[lo:hi]]
+
+    # Build the incidence matrix, one column per distinct tag variant
+    sizes = np.array([len(set_dict[key]) for key in keys], dtype=np.int64)
+    tags = np.fromiter((tag for key in keys for tag in set_dict[key]),
+                       dtype=np.int64, count=sizes.sum())
+    tag_ids, indices = np.unique(tags, return_inverse=True)
+    indptr = np.concatenate([[0], np.cumsum(sizes)])
+    M = sp.csr_matrix(
+        (np.ones(len(indices), dtype=np.int32), indices.ravel(), indptr),
+        shape=(len(keys), len(tag_ids))
+    )
+    MT = M.T.tocsr()
+
+    for block_start in range(start - lo, stop - lo, SPARSE_BLOCK_ROWS):
+        block_stop = min(block_start + SPARSE_BLOCK_ROWS, stop - lo)
+        # Columns from the block to the end of the window of its last row
+        col_lo = block_start
+        col_hi = np.searchsorted(positions, positions[block_stop - 1] + window,
+                                 side='right')
+        overlap = (M[block_start:block_stop] @ MT[:, col_lo:col_hi]).tocoo()
+
+        # Keep pairs in the upper triangle and within the window, in
+        # (row, column) order
+        rows = overlap.row + block_start
+        cols = overlap.col + col_lo
+        keep = (cols >= rows) & (positions[cols] - positions[rows] <= window)
+        rows, cols, counts = rows[keep], cols[keep], overlap.data[keep]
+        order = np.lexsort((cols, rows))
+        for row, col, count in zip(rows[order].tolist(), cols[order].tolist(),
+                                   counts[order].tolist()):
+            yield (row + lo, col + lo, int(sizes[row]) - count, count,
+                   int(sizes[col]) - count)
 
 def parse_args():
     """ Load command line args """
     parser = argparse.ArgumentParser()
-    parser.add_argument('--top_loci', metavar="<file>", type=str, required=True)
-    parser.add_argument('--ld', metavar="<file>", type=str, required=True)
-    parser.add_argument('--finemap', metavar="<file>", type=str, required=True)
+    parser.add_argument('--top_loci', metavar="<file>", help=("Top loci parquet"), type=str, required=True)
+    parser.add_argument('--ld', metavar="<file>", help=("LD table parquet, flat or nested"), type=str, required=True)
+    parser.add_argument('--finemap', metavar="<file>", help=("Finemapping table parquet"), type=str, required=True)
     parser.add_argument('--min_r2', metavar="<float>", type=float, required=True)
-    parser.add_argument('--outf', metavar="<str>", type=str, required=True)
+    parser.add_argument('--outf', metavar="<str>", help=("Output locus overlap parquet"), type=str, required=True)
+    parser.add_argument('--max_cores', metavar="<int>", help=("Maximum cores to use"), type=int, default=os.cpu_count())
+    parser.add_argument('--orientation', metavar="<str>", help=("Write each pair of loci as both (A, B) and (B, A), or only once with B at or after A (default: both)"), type=str, choices=['both', 'upper'], default='both')
+    parser.add_argument('--engine', metavar="<str>", help=("Count overlaps with python sets, or with a sparse matrix product (default: sets)"), type=str, choices=['sets', 'sparse'], default='sets')
     args = parser.parse_args()
     return args
 
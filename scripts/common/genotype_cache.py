@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Per-process cache of reference genotypes for the LD calculator.
+
+LD for a variant is calculated in every population, so filesets are cached a
+chromosome at a time: the filesets of all requested populations are loaded
+into memory if they fit in the budget together, and chromosomes are dropped
+least recently used first when the budget is needed for another one. If a
+chromosome's filesets do not fit together, all of them are read from the
+memory-mapped beds instead, rather than evicting each other in turn.
+'''
+
+from collections import OrderedDict
+
+import numpy as np
+from psutil import virtual_memory
+
+from common.plink_bed import PlinkBed, standardise
+
+# Variants decoded at a time when loading a fileset
+DECODE_BATCH_SIZE = 10000
+
+def detect_worker_memory_limit(n_workers, fraction=0.5):
+    ''' Splits a fraction of the physical memory evenly between n_workers
+        worker processes. The remainder is left for the workers' other
+        allocations.
+    Args:
+        n_workers (int): number of worker processes
+        fraction (float): fraction of physical memory to split
+    Returns:
+        int, bytes per worker
+    '''
+    return int(virtual_memory().total * fraction / max(n_workers, 1))
+
+def estimate_bed_nbytes(bed):
+    ''' Memory held by an opened fileset besides its memory-mapped genotypes,
+        i.e. the bim table and the indexes built from it
+    '''
+    return int(bed.bim.memory_usage(index=True, deep=True).sum()
+               + bed.unique_rows.nbytes
+               + bed.unique_ids.memory_usage(deep=True))
+
+class CachedGenotypes(object):
+    ''' Reference genotypes for one plink fileset held in memory, with the
+        same read interface as PlinkBed
+    Args:
+        bed (PlinkBed): fileset to load
+        packed_only (bool): keep the packed genotypes only (for the popcount
+            kernel), instead of decoding them
+    '''
+
+    def __init__(self, bed, packed_only=False):
+        self.bed = bed
+        self.bim = bed.bim
+        self.n_samples = bed.n_samples
+        self.n_variants = bed.n_variants
+        self.positions = bed.positions
+        self.variant_ids = bed.variant_ids
+        self.packed_only = packed_only
+
+        if packed_only:
+            self.packed = bed.read_packed(0, bed.n_variants).copy()
+            return
+
+        # Decode to A1 allele counts (int8, -1 where missing) and precompute
+        # per-variant allele frequency and variance over non-missing samples
+        self.dosages = np.empty((bed.n_variants, bed.n_samples), dtype=np.int8)
+        self.freq = np.empty(bed.n_variants)
+        self.var = np.empty(bed.n_variants)
+        n_missing = np.empty(bed.n_variants, dtype=np.int64)
+        for start in range(0, bed.n_variants, DECODE_BATCH_SIZE):
+            stop = min(start + DECODE_BATCH_SIZE, bed.n_variants)
+            G = bed.read_dosages(start, stop)
+            self.dosages[start:stop] = np.nan_to_num(G, nan=-1)
+            with np.errstate(invalid='ignore'):
+                self.freq[start:stop] = np.nanmean(G, axis=1) / 2
+                self.var[start:stop] = np.nanvar(G, axis=1)
+            n_missing[start:stop] = np.isnan(G).sum(axis=1)
+        self.missing_cumsum = np.concatenate([[0], np.cumsum(n_missing)])
+
+    @staticmethod
+    def estimate_nbytes(bed, packed_only=False):
+        ''' Memory needed to cache a fileset, without loading it
+        '''
+        if packed_only:
+            return bed.n_variants * bed.bytes_per_variant
+        return bed.n_variants * (bed.n_samples + 3 * 8)
+
+    def locate(self, varid):
+        return self.bed.locate(varid)
+
+    def window(self, idx, window_bp):
+        return self.bed.window(idx, window_bp)
+
+    def read_packed(self, start, stop):
+        if self.packed_only:
+            return self.packed[start:stop]
+        return self.bed.read_packed(start, stop)
+
+    def read_dosages(self, start, stop):
+        if self.packed_only:
+            return self.bed.read_dosages(start, stop)
+        G = self.dosages[start:stop].astype(np.float64)
+        G[G < 0] = np.nan
+        return G
+
+    def read_standardised(self, start, stop):
+        if self.packed_only:
+            return self.bed.read_standardised(start, stop)
+        if self.missing_cumsum[stop] - self.missing_cumsum[start] > 0:
+            return None
+        return standardise(self.dosages[start:stop].astype(np.float64),
+                           mean=2 * self.freq[start:stop],
+                           var=self.var[start:stop])
+
+class GenotypeCache(object):
+    ''' LRU cache of reference genotypes keyed by chromosome, holding the
+        filesets of every requested population on that chromosome
+    Args:
+        max_bytes (int): memory budget for opened filesets and cached
+            genotypes
+        packed_only (bool): cache packed rather than decoded genotypes
+    '''
+
+    def __init__(self, max_bytes, packed_only=False):
+        self.max_bytes = max_bytes
+        self.packed_only = packed_only
+        self.entries = OrderedDict()
+        self.nbytes = {}
+
+    def get(self, pop, chrom, bfiles):
+        ''' Returns the genotypes of pop on chrom, opening the filesets of all
+            populations in bfiles if the chromosome is not cached yet
+        Args:
+            pop (str): population to return
+            chrom (str): chromosome
+            bfiles (dict): plink file prefix of each population requested on
+                chrom, including pop
+        Returns:
+            CachedGenotypes, or PlinkBed if the chromosome's genotypes do not
+            fit in the budget
+        '''
+        if chrom not in self.entries:
+            self.load_chrom(chrom, bfiles)
+        self.entries.move_to_end(chrom)
+        entry = self.entries[chrom]
+
+        # Decode cached genotypes on first use
+        if entry['cached'] and pop not in entry['genotypes']:
+            entry['genotypes'][pop] = CachedGenotypes(
+                entry['beds'][pop], self.packed_only)
+        return entry['genotypes'].get(pop, entry['beds'][pop])
+
+    def load_chrom(self, chrom, bfiles):
+        ''' Opens the filesets of a chromosome and reserves the budget for
+            them, evicting least recently used chromosomes
+        '''
+        beds = OrderedDict(
+            (pop, PlinkBed(bfile)) for pop, bfile in bfiles.items())
+        bed_nbytes = sum(estimate_bed_nbytes(bed) for bed in beds.values())
+        geno_nbytes = sum(
+            CachedGenotypes.estimate_nbytes(bed, self.packed_only)
+            for bed in beds.values())
+
+        # Cache the genotypes only if all populations fit together,
+        # otherwise read them from the memory-mapped beds
+        cached = bed_nbytes + geno_nbytes <= self.max_bytes
+        nbytes = bed_nbytes + geno_nbytes if cached else bed_nbytes
+
+        # Evict least recently used chromosomes until the new one fits
+        while self.entries and sum(self.nbytes.values()) + nbytes > self.max_bytes:
+            evicted, _ = self.entries.popitem(last=False)
+            del self.nbytes[evicted]
+
+        self.entries[chrom] = {'beds': beds, 'cached': cached, 'genotypes': {}}
+        self.nbytes[chrom] = nbytes
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Append-only completion journal, used to resume interrupted runs.
+
+Each finished unit of work is recorded with its output file and the output's
+md5 checksum. Every process appends to its own journal file, so records from
+parallel workers are never interleaved. On restart, work is only skipped if
+its output still exists and matches the recorded checksum.
+'''
+
+import os
+import json
+import glob
+import hashlib
+
+class Journal(object):
+    ''' Completion journal stored in journal_dir
+    Args:
+        journal_dir (str): directory holding the journal files
+        base_dir (str): output paths are recorded relative to this directory
+        params (dict): run parameters. A journal written with different
+            parameters is discarded.
+    '''
+
+    def __init__(self, journal_dir, base_dir, params):
+        self.journal_dir = journal_dir
+        self.base_dir = base_dir
+        os.makedirs(journal_dir, exist_ok=True)
+
+        # Start a new journal if the parameters have changed
+        params_file = os.path.join(journal_dir, 'params.json')
+        if os.path.exists(params_file):
+            with open(params_file, 'r') as in_h:
+                if json.load(in_h) != params:
+                    print('Run parameters changed, discarding journal')
+                    for inf in self.journal_files():
+                        os.remove(inf)
+        with open(params_file, 'w') as out_h:
+            json.dump(params, out_h, sort_keys=True)
+
+    def journal_files(self):
+        return sorted(glob.glob(os.path.join(self.journal_dir, '*.tsv')))
+
+    def completed(self):
+        ''' Reads all journal files and validates the recorded outputs
+        Returns:
+            dict of key -> output path, for keys whose outputs exist with a
+            matching checksum
+        '''
+        records = {}
+        for inf in self.journal_files():
+            with open(inf, 'r') as in_h:
+                for line in in_h:
+                    parts = line.rstrip('\n').split('\t')
+                    # Skip a partially written last line
+                    if len(parts) != 3 or len(parts[2]) != 32:
+                        continue
+                    key, path, checksum = parts
+                    records.setdefault(key, []).append((path, checksum))
+
+        # A key is complete if any of its outputs is valid. Several keys can
+        # share an output, so only checksum each output once.
+        valid = {}
+        completed = {}
+        for key in records:
+            for path, checksum in records[key]:
+                path = os.path.join(self.base_dir, path)
+                if path not in valid:
+                    valid[path] = os.path.exists(path) and \
+                        file_checksum(path) == checksum
+                if valid[path]:
+                    completed[key] = path
+
+        return completed
+
+    def record(self, outputs):
+        ''' Appends completed work to this process' journal file
+        Args:
+            outputs (dict): key -> output file path
+        '''
+        checksums = {}
+        lines = []
+        for key, path in outputs.items():
+            if path not in checksums:
+                checksums[path] = file_checksum(path)
+            lines.append('\t'.join([
+                key,
+                os.path.relpath(path, self.base_dir),
+                checksums[path]
+            ]) + '\n')
+
+        outf = os.path.join(self.journal_dir, '{0}.tsv'.format(os.getpid()))
+        with open(outf, 'a') as out_h:
+            out_h.write(''.join(lines))
+            out_h.flush()
+            os.fsync(out_h.fileno())
+
+def file_checksum(path, block_size=2**20):
+    ''' md5 hex digest of a file
+    '''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as in_h:
+        for block in iter(lambda: in_h.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
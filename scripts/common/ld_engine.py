@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+In-process LD (correlation) calculation on decoded plink genotypes.
+
+Reproduces `plink --r --ld-snp <varid> --ld-window-kb <kb>` so that the
+output of calc_ld_1000G.v2.py does not change when plink is not used.
+'''
+
+import numpy as np
+import pandas as pd
+
+from common.pics import weighted_r2, make_ancestry_key
+from common.plink_bed import pack_sample_mask
+
+# plink only reports pairs with r2 >= --ld-window-r2, which defaults to 0.2
+PLINK_LD_WINDOW_R2 = 0.2
+
+# plink writes R with 6 significant digits. Anything that passes the r2 filter
+# above has |R| > 0.1, so this is the same as rounding to 6 dp.
+PLINK_R_DECIMALS = 6
+
+# Versions of each engine's results, part of the LD store key. Bump when a
+# change alters the R values an engine calculates, so that stored results
+# are recalculated. native 2: male het calls on chrX are missing.
+CALC_VERSIONS = {'native': 'native-v2', 'plink': 'plink-v1'}
+
+# Populations and their manifest proportion columns, in manifest order
+POPULATIONS = ['AFR', 'AMR', 'EAS', 'EUR', 'SAS']
+PROP_COLS = ['{}_prop'.format(pop) for pop in POPULATIONS]
+
+# Set bits in each byte value, for numpy versions without bitwise_count
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def pairwise_r(X, Y):
+    ''' Pearson correlation between every row of X and every row of Y. Samples
+        missing (NaN) in either variant of a pair are excluded from that pair,
+        as in plink.
+    Args:
+        X (np.array): dosages of shape (k, n_samples)
+        Y (np.array): dosages of shape (m, n_samples)
+    Returns:
+        np.array of shape (k, m), NaN where either variant is monomorphic
+    '''
+    mask_x = ~np.isnan(X)
+    mask_y = ~np.isnan(Y)
+    X0 = np.where(mask_x, X, 0.0)
+    Y0 = np.where(mask_y, Y, 0.0)
+    mask_x = mask_x.astype(np.float64)
+    mask_y = mask_y.astype(np.float64)
+
+    # Sums over the samples that are non-missing in both variants
+    n = mask_x @ mask_y.T
+    sum_x = X0 @ mask_y.T
+    sum_y = mask_x @ Y0.T
+    sum_xx = (X0 ** 2) @ mask_y.T
+    sum_yy = mask_x @ (Y0 ** 2).T
+    sum_xy = X0 @ Y0.T
+
+    return r_from_sums(n, sum_x, sum_y, sum_xx, sum_yy, sum_xy)
+
+def popcount_r(X, Y, n_samples):
+    ''' Same as pairwise_r, but calculated directly on 2-bit packed plink
+        genotypes using bitwise AND and popcount, without decoding to floats.
+        Missing genotypes are excluded pairwise, as in pairwise_r.
+    Args:
+        X (np.array): packed genotypes of shape (k, bytes_per_variant)
+        Y (np.array): packed genotypes of shape (m, bytes_per_variant)
+        n_samples (int): number of samples, used to ignore the padding bits
+    Returns:
+        np.array of shape (k, m)
+    '''
+    het_x, hom_x, valid_x = genotype_planes(X, n_samples)
+    het_y, hom_y, valid_y = genotype_planes(Y, n_samples)
+
+    # Sums over the samples that are non-missing in both variants. The het and
+    # hom planes are 0 where missing, so only sums over a single variant need
+    # masking by the other variant's valid plane.
+    shape = (X.shape[0], Y.shape[0])
+    n, sum_x, sum_y, sum_xx, sum_yy, sum_xy = [np.empty(shape) for _ in range(6)]
+    for i in range(X.shape[0]):
+        het_x_y = popcount(het_x[i] & valid_y)
+        hom_x_y = popcount(hom_x[i] & valid_y)
+        het_y_x = popcount(het_y & valid_x[i])
+        hom_y_x = popcount(hom_y & valid_x[i])
+        n[i] = popcount(valid_x[i] & valid_y)
+        sum_x[i] = het_x_y + hom_x_y
+        sum_y[i] = het_y_x + hom_y_x
+        sum_xx[i] = het_x_y + 3 * hom_x_y
+        sum_yy[i] = het_y_x + 3 * hom_y_x
+        sum_xy[i] = (popcount(het_x[i] & het_y) + popcount(het_x[i] & hom_y) +
+                     popcount(hom_x[i] & het_y) + popcount(hom_x[i] & hom_y))
+
+    return r_from_sums(n, sum_x, sum_y, sum_xx, sum_yy, sum_xy)
+
+def genotype_planes(packed, n_samples):
+    ''' Splits packed plink genotypes into bit planes, keeping the 2-bit
+        layout (one bit per sample at the even positions). The sample's
+        allele count is het + hom, counting the allele that plink codes as
+        11 (sign of R is unaffected as both variants are counted the same way).
+    Args:
+        packed (np.array): uint8 array of shape (m, bytes_per_variant)
+        n_samples (int): number of samples
+    Returns:
+        (het, hom, valid) uint64 arrays of shape (m, words)
+    '''
+    # Pad to whole 64 bit words
+    pad = -packed.shape[1] % 8
+    packed = np.pad(packed, ((0, 0), (0, pad)))
+
+    low = packed & 0x55
+    high = (packed >> 1) & 0x55
+    het = high                  # 10 or 11: at least one copy
+    hom = low & high            # 11: two copies
+    missing = low & ~high       # 01: missing
+
+    # Padding samples are coded 00, so must be masked out of valid
+    sample_mask = pack_sample_mask(np.ones(n_samples, dtype=bool), packed.shape[1])
+    valid = ~missing & sample_mask
+
+    return tuple(a.view(np.uint64) for a in (het, hom, valid))
+
+def popcount(a):
+    ''' Counts set bits along the last axis of a uint64 array
+    '''
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(a).sum(axis=-1, dtype=np.int64)
+    return POPCOUNT_TABLE[a.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+def r_from_sums(n, sum_x, sum_y, sum_xx, sum_yy, sum_xy):
+    ''' Pearson correlation from the sums over pairwise-complete samples
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = sum_xy - sum_x * sum_y / n
+        var_x = sum_xx - sum_x ** 2 / n
+        var_y = sum_yy - sum_y ** 2 / n
+        r = cov / np.sqrt(var_x * var_y)
+
+    return np.clip(r, -1.0, 1.0)
+
+def format_r(r):
+    ''' Applies plink's reporting rules to R values
+    Returns:
+        (rounded R values, boolean mask of values that plink would report)
+    '''
+    r = np.round(r, PLINK_R_DECIMALS)
+    keep = ~np.isnan(r) & (r ** 2 >= PLINK_LD_WINDOW_R2)
+    return r, keep
+
+def calc_ld_variant(bed, varid, pop, ld_window, kernel='float'):
+    ''' Calculates R between an index variant and every variant within
+        ld_window kb of it
+    Args:
+        bed (PlinkBed or CachedGenotypes): reference genotypes
+        varid (str): variant ID as it appears in the plink bim
+        pop (str): name of population
+        ld_window (int): window around variant to calc LD for (kb)
+        kernel (str): 'float' to decode genotypes, or 'popcount' to work on
+            the packed genotypes
+    Returns:
+        pd.DataFrame with columns index_variant_id, tag_variant_id, R_{pop}
+    '''
+    cols = ['index_variant_id', 'tag_variant_id', 'R_{}'.format(pop)]
+
+    idx = bed.locate(varid)
+    if idx is None:
+        return pd.DataFrame(columns=cols)
+
+    start, stop = bed.window(idx, ld_window * 1000)
+    lead_rows = [idx - start]
+    if kernel == 'popcount':
+        window = bed.read_packed(start, stop)
+        r = popcount_r(window[lead_rows], window, bed.n_samples)
+    else:
+        window = bed.read_dosages(start, stop)
+        r = pairwise_r(window[lead_rows], window)
+    r, keep = format_r(r[0])
+
+    return pd.DataFrame({
+        cols[0]: varid,
+        cols[1]: bed.variant_ids[start:stop][keep],
+        cols[2]: r[keep]
+    }, columns=cols)
+
+def calc_ld_block(bed, varids, pop, ld_window, kernel='float'):
+    ''' Calculates R between each of a block of nearby index variants and every
+        variant within ld_window kb of it. The genotypes covering all of the
+        windows are decoded and standardised once, and all lead vs window
+        correlations come from one matrix product.
+    Args:
+        bed (PlinkBed or CachedGenotypes): reference genotypes
+        varids (list of str): variant IDs as they appear in the plink bim
+        pop (str): name of population
+        ld_window (int): window around each variant to calc LD for (kb)
+        kernel (str): 'float' to decode genotypes, or 'popcount' to work on
+            the packed genotypes
+    Returns:
+        pd.DataFrame with columns index_variant_id, tag_variant_id, R_{pop}
+    '''
+    cols = ['index_variant_id', 'tag_variant_id', 'R_{}'.format(pop)]
+
+    # Find the leads that are in the reference, and the window of each
+    leads = []
+    for varid in varids:
+        idx = bed.locate(varid)
+        if idx is not None:
+            leads.append((varid, idx) + bed.window(idx, ld_window * 1000))
+    if len(leads) == 0:
+        return pd.DataFrame(columns=cols)
+
+    # Read the union of all windows once
+    block_start = min(lead[2] for lead in leads)
+    block_stop = max(lead[3] for lead in leads)
+    lead_rows = [lead[1] - block_start for lead in leads]
+
+    # All lead vs block correlations. Fall back to pairwise deletion if any
+    # genotypes are missing.
+    if kernel == 'popcount':
+        block = bed.read_packed(block_start, block_stop)
+        r = popcount_r(block[lead_rows], block, bed.n_samples)
+    else:
+        Z = bed.read_standardised(block_start, block_stop)
+        if Z is None:
+            block = bed.read_dosages(block_start, block_stop)
+            r = pairwise_r(block[lead_rows], block)
+        else:
+            r = np.clip((Z[lead_rows] @ Z.T) / Z.shape[1], -1.0, 1.0)
+
+    # Keep each lead's own window
+    res = []
+    for i, (varid, idx, start, stop) in enumerate(leads):
+        r_lead, keep = format_r(r[i, start - block_start:stop - block_start])
+        res.append(pd.DataFrame({
+            cols[0]: varid,
+            cols[1]: bed.variant_ids[start:stop][keep],
+            cols[2]: r_lead[keep]
+        }, columns=cols))
+
+    return pd.concat(res, ignore_index=True)
+
+def make_blocks(positions, max_span_bp):
+    ''' Groups sorted positions into consecutive blocks, each spanning no more
+        than max_span_bp from its first to its last position
+    Args:
+        positions (list of int): sorted positions
+        max_span_bp (int): maximum distance between first and last in a block
+    Returns:
+        list of (start, stop) index ranges into positions
+    '''
+    blocks = []
+    start = 0
+    for i in range(1, len(positions) + 1):
+        if i == len(positions) or positions[i] - positions[start] > max_span_bp:
+            blocks.append((start, i))
+            start = i
+    return blocks
+
+def load_ancestries(inf):
+    ''' Loads the distinct population proportion vectors for each index
+        variant from the LD analysis manifest. Vectors are compared and keyed
+        by their text in the manifest, so that process_ld.py can join them
+        back to studies exactly.
+    Returns:
+        pd.DataFrame with columns index_variant_id (plink format),
+        ancestry_key and the proportion columns
+    '''
+    # Only empty fields are missing, as when Spark reads the manifest
+    manifest = pd.read_csv(inf, sep='\t', header=0, dtype=str,
+                           usecols=['variant_id'] + PROP_COLS,
+                           keep_default_na=False, na_values=[''])
+    manifest['ancestry_key'] = make_ancestry_key(manifest[PROP_COLS])
+    manifest['index_variant_id'] = manifest['variant_id'].str.replace('_', ':')
+    ancestries = (
+        manifest.loc[:, ['index_variant_id', 'ancestry_key'] + PROP_COLS]
+        .drop_duplicates(subset=['index_variant_id', 'ancestry_key'])
+    )
+    for coln in PROP_COLS:
+        ancestries[coln] = pd.to_numeric(ancestries[coln], errors='coerce')
+    return ancestries
+
+def weight_by_ancestry(ld, ancestries, min_r2):
+    ''' Calculates the population weighted R2 for each distinct proportion
+        vector of the index variants, as in process_ld.py: Fisher transform R
+        in each population, take the proportion weighted mean, inverse
+        transform and round to 6 dp.
+    Args:
+        ld (pd.DataFrame): index_variant_id, tag_variant_id, R_{pop} columns
+        ancestries (pd.DataFrame): output of load_ancestries
+        min_r2 (float): minimum weighted R2 to keep
+    Returns:
+        pd.DataFrame with columns index_variant_id, tag_variant_id,
+        ancestry_key, R2_overall
+    '''
+    data = pd.merge(ld, ancestries, on='index_variant_id', how='inner')
+
+    r2_overall = weighted_r2(
+        data.loc[:, ['R_{}'.format(pop) for pop in POPULATIONS]].astype('float64').values,
+        data.loc[:, PROP_COLS].values
+    )
+    keep = r2_overall >= min_r2
+
+    data = data.loc[keep, ['index_variant_id', 'tag_variant_id', 'ancestry_key']]
+    data['R2_overall'] = r2_overall[keep]
+
+    return data
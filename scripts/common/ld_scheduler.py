@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Splits the LD variant list into work for the LD worker pool.
+
+Variants are sorted by (chromosome, position) and cut into contiguous chunks
+of roughly equal cost, where the cost of a variant is the number of reference
+variants in its LD window. Chunks are then assigned to workers so that each
+worker sees as few chromosomes as possible while the total cost per worker
+stays balanced.
+
+For runs split over several machines, shard_variants cuts the sorted variants
+into contiguous genomic regions of equal cost in the same way, one per shard.
+'''
+
+import numpy as np
+
+# Number of chunks per worker. More chunks balance better but split
+# chromosomes over more workers.
+CHUNKS_PER_WORKER = 8
+
+def parse_variant(varid, sep=':'):
+    ''' Gets (chrom, pos) from a variant ID
+    '''
+    chrom, pos = varid.split(sep)[:2]
+    return chrom, int(pos)
+
+def chrom_sort_key(chrom):
+    ''' Sorts chromosomes numerically, then X, Y, MT
+    '''
+    return (0, int(chrom), '') if chrom.isdigit() else (1, 0, chrom)
+
+def window_costs(positions, ref_positions, window_bp):
+    ''' Estimates the cost of each variant as the number of reference variants
+        within window_bp of it
+    Args:
+        positions (list of int): variant positions
+        ref_positions (np.array): sorted reference panel positions
+        window_bp (int): LD window in bp
+    Returns:
+        np.array of costs, at least 1 per variant
+    '''
+    positions = np.asarray(positions)
+    start = np.searchsorted(ref_positions, positions - window_bp, side='left')
+    stop = np.searchsorted(ref_positions, positions + window_bp, side='right')
+    return np.maximum(stop - start, 1)
+
+def make_chunks(variants, target_cost):
+    ''' Cuts variants into contiguous chunks on the same chromosome
+    Args:
+        variants (list of (chrom, pos, varid, cost)): sorted by chrom, pos
+        target_cost (float): chunk is closed once its cost reaches this
+    Returns:
+        list of dicts with keys chrom, varids, cost
+    '''
+    chunks = []
+    current = None
+    for chrom, pos, varid, cost in variants:
+        if current is None or current['chrom'] != chrom or \
+                current['cost'] >= target_cost:
+            current = {'chrom': chrom, 'varids': [], 'cost': 0}
+            chunks.append(current)
+        current['varids'].append(varid)
+        current['cost'] += cost
+    return chunks
+
+def assign_chunks(chunks, n_workers):
+    ''' Assigns chunks to workers. Largest chunks first, each to the least
+        loaded worker, unless a worker already holding the same chromosome
+        is still below the average load.
+    Args:
+        chunks (list of dict): output of make_chunks
+        n_workers (int): number of workers
+    Returns:
+        list (one per worker) of chunk lists, each sorted by chrom and pos
+    '''
+    total = sum(chunk['cost'] for chunk in chunks)
+    mean_load = total / max(n_workers, 1)
+
+    loads = [0] * n_workers
+    chroms = [set() for _ in range(n_workers)]
+    assigned = [[] for _ in range(n_workers)]
+    for order, chunk in sorted(enumerate(chunks),
+                               key=lambda x: x[1]['cost'], reverse=True):
+        least = min(range(n_workers), key=lambda w: loads[w])
+        same_chrom = [w for w in range(n_workers)
+                      if chunk['chrom'] in chroms[w]
+                      and loads[w] + chunk['cost'] <= mean_load]
+        worker = min(same_chrom, key=lambda w: loads[w]) if same_chrom else least
+        loads[worker] += chunk['cost']
+        chroms[worker].add(chunk['chrom'])
+        assigned[worker].append((order, chunk))
+
+    # Process each worker's chunks in genomic order
+    return [[chunk for _, chunk in sorted(worker_chunks, key=lambda x: x[0])]
+            for worker_chunks in assigned if worker_chunks]
+
+def shard_variants(varids, ref_positions, window_bp, shard, n_shards):
+    ''' Deterministically splits variants into n_shards contiguous genomic
+        regions of roughly equal cost, and returns those in one shard. Every
+        machine that runs a shard gets the same partition, provided it is
+        given the same variant list and reference panel.
+    Args:
+        varids (iterable of str): chrom:pos:ref:alt variant IDs
+        ref_positions (dict): chrom -> sorted np.array of reference positions
+        window_bp (int): LD window in bp
+        shard (int): shard number, 1 to n_shards
+        n_shards (int): number of shards
+    Returns:
+        set of variant IDs in the shard
+    '''
+    variants = sort_variants(varids, ref_positions, window_bp)
+    costs = np.cumsum([variant[3] for variant in variants])
+    if len(costs) == 0:
+        return set([])
+
+    # Shard s holds the variants whose cumulative cost ends in its slice of
+    # the total
+    bounds = costs[-1] * np.arange(1, n_shards) / n_shards
+    shards = np.searchsorted(bounds, costs, side='left') + 1
+
+    return set(variant[2] for variant, s in zip(variants, shards) if s == shard)
+
+def sort_variants(varids, ref_positions, window_bp):
+    ''' Sorts variants by chromosome and position, and estimates their cost
+    Returns:
+        list of (chrom, pos, varid, cost)
+    '''
+    by_chrom = {}
+    for varid in varids:
+        chrom, pos = parse_variant(varid)
+        by_chrom.setdefault(chrom, []).append((pos, varid))
+
+    variants = []
+    for chrom in sorted(by_chrom, key=chrom_sort_key):
+        chrom_variants = sorted(by_chrom[chrom])
+        positions = [pos for pos, _ in chrom_variants]
+        costs = window_costs(positions,
+                             ref_positions.get(chrom, np.array([], dtype=int)),
+                             window_bp)
+        for (pos, varid), cost in zip(chrom_variants, costs):
+            variants.append((chrom, pos, varid, int(cost)))
+
+    return variants
+
+def schedule_variants(varids, ref_positions, window_bp, n_workers):
+    ''' Splits variants into balanced, chromosome-affine work for each worker
+    Args:
+        varids (iterable of str): chrom:pos:ref:alt variant IDs
+        ref_positions (dict): chrom -> sorted np.array of reference positions
+        window_bp (int): LD window in bp
+        n_workers (int): number of workers
+    Returns:
+        list (one per worker) of chunk lists
+    '''
+    variants = sort_variants(varids, ref_positions, window_bp)
+    if len(variants) == 0:
+        return []
+
+    total = sum(variant[3] for variant in variants)
+    target_cost = total / (n_workers * CHUNKS_PER_WORKER)
+    chunks = make_chunks(variants, target_cost)
+
+    return assign_chunks(chunks, n_workers)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Persistent store of LD results, reused between releases.
+
+Results are kept as the parquet shards written by calc_ld_1000G.v2.py, in a
+directory per reference panel version, LD window, min R2, set of populations
+and calculation version (everything that changes the calculated values):
+
+    {store}/panel={version}/ld_window={kb}/min_r2={min_r2}/pops={AFR-AMR-...}/calc={calc}/
+
+The calculation version names the engine and the version of its results
+(common.ld_engine.CALC_VERSIONS), so that results of an older engine are not
+reused.
+
+An append-only index.tsv in that directory records which shard holds each
+index variant. Index variants already in the store are exported from it
+instead of being recalculated.
+'''
+
+import os
+import uuid
+import shutil
+
+import pyarrow.parquet as pq
+
+class LDStore(object):
+    ''' LD results for one panel version, window, min R2, population set and
+        calculation version
+    Args:
+        store_dir (str): root of the store
+        panel_version (str): reference panel version
+        ld_window (int): LD window (kb)
+        min_r2 (float): minimum R2 that results were filtered on
+        pops (list of str): populations
+        calc (str): calculation version, e.g. native-v2
+    '''
+
+    def __init__(self, store_dir, panel_version, ld_window, min_r2, pops, calc):
+        self.path = os.path.join(
+            store_dir,
+            'panel={0}'.format(panel_version),
+            'ld_window={0}'.format(ld_window),
+            'min_r2={0}'.format(min_r2),
+            'pops={0}'.format('-'.join(sorted(pops))),
+            'calc={0}'.format(calc)
+        )
+        self.index_file = os.path.join(self.path, 'index.tsv')
+        os.makedirs(self.path, exist_ok=True)
+
+    def index(self):
+        ''' Reads the store index
+        Returns:
+            dict of variant ID -> shard file name, for shards that exist
+        '''
+        index = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r') as in_h:
+                for line in in_h:
+                    parts = line.rstrip('\n').split('\t')
+                    # Skip a partially written last line
+                    if len(parts) != 2 or not parts[1].endswith('.parquet'):
+                        continue
+                    index[parts[0]] = parts[1]
+
+        return {varid: shard for varid, shard in index.items()
+                if os.path.exists(os.path.join(self.path, shard))}
+
+    def export(self, varids, outdir):
+        ''' Copies the stored results for varids into outdir, as one new shard
+            per store shard
+        Args:
+            varids (iterable of str): variant IDs, all must be in the store
+            outdir (str): output directory
+        Returns:
+            dict of variant ID -> output shard path
+        '''
+        index = self.index()
+        by_shard = {}
+        for varid in varids:
+            by_shard.setdefault(index[varid], []).append(varid)
+
+        outputs = {}
+        for shard, shard_varids in by_shard.items():
+            table = pq.read_table(
+                os.path.join(self.path, shard),
+                filters=[('index_variant_id', 'in', shard_varids)]
+            )
+            outname = 'ld.chrom{0}.{1}.parquet'.format(
+                shard_varids[0].split(':')[0], uuid.uuid4().hex)
+            outf = os.path.join(outdir, outname)
+            outtemp = os.path.join(outdir, '.' + outname + '.tmp')
+            pq.write_table(table, outtemp, compression='snappy',
+                           row_group_size=table.num_rows or None)
+            os.replace(outtemp, outf)
+            for varid in shard_varids:
+                outputs[varid] = outf
+
+        return outputs
+
+    def publish(self, outputs):
+        ''' Adds newly calculated results to the store
+        Args:
+            outputs (dict): variant ID -> shard path, as recorded in the
+                calculator's journal
+        '''
+        lines = []
+        for varid, inf in outputs.items():
+            shard = os.path.basename(inf)
+            storef = os.path.join(self.path, shard)
+            if not os.path.exists(storef):
+                storetemp = os.path.join(self.path, '.' + shard + '.tmp')
+                shutil.copyfile(inf, storetemp)
+                os.replace(storetemp, storef)
+            lines.append('{0}\t{1}\n'.format(varid, shard))
+
+        with open(self.index_file, 'a') as out_h:
+            out_h.write(''.join(lines))
+            out_h.flush()
+            os.fsync(out_h.fileno())
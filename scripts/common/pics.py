@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Population weighted LD and PICS credible sets on pandas/numpy arrays.
+
+Probabilistic Identification of Causal SNPs (PICS) from Farh (2014):
+    https://www.nature.com/articles/nature13835
+
+Adjusts the p-values for tag SNPs based on the p-value of the lead SNP and
+its LD. These functions reproduce the Spark implementation in process_ld.py,
+so that the credible sets can be calculated without Spark.
+'''
+
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr
+
+# Empiric constant that can be adjusted to fit the curve, 6.4 recommended
+PICS_K = 6.4
+
+def weighted_r2(R, props):
+    ''' Weights correlations by population: Fisher transform R in each
+        population, take the proportion weighted mean, inverse transform and
+        round to 6 dp
+    Args:
+        R (np.array): n x populations correlations, NaN where missing
+        props (np.array): n x populations proportions
+    Returns:
+        np.array of R2, NaN where the proportions are missing
+    '''
+    # Missing R is 0. R == 1 would give an infinite Z, this is reverted by
+    # the rounding below.
+    R = np.nan_to_num(np.asarray(R, dtype=np.float64), nan=0.0)
+    R = np.where(R == 1, 0.9999995, R)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_overall = (np.asarray(props, dtype=np.float64) * np.arctanh(R)).sum(axis=1)
+    return np.round(np.tanh(z_overall), 6) ** 2
+
+def make_ancestry_key(props):
+    ''' Concatenates each row's population proportions, as text, into the key
+        that identifies a distinct ancestry. Missing proportions are empty
+        strings, as in the Spark key made by process_ld.py.
+    Args:
+        props (pd.DataFrame): proportion columns, as read from the manifest
+    Returns:
+        pd.Series of str
+    '''
+    props = props.fillna('')
+    return props.iloc[:, 0].str.cat(
+        [props[coln] for coln in props.columns[1:]], sep='|')
+
+def neglog_pval(mantissa, exponent):
+    ''' -log10 of a p-value stored as mantissa and exponent
+    '''
+    return -1 * (np.log10(mantissa) + exponent)
+
+def pics_relative_prob(r2, neglog_p, k=PICS_K):
+    ''' PICS mean and relative probability of each tag variant
+    Args:
+        r2 (np.array): R2 between lead and tag
+        neglog_p (np.array): -log10 p-value of the lead
+        k (float): PICS constant
+    Returns:
+        (pics_mu, pics_relative_prob) np.arrays
+    '''
+    mu = r2 * neglog_p
+    std = np.sqrt(1 - np.sqrt(r2) ** k) * np.sqrt(neglog_p) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prob = np.where(std == 0, 1.0, ndtr((mu - neglog_p) / std) * 2)
+    return mu, prob
+
+def calc_pics(data, group_cols, k=PICS_K):
+    ''' Calculates PICS posterior probabilities and 95/99% credible sets for
+        each locus
+    Args:
+        data (pd.DataFrame): group_cols, R2_overall and neglog_p columns
+        group_cols (list of str): columns identifying a locus
+        k (float): PICS constant
+    Returns:
+        pd.DataFrame with pics_mu, pics_postprob, pics_postprob_cumsum,
+        pics_95perc_credset and pics_99perc_credset added, sorted by locus
+        and descending posterior probability
+    '''
+    data = data.copy()
+    data['pics_mu'], prob = pics_relative_prob(
+        data['R2_overall'].values, data['neglog_p'].values, k)
+
+    # Normalise to the sum of relative probabilities at each locus
+    prob = pd.Series(prob, index=data.index)
+    data['pics_postprob'] = prob / prob.groupby(
+        [data[coln] for coln in group_cols], sort=False).transform('sum')
+
+    # Cumulative sum per locus, from the most probable tag
+    data = data.sort_values(group_cols + ['pics_postprob'],
+                            ascending=[True] * len(group_cols) + [False],
+                            kind='mergesort')
+    grouped = data.groupby(group_cols, sort=False)['pics_postprob']
+    data['pics_postprob_cumsum'] = grouped.cumsum()
+
+    # A tag is in the credible set unless the tags before it already reach it
+    prev_cumsum = data.groupby(group_cols, sort=False)[
+        'pics_postprob_cumsum'].shift(1)
+    data['pics_95perc_credset'] = ~(prev_cumsum >= 0.95)
+    data['pics_99perc_credset'] = ~(prev_cumsum >= 0.99)
+
+    return data
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Reads PLINK 1 binary filesets (.bed, .bim, .fam) without calling plink.
+
+The .bed is memory-mapped, so opening a fileset is cheap and only the variants
+that are actually requested get read from disk. Genotypes are decoded to A1
+allele counts (0, 1, 2) with missing calls as NaN, which is the coding plink
+uses when calculating --r. As in plink, heterozygous calls of males (sex code 1
+in the .fam) on chrX outside the PAR are treated as missing.
+
+Format spec: https://www.cog-genomics.org/plink/1.9/formats#bed
+'''
+
+import numpy as np
+import pandas as pd
+
+# First three bytes of a variant-major .bed file
+BED_MAGIC = bytes([0x6c, 0x1b, 0x01])
+
+# A1 allele count for each 2-bit genotype code (00, 01, 10, 11)
+GENOTYPE_CODES = np.array([2.0, np.nan, 1.0, 0.0])
+
+# bim chromosome codes of chrX outside the PAR, where males are haploid. plink
+# codes the PAR as XY (25).
+HAPLOID_X_CHROMS = {'X', '23'}
+
+# Lookup from a packed byte to the 4 genotypes it holds (low bits first)
+BYTE_TO_GENOTYPES = GENOTYPE_CODES[
+    (np.arange(256)[:, None] >> np.array([0, 2, 4, 6])) & 0b11
+]
+
+class PlinkBed(object):
+    ''' Memory-mapped PLINK 1 binary fileset
+    Args:
+        prefix (str): plink file prefix, without the .bed/.bim/.fam extension
+    '''
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.bim = load_bim(prefix + '.bim')
+        self.sex = load_fam_sex(prefix + '.fam')
+        self.n_samples = self.sex.shape[0]
+        self.n_variants = self.bim.shape[0]
+        self.bytes_per_variant = (self.n_samples + 3) // 4
+
+        # Check the header before mapping the genotype block
+        with open(prefix + '.bed', 'rb') as in_h:
+            magic = in_h.read(3)
+        if magic != BED_MAGIC:
+            raise ValueError(
+                '{0}.bed is not a variant-major plink bed file'.format(prefix))
+
+        self.packed = np.memmap(
+            prefix + '.bed',
+            dtype=np.uint8,
+            mode='r',
+            offset=len(BED_MAGIC),
+            shape=(self.n_variants, self.bytes_per_variant)
+        )
+        self.positions = self.bim['pos'].values
+        self.is_haploid_x = self.bim['chrom'].isin(HAPLOID_X_CHROMS).values
+        self.male_mask = pack_sample_mask(self.sex == 1, self.bytes_per_variant)
+        self.variant_ids = pd.Index(self.bim['variant_id'].values)
+
+        # Look up only IDs that occur once. plink fails a --ld-snp that is
+        # duplicated in the bim, so these are treated as not found.
+        is_unique = ~self.bim['variant_id'].duplicated(keep=False).values
+        self.unique_rows = np.flatnonzero(is_unique)
+        self.unique_ids = pd.Index(self.bim['variant_id'].values[is_unique])
+
+    def locate(self, varid):
+        ''' Returns the row index of a variant ID, or None if it is not in the
+            bim or is duplicated
+        '''
+        idx = self.unique_ids.get_indexer([varid])[0]
+        return None if idx < 0 else int(self.unique_rows[idx])
+
+    def window(self, idx, window_bp):
+        ''' Returns the [start, stop) row range of variants within window_bp
+            of the variant at row idx
+        '''
+        pos = self.positions[idx]
+        start = np.searchsorted(self.positions, pos - window_bp, side='left')
+        stop = np.searchsorted(self.positions, pos + window_bp, side='right')
+        return int(start), int(stop)
+
+    def read_packed(self, start, stop):
+        ''' Reads the 2-bit packed genotypes of variants in rows [start, stop),
+            with male heterozygous calls on chrX set to missing
+        Returns:
+            np.array of shape (stop - start, bytes_per_variant), dtype uint8
+        '''
+        packed = np.asarray(self.packed[start:stop])
+        rows = self.is_haploid_x[start:stop]
+        if rows.any() and self.male_mask.any():
+            packed = packed.copy()
+            packed[rows] = mask_het_calls(packed[rows], self.male_mask)
+        return packed
+
+    def read_dosages(self, start, stop):
+        ''' Decodes variants in rows [start, stop) to A1 allele counts
+        Returns:
+            np.array of shape (stop - start, n_samples), NaN where missing
+        '''
+        return decode_packed(self.read_packed(start, stop), self.n_samples)
+
+    def read_standardised(self, start, stop):
+        ''' Decodes and standardises variants in rows [start, stop)
+        Returns:
+            np.array of shape (stop - start, n_samples), or None if any
+            genotypes in the range are missing
+        '''
+        G = self.read_dosages(start, stop)
+        if np.isnan(G).any():
+            return None
+        return standardise(G)
+
+def standardise(G, mean=None, var=None):
+    ''' Centres and scales each variant (row) to mean 0 and variance 1, so that
+        correlations can be taken as a single matrix product
+    Args:
+        G (np.array): dosages of shape (m, n_samples) with no missing values
+        mean, var (np.array): precomputed per-variant mean and variance
+    Returns:
+        np.array of shape (m, n_samples), NaN rows for monomorphic variants
+    '''
+    if mean is None:
+        mean = G.mean(axis=1)
+        var = G.var(axis=1)
+    Z = G - mean[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Z /= np.sqrt(var)[:, None]
+    return Z
+
+def decode_packed(packed, n_samples):
+    ''' Decodes packed 2-bit genotypes to A1 allele counts
+    Args:
+        packed (np.array): uint8 array of shape (n_variants, bytes_per_variant)
+        n_samples (int): number of samples, used to drop the padding bits
+    Returns:
+        np.array of shape (n_variants, n_samples)
+    '''
+    dosages = BYTE_TO_GENOTYPES[packed].reshape(packed.shape[0], -1)
+    return dosages[:, :n_samples]
+
+def pack_sample_mask(is_sample, bytes_per_variant):
+    ''' Packs a boolean per-sample array into the 2-bit bed layout, setting the
+        low bit of each selected sample
+    Returns:
+        np.array of shape (bytes_per_variant,), dtype uint8
+    '''
+    bits = np.zeros(bytes_per_variant * 4, dtype=bool)
+    bits[:is_sample.shape[0]] = is_sample
+    return np.packbits(
+        np.stack([bits, np.zeros_like(bits)], axis=1).ravel(),
+        bitorder='little'
+    )
+
+def mask_het_calls(packed, sample_mask):
+    ''' Sets heterozygous calls (10) of the samples in sample_mask to missing
+        (01)
+    Args:
+        packed (np.array): uint8 array of shape (n_variants, bytes_per_variant)
+        sample_mask (np.array): output of pack_sample_mask
+    Returns:
+        np.array of the same shape as packed
+    '''
+    low = packed & 0x55
+    high = (packed >> 1) & 0x55
+    het = high & ~low & sample_mask
+    return packed ^ (het | (het << 1))
+
+def load_bim(inf):
+    ''' Loads a plink .bim file
+    '''
+    return pd.read_csv(
+        inf,
+        sep=r'\s+',
+        header=None,
+        names=['chrom', 'variant_id', 'cm', 'pos', 'a1', 'a2'],
+        dtype={'chrom': str, 'variant_id': str, 'pos': np.int64,
+               'a1': str, 'a2': str}
+    )
+
+def load_fam_sex(inf):
+    ''' Loads the sex code (1 male, 2 female, 0 unknown) of each sample in a
+        plink .fam file
+    Returns:
+        np.array of int, one per sample
+    '''
+    fam = pd.read_csv(inf, sep=r'\s+', header=None, usecols=[4], dtype=str)
+    return pd.to_numeric(fam[4], errors='coerce').fillna(0).astype(int).values
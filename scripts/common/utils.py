@@ -1,3 +1,5 @@
+import os
+import glob
 from pathlib import Path
 from psutil import virtual_memory
 
@@ -21,22 +23,66 @@ def detect_spark_memory_limit():
     return int(mem_gib * 0.9)
 
 
-def initialize_sparksession() -> SparkSession:
-    """Initialize spark session."""
+# Target size of a shuffle partition. Adaptive query execution coalesces
+# partitions that turn out to be smaller.
+SHUFFLE_PARTITION_BYTES = 128 * 2**20
 
+
+def get_spark_master(master=None) -> str:
+    """Spark master to use: the argument, else the SPARK_MASTER environment variable (e.g. spark://host:7077 for a
+    standalone cluster), else all cores of this machine."""
+    return master or os.environ.get('SPARK_MASTER') or 'local[*]'
+
+
+def estimate_shuffle_partitions(input_paths=None, partition_bytes=SHUFFLE_PARTITION_BYTES) -> int:
+    """Sets the number of shuffle partitions from the total size of the input files (or directories, or glob
+    patterns), with at least two per core."""
+    total_bytes = 0
+    for pattern in input_paths or []:
+        for path in glob.glob(str(pattern)):
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    total_bytes += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+            else:
+                total_bytes += os.path.getsize(path)
+    return max(2 * os.cpu_count(), -(-total_bytes // partition_bytes))
+
+
+def initialize_sparksession(input_paths=None, master=None) -> SparkSession:
+    """Initialize spark session, tuned to this machine and to the size of the input.
+
+    Driver memory is set from the physical memory (also used by the executors in local mode). The number of shuffle
+    partitions is set from the size of input_paths, and adaptive query execution coalesces small partitions and splits
+    skewed joins. Rows are serialised with Kryo, and passed to pandas with Arrow. The scripts directory is added to
+    the Python workers' path, so that UDFs can use the common modules."""
+
+    master = get_spark_master(master)
     spark_mem_limit = detect_spark_memory_limit()
     spark_conf = (
         SparkConf()
         .set('spark.driver.memory', f'{spark_mem_limit}g')
-        .set('spark.executor.memory', f'{spark_mem_limit}g')
         .set('spark.driver.maxResultSize', '0')
         .set('spark.debug.maxToStringFields', '2000')
+        .set('spark.sql.shuffle.partitions', str(estimate_shuffle_partitions(input_paths)))
+        .set('spark.sql.adaptive.enabled', 'true')
+        .set('spark.sql.adaptive.coalescePartitions.enabled', 'true')
+        .set('spark.sql.adaptive.skewJoin.enabled', 'true')
+        .set('spark.serializer', 'org.apache.spark.serializer.KryoSerializer')
+        .set('spark.kryoserializer.buffer.max', '512m')
+        .set('spark.sql.execution.arrow.pyspark.enabled', 'true')
         .set('spark.sql.execution.arrow.maxRecordsPerBatch', '500000')
+        .set('spark.executorEnv.PYTHONPATH', str(Path(__file__).resolve().parents[1]))
     )
+    # Executors of a standalone cluster are sized by its workers
+    if master.startswith('local'):
+        spark_conf = (
+            spark_conf
+            .set('spark.executor.memory', f'{spark_mem_limit}g')
+            .set('spark.driver.bindAddress', '127.0.0.1')
+        )
     spark = (
         SparkSession.builder.config(conf=spark_conf)
-        .master('local[*]')
-        .config("spark.driver.bindAddress", "127.0.0.1")
+        .master(master)
         .getOrCreate()
     )
 
@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Packs chrom_pos_ref_alt variant IDs into a single int64 key, so that joins,
+sorts and set operations run on fixed-width integers instead of strings.
+
+Key layout (bit 63 is unused, so keys are positive and sort by chrom, pos):
+
+    bits 58-62  chromosome code, 1-22, X=23, Y=24, MT=25
+    bits 29-57  position
+    bits 0-28   allele code
+
+The allele code of a SNV is 4 * ref + alt for bases A, C, G, T (0-15), and can
+be decoded from the key. Any other (ref, alt) pair is stored as a 28-bit
+CRC32 hash of "ref_alt" with bit 28 set. These can only be decoded with an
+allele table of the keys (key -> (ref, alt)), made by make_allele_table or
+filled in by the pandas encoder. Two different alleles at the same chrom:pos
+get the same key with a probability of ~4e-9; the pandas and Arrow encoders
+and make_allele_table raise a ValueError if they do, and the Spark encoder's
+keys can be checked with check_hash_collisions_spark.
+
+The module also builds and splits chrom_pos_ref_alt variant ID strings, for
+the tables that keep them.
+
+The scalar functions are pure Python. Vectorized versions for pandas, Arrow
+and Spark import those libraries when called, and give the same keys as the
+scalar functions.
+'''
+
+import zlib
+
+CHROMS = [str(chrom) for chrom in range(1, 23)] + ['X', 'Y', 'MT']
+CHROM_CODES = dict((chrom, code) for code, chrom in enumerate(CHROMS, 1))
+CHROM_CODES['M'] = CHROM_CODES['MT']
+
+BASES = 'ACGT'
+SNV_CODES = dict(('{0}_{1}'.format(ref, alt), 4 * i + j)
+                 for i, ref in enumerate(BASES)
+                 for j, alt in enumerate(BASES))
+
+CHROM_SHIFT = 58
+POS_SHIFT = 29
+POS_MASK = (1 << 29) - 1
+ALLELE_MASK = (1 << 29) - 1
+HASH_FLAG = 1 << 28
+HASH_MASK = (1 << 28) - 1
+
+#
+# Scalar -----------------------------------------------------------------------
+#
+
+def allele_code(ref, alt):
+    ''' Gets the allele code of a (ref, alt) pair
+    '''
+    alleles = '{0}_{1}'.format(ref, alt)
+    try:
+        return SNV_CODES[alleles]
+    except KeyError:
+        return HASH_FLAG | (zlib.crc32(alleles.encode()) & HASH_MASK)
+
+def encode_variant(chrom, pos, ref, alt):
+    ''' Packs a variant into an int64 key
+    Args:
+        chrom (str): chromosome, 1-22, X, Y or MT
+        pos (int or str): position
+        ref, alt (str): alleles
+    Returns:
+        int
+    Raises:
+        ValueError if the chromosome, position or alleles can not be encoded
+    '''
+    try:
+        chrom_code = CHROM_CODES[str(chrom)]
+    except KeyError:
+        raise ValueError('Unknown chromosome: {0}'.format(chrom))
+    pos = int(pos)
+    if not 0 <= pos <= POS_MASK:
+        raise ValueError('Position out of range: {0}'.format(pos))
+    if ref is None or alt is None:
+        raise ValueError('Missing alleles at {0}:{1}'.format(chrom, pos))
+    return ((chrom_code << CHROM_SHIFT) |
+            (pos << POS_SHIFT) |
+            allele_code(ref, alt))
+
+def encode_varid(varid, sep='_'):
+    ''' Packs a chrom_pos_ref_alt variant ID into an int64 key
+    '''
+    chrom, pos, ref, alt = varid.split(sep, 3)
+    return encode_variant(chrom, pos, ref, alt)
+
+def check_hash_collisions(keys, alleles, seen=None):
+    ''' Checks that different alleles at the same chrom:pos have different
+        keys
+    Args:
+        keys (iterable of int): keys of variants with hashed alleles
+        alleles (iterable of str): "ref_alt" of each key
+        seen (dict): key -> "ref_alt" of keys checked by earlier calls,
+                     updated in place
+    Raises:
+        ValueError if two different alleles have the same key
+    '''
+    if seen is None:
+        seen = {}
+    for key, x in zip(keys, alleles):
+        if seen.setdefault(key, x) != x:
+            chrom, pos = key_chrom_pos(key)
+            raise ValueError(
+                'Alleles {0} and {1} at {2}:{3} have the same key {4}'.format(
+                    seen[key], x, chrom, pos, key))
+
+def key_chrom_pos(key):
+    ''' Gets (chrom, pos) from a key
+    '''
+    return CHROMS[(key >> CHROM_SHIFT) - 1], (key >> POS_SHIFT) & POS_MASK
+
+def decode_key(key, alleles=None):
+    ''' Unpacks a key
+    Args:
+        key (int): variant key
+        alleles (dict): key -> (ref, alt), output of make_allele_table,
+                        needed to decode alleles other than SNVs
+    Returns:
+        (chrom, pos, ref, alt), ref and alt are None if they can not be decoded
+    '''
+    chrom, pos = key_chrom_pos(key)
+    code = key & ALLELE_MASK
+    if not code & HASH_FLAG:
+        ref, alt = BASES[code // 4], BASES[code % 4]
+    else:
+        ref, alt = (alleles or {}).get(key, (None, None))
+    return chrom, pos, ref, alt
+
+def decode_varid(key, alleles=None, sep='_'):
+    ''' Unpacks a key to a chrom_pos_ref_alt variant ID
+    Raises:
+        KeyError if the alleles can not be decoded
+    '''
+    chrom, pos, ref, alt = decode_key(key, alleles)
+    if ref is None:
+        raise KeyError('Alleles of {0} are not in the allele table'.format(key))
+    return sep.join([chrom, str(pos), ref, alt])
+
+def make_allele_table(variants):
+    ''' Makes the table used to decode the keys of variants that are not SNVs
+    Args:
+        variants (iterable of (chrom, pos, ref, alt))
+    Returns:
+        dict of key -> (ref, alt)
+    Raises:
+        ValueError if two different alleles at a chrom:pos have the same key
+    '''
+    table = {}
+    seen = {}
+    for chrom, pos, ref, alt in variants:
+        key = encode_variant(chrom, pos, ref, alt)
+        if key & HASH_FLAG:
+            check_hash_collisions([key], ['{0}_{1}'.format(ref, alt)], seen)
+            table[key] = (ref, alt)
+    return table
+
+#
+# pandas -----------------------------------------------------------------------
+#
+
+def make_varids_pd(chrom, pos, ref, alt, sep='_'):
+    ''' Joins variant columns into chrom_pos_ref_alt variant IDs
+    Args:
+        chrom, pos, ref, alt (pd.Series): variant columns, with the same
+                                          length and order
+    Returns:
+        pd.Series of str with the index of chrom
+    '''
+    return chrom.astype(str).str.cat(
+        [pos.astype(str).values, ref.astype(str).values,
+         alt.astype(str).values], sep=sep)
+
+def split_varids_pd(varids, sep='_'):
+    ''' Splits chrom_pos_ref_alt variant IDs into their columns
+    Args:
+        varids (pd.Series): variant IDs
+    Returns:
+        pd.DataFrame of chrom, pos (int64), ref, alt with the index of varids
+    '''
+    parts = varids.str.split(sep, n=3, expand=True)
+    if parts.shape[1] < 4:
+        parts = parts.reindex(columns=range(4))
+    parts.columns = ['chrom', 'pos', 'ref', 'alt']
+    parts['pos'] = parts['pos'].astype('int64')
+    return parts
+
+def encode_variants_pd(chrom, pos, ref, alt, seen=None, alleles=None):
+    ''' Packs variants into int64 keys
+    Args:
+        chrom, pos, ref, alt (pd.Series): variant columns
+        seen (dict): hashed keys of earlier calls, to check for collisions
+                     across calls (see check_hash_collisions)
+        alleles (dict): allele table, key -> (ref, alt), that the hashed
+                        keys are added to, for decode_keys_pd
+    Returns:
+        pd.Series of int64 keys with the index of chrom
+    Raises:
+        ValueError if a chromosome, position or alleles can not be encoded, or
+        if two different alleles at a chrom:pos have the same key
+    '''
+    import numpy as np
+    import pandas as pd
+
+    chrom_code = chrom.astype(str).map(CHROM_CODES)
+    if chrom_code.isnull().any():
+        raise ValueError('Unknown chromosome: {0}'.format(
+            chrom[chrom_code.isnull()].iloc[0]))
+    pos = pd.Series(np.asarray(pos), index=chrom.index).astype(np.int64)
+    if ((pos < 0) | (pos > POS_MASK)).any():
+        raise ValueError('Position out of range: {0}'.format(
+            pos[(pos < 0) | (pos > POS_MASK)].iloc[0]))
+
+    missing = (ref.isnull() | alt.isnull()).values
+    if missing.any():
+        raise ValueError('Missing alleles at {0}:{1}'.format(
+            chrom[missing].iloc[0], pos[missing].iloc[0]))
+
+    # SNVs are looked up, other alleles are hashed
+    alleles_joined = ref.astype(str).str.cat(alt.astype(str).values, sep='_')
+    snv_codes = alleles_joined.map(SNV_CODES)
+    is_hashed = snv_codes.isnull().values
+    codes = snv_codes.fillna(0).values.astype(np.int64)
+    if is_hashed.any():
+        codes[is_hashed] = [HASH_FLAG | (zlib.crc32(x.encode()) & HASH_MASK)
+                            for x in alleles_joined[is_hashed]]
+
+    key = ((chrom_code.values.astype(np.int64) << CHROM_SHIFT) |
+           (pos.values << POS_SHIFT) |
+           codes)
+    if is_hashed.any():
+        check_hash_collisions(key[is_hashed].tolist(),
+                              alleles_joined[is_hashed].tolist(), seen)
+        if alleles is not None:
+            alleles.update(zip(key[is_hashed].tolist(),
+                               zip(ref[is_hashed].astype(str).tolist(),
+                                   alt[is_hashed].astype(str).tolist())))
+    return pd.Series(key, index=chrom.index)
+
+def encode_varids_pd(varids, sep='_', seen=None, alleles=None):
+    ''' Packs a pd.Series of chrom_pos_ref_alt variant IDs into int64 keys
+        (see encode_variants_pd). Each distinct ID is split and encoded once.
+    '''
+    import pandas as pd
+
+    codes, distinct = pd.factorize(varids)
+    if (codes < 0).any():
+        raise ValueError('Missing variant ID')
+    parts = split_varids_pd(pd.Series(distinct), sep)
+    keys = encode_variants_pd(parts['chrom'], parts['pos'], parts['ref'],
+                              parts['alt'], seen, alleles)
+    return pd.Series(keys.values[codes], index=varids.index)
+
+def decode_keys_pd(keys, alleles=None):
+    ''' Unpacks int64 keys
+    Args:
+        keys (pd.Series): variant keys
+        alleles (dict): key -> (ref, alt), output of make_allele_table
+    Returns:
+        pd.DataFrame of chrom, pos, ref, alt with the index of keys. ref and
+        alt are None where they can not be decoded.
+    '''
+    import numpy as np
+    import pandas as pd
+
+    values = keys.values.astype(np.int64)
+    codes = values & ALLELE_MASK
+    is_hashed = (codes & HASH_FLAG) != 0
+    snv_codes = np.where(is_hashed, 0, codes)
+
+    df = pd.DataFrame({
+        'chrom': np.array(CHROMS, dtype=object)[(values >> CHROM_SHIFT) - 1],
+        'pos': (values >> POS_SHIFT) & POS_MASK,
+        'ref': np.array(list(BASES), dtype=object)[snv_codes // 4],
+        'alt': np.array(list(BASES), dtype=object)[snv_codes % 4]
+    }, index=keys.index)
+
+    # Look up the other alleles
+    if is_hashed.any():
+        hashed = [(alleles or {}).get(key, (None, None))
+                  for key in values[is_hashed].tolist()]
+        df.loc[is_hashed, 'ref'] = [x[0] for x in hashed]
+        df.loc[is_hashed, 'alt'] = [x[1] for x in hashed]
+
+    return df
+
+#
+# Arrow ------------------------------------------------------------------------
+#
+
+def encode_variants_pa(chrom, pos, ref, alt, seen=None):
+    ''' Packs variants into int64 keys
+    Args:
+        chrom, pos, ref, alt (pa.Array or pa.ChunkedArray): variant columns
+        seen (dict): hashed keys of earlier calls, to check for collisions
+                     across calls (see check_hash_collisions)
+    Returns:
+        pa.Array of int64 keys
+    Raises:
+        ValueError if a chromosome, position or alleles can not be encoded, or
+        if two different alleles at a chrom:pos have the same key
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    chrom_code = pc.index_in(pc.cast(chrom, pa.string()),
+                             value_set=pa.array(CHROMS + ['M']))
+    if chrom_code.null_count > 0:
+        raise ValueError('Unknown chromosome: {0}'.format(
+            pc.filter(chrom, pc.is_null(chrom_code))[0]))
+    # Codes are 1-based, and M is MT
+    chrom_code = pc.add(pc.min_element_wise(chrom_code, len(CHROMS) - 1), 1)
+    pos = pc.cast(pos, pa.int64())
+    out_of_range = pc.or_(pc.less(pos, 0), pc.greater(pos, POS_MASK))
+    if pc.any(out_of_range).as_py():
+        raise ValueError('Position out of range: {0}'.format(
+            pc.filter(pos, out_of_range)[0]))
+
+    # SNVs are looked up, other alleles are hashed
+    alleles = pc.binary_join_element_wise(pc.cast(ref, pa.string()),
+                                          pc.cast(alt, pa.string()), '_')
+    if alleles.null_count > 0:
+        missing = pc.is_null(alleles)
+        raise ValueError('Missing alleles at {0}:{1}'.format(
+            pc.filter(chrom, missing)[0], pc.filter(pos, missing)[0]))
+    if isinstance(alleles, pa.ChunkedArray):
+        alleles = alleles.combine_chunks()
+    snv_alleles = list(SNV_CODES)
+    codes = pc.index_in(alleles, value_set=pa.array(snv_alleles))
+    codes = pc.take(pa.array([SNV_CODES[x] for x in snv_alleles],
+                             type=pa.int64()), codes)
+    is_hashed = pc.is_null(codes)
+    if codes.null_count > 0:
+        # Hash each distinct non-SNV allele once, and scatter the codes back
+        # to their rows
+        hashed_alleles = pc.filter(alleles, is_hashed)
+        distinct = pc.unique(hashed_alleles)
+        distinct_codes = pa.array(
+            [HASH_FLAG | (zlib.crc32(x.encode()) & HASH_MASK)
+             for x in distinct.to_pylist()], type=pa.int64())
+        codes = pc.replace_with_mask(
+            codes, is_hashed,
+            pc.take(distinct_codes, pc.index_in(hashed_alleles,
+                                                value_set=distinct)))
+
+    key = pc.bit_wise_or(
+        pc.shift_left(pc.cast(chrom_code, pa.int64()), CHROM_SHIFT),
+        pc.bit_wise_or(pc.shift_left(pos, POS_SHIFT), codes))
+    if isinstance(key, pa.ChunkedArray):
+        key = key.combine_chunks()
+    if pc.any(is_hashed).as_py():
+        check_hash_collisions(pc.filter(key, is_hashed).to_pylist(),
+                              pc.filter(alleles, is_hashed).to_pylist(), seen)
+    return key
+
+def decode_keys_pa(keys, alleles=None):
+    ''' Unpacks int64 keys
+    Args:
+        keys (pa.Array): variant keys
+        alleles (dict): key -> (ref, alt), output of make_allele_table
+    Returns:
+        pa.Table of chrom, pos, ref, alt. ref and alt are null where they can
+        not be decoded.
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    keys = pc.cast(keys, pa.int64())
+    codes = pc.bit_wise_and(keys, ALLELE_MASK)
+    chrom = pc.take(pa.array(CHROMS),
+                    pc.subtract(pc.shift_right(keys, CHROM_SHIFT), 1))
+    pos = pc.bit_wise_and(pc.shift_right(keys, POS_SHIFT), POS_MASK)
+
+    # SNV codes index the first 16 entries, keys of other alleles the rest
+    table = sorted((alleles or {}).items())
+    refs = pa.array([BASES[i // 4] for i in range(16)] + [x[1][0] for x in table],
+                    type=pa.string())
+    alts = pa.array([BASES[i % 4] for i in range(16)] + [x[1][1] for x in table],
+                    type=pa.string())
+    index = pc.coalesce(
+        pc.index_in(codes, value_set=pa.array(range(16), type=pa.int64())),
+        pc.add(pc.index_in(keys, value_set=pa.array(
+            [x[0] for x in table], type=pa.int64())), 16))
+
+    return pa.table({
+        'chrom': chrom,
+        'pos': pos,
+        'ref': pc.take(refs, index),
+        'alt': pc.take(alts, index)
+    })
+
+#
+# Spark ------------------------------------------------------------------------
+#
+
+def encode_variants_spark(chrom, pos, ref, alt):
+    ''' Packs variants into int64 keys. Keys of unknown chromosomes or
+        missing alleles are null.
+        Hash collisions are not checked, as a column expression can not see
+        other rows: check the distinct (key, ref, alt) with
+        check_hash_collisions before relying on the keys of non-SNVs.
+    Args:
+        chrom, pos, ref, alt (Column or str): variant columns
+    Returns:
+        Column of long keys
+    '''
+    from itertools import chain
+    from pyspark.sql import functions as F
+
+    chrom_codes = F.create_map(*[F.lit(x) for x in chain(*CHROM_CODES.items())])
+    snv_codes = F.create_map(*[F.lit(x) for x in chain(*SNV_CODES.items())])
+
+    # SNVs are looked up, other alleles are hashed
+    alleles = F.concat(F.col(ref) if isinstance(ref, str) else ref, F.lit('_'),
+                       F.col(alt) if isinstance(alt, str) else alt)
+    codes = F.coalesce(
+        snv_codes[alleles].cast('long'),
+        F.crc32(alleles.cast('binary')).bitwiseAND(HASH_MASK).bitwiseOR(HASH_FLAG)
+    )
+
+    chrom = F.col(chrom) if isinstance(chrom, str) else chrom
+    pos = F.col(pos) if isinstance(pos, str) else pos
+    return (
+        F.shiftleft(chrom_codes[chrom.cast('string')].cast('long'), CHROM_SHIFT)
+        .bitwiseOR(F.shiftleft(pos.cast('long'), POS_SHIFT))
+        .bitwiseOR(codes)
+    )
+
+def encode_varids_spark(varid, sep='_'):
+    ''' Packs a column of chrom_pos_ref_alt variant IDs into int64 keys
+    '''
+    from pyspark.sql import functions as F
+
+    parts = F.split(F.col(varid) if isinstance(varid, str) else varid, sep)
+    return encode_variants_spark(parts.getItem(0), parts.getItem(1),
+                                 parts.getItem(2), parts.getItem(3))
+
+def decode_keys_spark(key):
+    ''' Unpacks int64 keys. Alleles other than SNVs can not be decoded and are
+        null; join to a table of the original alleles to recover them.
+    Args:
+        key (Column or str): variant keys
+    Returns:
+        (chrom, pos, ref, alt) Columns
+    '''
+    from pyspark.sql import functions as F
+
+    key = F.col(key) if isinstance(key, str) else key
+    chroms = F.array(*[F.lit(x) for x in CHROMS])
+    bases = F.array(*[F.lit(x) for x in BASES])
+    codes = key.bitwiseAND(ALLELE_MASK)
+    is_snv = codes < 16
+
+    return (
+        F.element_at(chroms, F.shiftright(key, CHROM_SHIFT).cast('int')),
+        F.shiftright(key, POS_SHIFT).bitwiseAND(POS_MASK),
+        F.when(is_snv, F.element_at(bases, (F.floor(codes / 4) + 1).cast('int'))),
+        F.when(is_snv, F.element_at(bases, (codes % 4 + 1).cast('int')))
+    )
+
+def check_hash_collisions_spark(df, key, ref, alt, seen=None):
+    ''' Checks the keys made by encode_variants_spark for hash collisions,
+        collecting the distinct hashed (key, ref, alt) of df
+    Args:
+        df (spark.df): table with key, ref and alt columns
+        key, ref, alt (str): column names
+        seen (dict): hashed keys of earlier checks (see check_hash_collisions)
+    Raises:
+        ValueError if two different alleles at a chrom:pos have the same key
+    '''
+    from pyspark.sql import functions as F
+
+    rows = (
+        df
+        .filter(F.col(key).bitwiseAND(HASH_FLAG) != 0)
+        .select(key, F.concat(F.col(ref), F.lit('_'), F.col(alt)).alias('alleles'))
+        .distinct()
+        .collect()
+    )
+    check_hash_collisions([row[0] for row in rows], [row[1] for row in rows],
+                          seen)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Expands the nested LD table written by process_ld.py --out_format nested
+# (loci and tag sets) back to the flat LD table schema
+#
+
+import os
+import argparse
+
+from pyspark.sql.functions import col, explode
+
+from common.utils import initialize_sparksession
+from process_ld import write_ld_table, LOCUS_COLS, NESTED_TAG_COLS
+
+def main():
+
+    # Args
+    args = parse_args()
+
+    # Make spark session
+    global spark
+    spark = initialize_sparksession(input_paths=[args.in_nested])
+
+    # Expand and save
+    ld = expand_ld_table(args.in_nested)
+    write_ld_table(ld, args.out, args.out_layout,
+                   range_cols=['study_id', 'lead_chrom', 'lead_pos'])
+
+    return 0
+
+def expand_ld_table(in_nested):
+    ''' Joins each (study, lead) locus to its tag set and explodes the tags.
+        The result is also registered as the temporary view "ld".
+    Args:
+        in_nested (str): directory with loci and tagsets tables
+    Returns:
+        spark.df with the flat LD table schema
+    '''
+    # Keep lead_chrom as a string if the tables are partitioned by it
+    spark.conf.set('spark.sql.sources.partitionColumnTypeInference.enabled',
+                   'false')
+
+    loci = (
+        spark.read.parquet(os.path.join(in_nested, 'loci'))
+        .filter(col('ld_available'))
+    )
+    tagsets = spark.read.parquet(os.path.join(in_nested, 'tagsets'))
+
+    ld = (
+        loci
+        .join(tagsets,
+              on=['tagset_id', 'lead_chrom', 'lead_pos', 'lead_ref', 'lead_alt'])
+        .withColumn('tag', explode('tags'))
+        .select(*LOCUS_COLS,
+                *[col('tag.' + coln).alias(coln) for coln in NESTED_TAG_COLS],
+                'AFR_1000G_prop',
+                'AMR_1000G_prop',
+                'EAS_1000G_prop',
+                'EUR_1000G_prop',
+                'SAS_1000G_prop')
+    )
+    ld.createOrReplaceTempView('ld')
+
+    return ld
+
+def parse_args():
+    """ Load command line args """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--in_nested', metavar="<str>", help=("Nested LD table, output of process_ld.py --out_format nested"), type=str, required=True)
+    parser.add_argument('--out', metavar="<str>", help=("Output flat LD table"), type=str, required=True)
+    parser.add_argument('--out_layout', metavar="<str>", help=("Range partition the output by study, or partition it by lead_chrom with rows sorted by lead_pos (default: study)"), type=str, choices=['study', 'chrom'], default='study')
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+
+    main()
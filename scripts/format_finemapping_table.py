@@ -15,7 +15,11 @@ def main():
 
     # Args
     args = parse_args()
-    
+
+    # Make spark session
+    global spark
+    spark = initialize_sparksession(input_paths=[args.inf])
+
     # Load data
     credset = (
         spark.read.json(args.inf)
@@ -63,7 +67,4 @@ def parse_args():
 
 if __name__ == '__main__':
 
-    global spark
-    spark = initialize_sparksession()
-
     main()
@@ -3,29 +3,83 @@
 #
 # Ed Mountjoy
 #
+# The study weighted LD table is streamed in chunks and staged in partitions
+# of at most --max_loci (study, lead) loci, in output order: by study for the
+# single file layout, or by lead position for the chrom layout. Each partition
+# is then formatted on its own and appended to the output, so that only one
+# partition is held in memory at a time. Variants are staged and deduplicated
+# as int64 keys (see common.variant_key), and decoded back to their columns
+# when formatted.
+#
 
 import sys
 import os
+import shutil
 import argparse
+import tempfile
+import numpy as np
 import pandas as pd
-from pprint import pprint
+import pyarrow as pa
+import pyarrow.parquet as pq
 from collections import OrderedDict
-from parquet_writer import write_parquet
+from common.variant_key import encode_varids_pd, decode_keys_pd
+from parquet_writer import (write_parquet_by_chrom, pd_dtype_to_pa_schema,
+                            pd_dtype_int_to_float,
+                            LOOKUP_ROW_GROUP_SIZE, LOOKUP_WRITE_OPTIONS)
 
-def main():
+# Rows read from the input at a time
+CHUNK_ROWS = 1000000
 
-    # Parse args
-    args = parse_args()
+# Input columns and types
+IN_DTYPES = OrderedDict([
+    ('study_id', 'object'),
+    ('index_variant_id', 'object'),
+    ('tag_variant_id', 'object'),
+    ('R2_overall', 'float64'),
+    ('AFR_prop', 'float64'),
+    ('AMR_prop', 'float64'),
+    ('EAS_prop', 'float64'),
+    ('EUR_prop', 'float64'),
+    ('SAS_prop', 'float64')
+])
 
-    # Load
-    ld = pd.read_csv(args.inf, sep='\t', header=0, low_memory=False)
+# Staged columns and types
+STAGED_DTYPES = OrderedDict([
+    ('study_id', 'object'),
+    ('index_key', 'int64'),
+    ('tag_key', 'int64'),
+    ('R2_overall', 'float64'),
+    ('AFR_prop', 'float64'),
+    ('AMR_prop', 'float64'),
+    ('EAS_prop', 'float64'),
+    ('EUR_prop', 'float64'),
+    ('SAS_prop', 'float64')
+])
 
-    # Create table which tells us if LD is available for a given (study, lead)
-    ld_available = ld.loc[:, ['study_id', 'index_variant_id']].drop_duplicates()
-    ld_available['ld_available'] = True
+# Output columns and types
+OUT_DTYPES = OrderedDict([
+    ('study_id', 'object'),
+    ('lead_chrom', 'object'),
+    ('lead_pos', 'int64'),
+    ('lead_ref', 'object'),
+    ('lead_alt', 'object'),
+    ('tag_chrom', 'object'),
+    ('tag_pos', 'int64'),
+    ('tag_ref', 'object'),
+    ('tag_alt', 'object'),
+    ('overall_r2', 'float64'),
+    ('AFR_1000G_prop', 'float64'),
+    ('AMR_1000G_prop', 'float64'),
+    ('EAS_1000G_prop', 'float64'),
+    ('EUR_1000G_prop', 'float64'),
+    ('SAS_1000G_prop', 'float64'),
+    ('ld_available', 'bool')
+])
+
+def main():
 
-    # Filter
-    ld = ld.loc[ld.R2_overall >= args.min_r2, :]
+    # Parse args
+    args = parse_args()
 
     # For each lead variant, add a tag variant with R-squared == 1.0
     # Need to do this using the manifest, as leads without LD have already been
@@ -34,29 +88,233 @@ def main():
     manifest['index_variant_id'] = manifest['variant_id']
     manifest['tag_variant_id'] = manifest['variant_id']
     manifest['R2_overall'] = 1.0
-    manifest = manifest.drop(['chrom', 'pos', 'ref', 'alt', 'variant_id'], axis=1)
-    ld = pd.concat([ld, manifest], sort=False)
+    manifest = manifest.loc[:, list(IN_DTYPES.keys())].astype(dtype=IN_DTYPES)
+
+    # Key the variants. The allele table collects the alleles of keys that
+    # are hashed, to decode them, and is also used to check for collisions.
+    alleles = {}
+    seen = {}
+    encode = lambda varids: encode_varids_pd(varids, seen=seen, alleles=alleles)
+    manifest['index_key'] = encode(manifest['index_variant_id'])
+    manifest['tag_key'] = manifest['index_key']
+
+    # Partition into ranges of loci, in the order they are written
+    locus_bounds = make_locus_bounds(manifest, args.layout, args.max_loci)
+    get_partitions = lambda df: partition_keys(df, args.layout, locus_bounds)
+
+    # Stage the filtered LD in partitions, and record which (study, lead)
+    # have LD available. The output is written to a temp file, or directory
+    # for the chrom layout, next to outf and renamed over it once complete,
+    # so a failed run does not leave a partial table and parts of an earlier
+    # run (with a larger --max_loci) do not remain.
+    outdir = os.path.dirname(os.path.abspath(args.outf))
+    staging_dir = tempfile.mkdtemp(prefix='.format_ld_table.', dir=outdir)
+    if args.layout == 'chrom':
+        outtemp = tempfile.mkdtemp(prefix='.format_ld_table.out.', dir=outdir)
+    else:
+        outtemp = os.path.join(outdir, '.' + os.path.basename(args.outf) + '.tmp')
+    try:
+        ld_available = stage_ld(args.inf, staging_dir, args.min_r2,
+                                get_partitions, encode)
+        write_ld_table(outtemp, args.layout, staging_dir, manifest,
+                       get_partitions, ld_available, alleles)
+    except BaseException:
+        if os.path.isdir(outtemp):
+            shutil.rmtree(outtemp)
+        elif os.path.exists(outtemp):
+            os.remove(outtemp)
+        raise
+    finally:
+        shutil.rmtree(staging_dir)
+    if os.path.isdir(args.outf):
+        shutil.rmtree(args.outf)
+    elif args.layout == 'chrom' and os.path.exists(args.outf):
+        os.remove(args.outf)
+    os.replace(outtemp, args.outf)
+
+    return 0
+
+def write_ld_table(outf, layout, staging_dir, manifest, get_partitions,
+                   ld_available, alleles):
+    ''' Formats the staged LD one partition at a time, and writes it to outf
+        in the layout
+    '''
+    schema = pd_dtype_to_pa_schema(OUT_DTYPES)
+    writer = None
+    if layout == 'single':
+        writer = pq.ParquetWriter(outf, schema, compression='snappy',
+                                  flavor='spark', **LOOKUP_WRITE_OPTIONS)
+
+    try:
+        manifest_partitions = get_partitions(manifest)
+        for part, key in enumerate(
+                sorted(set(os.listdir(staging_dir)) | set(manifest_partitions))):
+            ld = format_partition(
+                staged=os.path.join(staging_dir, key),
+                manifest=manifest.loc[manifest_partitions == key,
+                                      list(STAGED_DTYPES)],
+                ld_available=ld_available,
+                alleles=alleles
+            )
+            if ld.shape[0] == 0:
+                continue
+
+            # Append to the single file sorted by study, or write a file per
+            # chromosome in the partition, sorted by lead position
+            if layout == 'chrom':
+                write_parquet_by_chrom(
+                    ld,
+                    outf,
+                    chrom_col='lead_chrom',
+                    part=part,
+                    sort_cols=['lead_pos', 'lead_ref', 'lead_alt', 'study_id',
+                               'tag_chrom', 'tag_pos', 'tag_ref', 'tag_alt'],
+                    compression='snappy',
+                    flavor='spark',
+                    row_group_size=LOOKUP_ROW_GROUP_SIZE,
+                    **LOOKUP_WRITE_OPTIONS
+                )
+            else:
+                ld = ld.sort_values(
+                    ['study_id', 'lead_chrom', 'lead_pos', 'lead_ref',
+                     'lead_alt', 'tag_chrom', 'tag_pos', 'tag_ref', 'tag_alt']
+                )
+                writer.write_table(
+                    pa.Table.from_pandas(
+                        ld.astype(dtype=pd_dtype_int_to_float(OUT_DTYPES)),
+                        schema=schema,
+                        preserve_index=False
+                    ),
+                    row_group_size=LOOKUP_ROW_GROUP_SIZE
+                )
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return 0
+
+def make_locus_sort_keys(loci, layout):
+    ''' Makes a key for each (study_id, index_variant_id) that sorts in the
+        output order of the layout: by study then lead variant for the single
+        file, or by lead variant then study for the chrom layout. Fields are
+        joined with tabs, which sort before the characters of IDs and alleles,
+        and lead positions are zero padded so that they sort as numbers.
+    Returns:
+        np.array of str
+    '''
+    if loci.shape[0] == 0:
+        return np.array([], dtype=str)
+    lead = loci['index_variant_id'].str.split('_', n=3, expand=True)
+    lead_cols = [lead[0], lead[1].str.zfill(10), lead[2], lead[3]]
+    if layout == 'chrom':
+        cols = lead_cols + [loci['study_id']]
+    else:
+        cols = [loci['study_id']] + lead_cols
+    return cols[0].str.cat(cols[1:], sep='\t').values.astype(str)
+
+def make_locus_bounds(manifest, layout, max_loci):
+    ''' Splits the manifest's (study, lead) loci, in output order, into
+        ranges of at most max_loci
+    Returns:
+        np.array of the sort key of the first locus of each range after the
+        first
+    '''
+    loci = manifest.loc[:, ['study_id', 'index_variant_id']].drop_duplicates()
+    keys = np.sort(make_locus_sort_keys(loci, layout))
+    return keys[max_loci::max_loci]
+
+def partition_keys(df, layout, locus_bounds):
+    ''' Gets the partition of each row, from its (study, lead) locus. All rows
+        of a locus are in the same partition.
+    Returns:
+        pd.Series of partition names, which sort in output order
+    '''
+    loci = df.loc[:, ['study_id', 'index_variant_id']].drop_duplicates()
+    ranges = np.searchsorted(locus_bounds, make_locus_sort_keys(loci, layout),
+                             side='right')
+    loci['partition'] = ['{0:05d}'.format(x) for x in ranges]
+    partitions = pd.merge(df.loc[:, ['study_id', 'index_variant_id']], loci,
+                          on=['study_id', 'index_variant_id'], how='left')
+    return pd.Series(partitions['partition'].values, index=df.index,
+                     dtype='object')
+
+def stage_ld(inf, staging_dir, min_r2, get_partitions, encode):
+    ''' Reads the LD in chunks, filters on min_r2, and appends each chunk's
+        rows, with variants as keys, to a parquet file per partition in
+        staging_dir
+    Args:
+        encode (function): encodes a pd.Series of variant IDs to keys
+    Returns:
+        pd.DataFrame of (study_id, index_key) with LD available
+    '''
+    schema = pd_dtype_to_pa_schema(STAGED_DTYPES)
+    writers = {}
+    ld_available = []
+    for chunk in pd.read_csv(inf, sep='\t', header=0, usecols=list(IN_DTYPES),
+                             dtype=IN_DTYPES, chunksize=CHUNK_ROWS):
+
+        # Create table which tells us if LD is available for a given
+        # (study, lead)
+        chunk['index_key'] = encode(chunk['index_variant_id'])
+        ld_available.append(
+            chunk.loc[:, ['study_id', 'index_key']].drop_duplicates())
+
+        # Filter
+        chunk = chunk.loc[chunk.R2_overall >= min_r2, :]
+        chunk = chunk.assign(tag_key=encode(chunk['tag_variant_id']))
+
+        for key, part in chunk.loc[:, list(STAGED_DTYPES)].groupby(
+                get_partitions(chunk)):
+            if key not in writers:
+                writers[key] = pq.ParquetWriter(
+                    os.path.join(staging_dir, key), schema)
+            writers[key].write_table(
+                pa.Table.from_pandas(part, schema=schema, preserve_index=False))
+
+    for writer in writers.values():
+        writer.close()
+
+    ld_available = (
+        pd.concat(ld_available, ignore_index=True)
+        .drop_duplicates()
+    ) if ld_available else pd.DataFrame(columns=['study_id', 'index_key'])
+    ld_available['ld_available'] = True
+
+    return ld_available
+
+def format_partition(staged, manifest, ld_available, alleles):
+    ''' Formats the LD table for one partition
+    Args:
+        staged (file): staged LD rows of the partition, may not exist
+        manifest (pd.DataFrame): manifest rows of the partition, as staged
+        ld_available (pd.DataFrame): (study, lead) with LD available
+        alleles (dict): allele table of the hashed keys
+    Returns:
+        pd.DataFrame with the columns of OUT_DTYPES
+    '''
+    parts = [manifest]
+    if os.path.exists(staged):
+        parts.append(pq.read_table(staged).to_pandas())
+    ld = pd.concat(parts, ignore_index=True, sort=False)
 
     # Sort by overall R2 and then deduplicate on (study, lead, tag)
     ld = (
-        ld.sort_values('R2_overall', ascending=False)
-        .drop_duplicates(subset=['study_id', 'index_variant_id', 'tag_variant_id'])
+        ld.sort_values('R2_overall', ascending=False, kind='mergesort')
+        .drop_duplicates(subset=['study_id', 'index_key', 'tag_key'])
     )
 
     # Add column showing whether LD was available for each (study, lead)
     ld = pd.merge(ld,
                   ld_available,
-                  on=['study_id', 'index_variant_id'],
+                  on=['study_id', 'index_key'],
                   how='left')
-    ld['ld_available'] = ld['ld_available'].fillna(False)
+    ld['ld_available'] = ld['ld_available'].fillna(False).astype(bool)
 
-    # Decompose variant IDs
+    # Decode variant keys
     ld[['lead_chrom', 'lead_pos', 'lead_ref', 'lead_alt']] = \
-        ld.index_variant_id.str.split('_', 3, expand=True)
+        decode_keys_pd(ld['index_key'], alleles).values
     ld[['tag_chrom', 'tag_pos', 'tag_ref', 'tag_alt']] = \
-        ld.tag_variant_id.str.split('_', 3, expand=True)
-    ld['lead_pos'] = ld['lead_pos'].astype(int)
-    ld['tag_pos'] = ld['tag_pos'].astype(int)
+        decode_keys_pd(ld['tag_key'], alleles).values
 
     # Format
     cols = OrderedDict([
@@ -78,21 +336,10 @@ def main():
         ('ld_available', 'ld_available')
     ])
     ld = ( ld.loc[:, list(cols.keys())]
-             .rename(columns=cols) )
-    
-    # Sort
-    ld = ld.sort_values(
-        ['study_id', 'lead_chrom', 'lead_pos', 'lead_ref', 'lead_alt',
-         'tag_chrom', 'tag_pos', 'tag_ref', 'tag_alt']
-    )
+             .rename(columns=cols)
+             .astype(dtype=OUT_DTYPES) )
 
-    # Save as parquet
-    write_parquet(
-        ld,
-        args.outf,
-        compression='snappy',
-        flavor='spark'
-    )
+    return ld
 
 def parse_args():
     """ Load command line args """
@@ -101,6 +348,8 @@ def parse_args():
     parser.add_argument('--in_manifest', metavar="<file>", help=('Input manifest file'), type=str, required=True)
     parser.add_argument('--outf', metavar="<str>", help=("Output"), type=str, required=True)
     parser.add_argument('--min_r2', metavar="<str>", help=("Minimum R2 to be included"), type=float, required=True)
+    parser.add_argument('--layout', metavar="<str>", help=("Write a single file sorted by study, or a directory partitioned by lead_chrom and sorted by lead_pos (default: single)"), type=str, choices=['single', 'chrom'], default='single')
+    parser.add_argument('--max_loci', metavar="<int>", help=("Maximum number of (study, lead) loci formatted at a time (default: 20000)"), type=int, default=20000)
     args = parser.parse_args()
     return args
 
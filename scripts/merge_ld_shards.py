@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Combines the shards of an LD calculation run with calc_ld_1000G.v2.py
+# --shard i/N into a single output directory, separate from the shards so
+# that process_ld.py does not read any LD row twice. Fails unless every shard
+# is present, complete, and its outputs match their journaled checksums.
+#
+
+import sys
+import os
+import json
+import shutil
+import argparse
+from common.journal import Journal
+
+def main():
+
+    # Parse args
+    args = parse_args()
+
+    # Validate all shards before changing anything
+    outputs = {}
+    shard_of = {}
+    errors = []
+    for shard in range(1, args.n_shards + 1):
+        shard_dir = os.path.join(args.indir, make_shard_name(shard, args.n_shards))
+        try:
+            shard_outputs, shard_varids = validate_shard(
+                shard_dir, shard, args.n_shards)
+        except ValueError as e:
+            errors.append(str(e))
+            continue
+
+        # Each variant must belong to exactly one shard
+        for varid in shard_varids:
+            if varid in shard_of:
+                errors.append('{0} is in shards {1} and {2}'.format(
+                    varid, shard_of[varid], shard))
+            shard_of[varid] = shard
+        outputs.update(shard_outputs)
+
+    # Check that shards cover the full variant list
+    if args.varfile and not errors:
+        with open(args.varfile, 'r') as in_h:
+            varids = set(line.rstrip() for line in in_h)
+        missing = varids - set(shard_of)
+        if missing:
+            errors.append('{0} variants are not in any shard, e.g. {1}'.format(
+                len(missing), sorted(missing)[0]))
+
+    if errors:
+        for error in errors:
+            print('Error: ' + error, file=sys.stderr)
+        sys.exit(1)
+
+    # Link (or copy) each output into outdir. Shard outputs have distinct
+    # names, and existing links are kept, so an interrupted merge can be rerun.
+    os.makedirs(args.outdir, exist_ok=True)
+    for inf in sorted(set(outputs.values())):
+        outf = os.path.join(args.outdir, os.path.basename(inf))
+        if os.path.exists(outf):
+            continue
+        outtemp = os.path.join(args.outdir, '.' + os.path.basename(inf) + '.tmp')
+        try:
+            os.link(inf, outtemp)
+        except OSError:
+            shutil.copyfile(inf, outtemp)
+        os.replace(outtemp, outf)
+    print('Merged {0} variants from {1} shards'.format(
+        len(shard_of), args.n_shards))
+
+    # Mark the merged run as complete
+    open(os.path.join(args.outdir, '_SUCCESS'), 'w').close()
+
+    # Remove shard directories
+    if args.delete_shards:
+        for shard in range(1, args.n_shards + 1):
+            shutil.rmtree(os.path.join(
+                args.indir, make_shard_name(shard, args.n_shards)))
+
+    return 0
+
+def validate_shard(shard_dir, shard, n_shards):
+    ''' Checks that a shard finished and that every variant it is responsible
+        for has a valid output
+    Returns:
+        (dict of variant ID -> output path, list of the shard's variant IDs)
+    Raises:
+        ValueError if the shard is missing or incomplete
+    '''
+    if not os.path.exists(os.path.join(shard_dir, '_SUCCESS')):
+        raise ValueError('{0} is missing or did not finish'.format(shard_dir))
+
+    # A run without --shard, or an incomplete copy, has _SUCCESS but not
+    # the shard information
+    try:
+        with open(os.path.join(shard_dir, '_SHARD.json'), 'r') as in_h:
+            shard_info = json.load(in_h)
+        journal_dir = os.path.join(shard_dir, '_journal')
+        with open(os.path.join(journal_dir, 'params.json'), 'r') as in_h:
+            params = json.load(in_h)
+    except (OSError, ValueError) as e:
+        raise ValueError('{0} is not a complete shard: {1}'.format(shard_dir, e))
+    if [shard_info['shard'], shard_info['n_shards']] != [shard, n_shards]:
+        raise ValueError('{0} holds shard {1}/{2}'.format(
+            shard_dir, shard_info['shard'], shard_info['n_shards']))
+
+    # Re-open the shard's journal with its own parameters
+    completed = Journal(journal_dir, shard_dir, params).completed()
+
+    incomplete = [varid for varid in shard_info['varids']
+                  if varid not in completed]
+    if incomplete:
+        raise ValueError('{0} has {1} variants without a valid output, e.g. {2}'.format(
+            shard_dir, len(incomplete), incomplete[0]))
+
+    return ({varid: completed[varid] for varid in shard_info['varids']},
+            shard_info['varids'])
+
+def make_shard_name(shard, n_shards):
+    ''' Makes the output directory name of a shard, as calc_ld_1000G.v2.py
+    '''
+    return 'shard-{0}-of-{1}'.format(shard, n_shards)
+
+def parse_args():
+    """ Load command line args """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--indir', metavar="<str>", help=("Output directory given to calc_ld_1000G.v2.py, containing the shard directories"), type=str, required=True)
+    parser.add_argument('--n_shards', metavar="<int>", help=("Number of shards (N in --shard i/N)"), type=int, required=True)
+    parser.add_argument('--outdir', metavar="<str>", help=("Directory to merge the shards into, to pass to process_ld.py --in_ld_folder. Must not be --indir or contain it"), type=str, required=True)
+    parser.add_argument('--varfile', metavar="<str>", help=("Check that the shards cover every variant in this file"), type=str, default=None)
+    parser.add_argument('--delete_shards', help=("Remove the shard directories after merging"), action='store_true')
+    args = parser.parse_args()
+
+    # The shard directories must not be below the merged output, or their
+    # rows would be read again with it
+    indir = os.path.realpath(args.indir)
+    outdir = os.path.realpath(args.outdir)
+    if os.path.commonpath([indir, outdir]) == outdir:
+        parser.error('--outdir must not be --indir or one of its parents')
+    return args
+
+if __name__ == '__main__':
+
+    main()
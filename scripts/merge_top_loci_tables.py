@@ -11,6 +11,7 @@ import argparse
 import pandas as pd
 from collections import OrderedDict
 from parquet_writer import write_parquet
+from common.variant_key import split_varids_pd
 
 def main():
 
@@ -48,9 +49,8 @@ def main():
     merged = pd.concat([gwas, sumstat], sort=False)
 
     # Split variant ID into chrom, pos, ref, alt
-    merged[['chrom', 'pos', 'ref', 'alt']] = (
-        merged['variant_id_b38'].str.split('_', expand=True)
-    )
+    merged[['chrom', 'pos', 'ref', 'alt']] = \
+        split_varids_pd(merged['variant_id_b38']).values
     merged.pos = merged.pos.astype(int)
     merged.drop(['variant_id_b38', 'rsid'], axis=1, inplace=True)
 
@@ -4,6 +4,7 @@
 # Ed Mountjoy
 #
 
+import os
 import sys
 import pandas as pd
 import pyarrow as pa
@@ -11,6 +12,17 @@ import pyarrow.parquet as pq
 from numpy import nan
 from collections import OrderedDict
 
+# Write options for tables that are looked up by region or by study. Row
+# groups are small enough to be skipped individually, using the column
+# statistics and page indexes for range queries and a bloom filter for study.
+# bloom_filter_options needs pyarrow >= 24.
+LOOKUP_ROW_GROUP_SIZE = 250000
+LOOKUP_WRITE_OPTIONS = {
+    'write_statistics': True,
+    'write_page_index': True,
+    'bloom_filter_options': {'study_id': {'ndv': 100000, 'fpp': 0.01}}
+}
+
 
 def main():
 
@@ -70,6 +82,32 @@ def write_parquet(df, path, preserve_index=False, str_list_cols=None, **kwargs):
 
     return 0
 
+def write_parquet_by_chrom(df, path, chrom_col, sort_cols, part=0, **kwargs):
+    ''' Writes a pandas df as a hive partitioned parquet dataset with a
+        directory per chromosome ({chrom_col}={chrom}), each sorted by
+        sort_cols. As with Spark's partitionBy, chrom_col is only stored in
+        the directory names.
+    Params:
+        df (pd.df): pandas dataframe
+        path (dir): dataset directory to write. Existing files of other
+            parts are kept, so write a new table into an empty directory
+        chrom_col (str): column to partition on
+        sort_cols (list of str): columns to sort each partition by
+        part (int): file number within each chromosome directory, to write a
+            chromosome in several parts
+        kwargs: passed to write_parquet
+    '''
+    for chrom, chrom_df in df.groupby(chrom_col, sort=True):
+        outdir = os.path.join(path, '{0}={1}'.format(chrom_col, chrom))
+        os.makedirs(outdir, exist_ok=True)
+        write_parquet(
+            chrom_df.drop(columns=chrom_col).sort_values(sort_cols),
+            os.path.join(outdir, 'part-{0:05d}.parquet'.format(part)),
+            **kwargs
+        )
+
+    return 0
+
 def pd_dtype_to_pa_schema(dtypes, str_list_cols=None):
     ''' Converts a pandas dtype to a pyarrow schema
     '''
@@ -8,21 +8,109 @@
 - Calculates study/population weighted LD
 - Calulcates PICS probabilities, and credible sets
 
-# Set SPARK_HOME and PYTHONPATH to use 2.4.0
-export PYSPARK_SUBMIT_ARGS="--driver-memory 8g pyspark-shell"
-export SPARK_HOME=/Users/em21/software/spark-2.4.0-bin-hadoop2.7
-export PYTHONPATH=$SPARK_HOME/python:$SPARK_HOME/python/lib/py4j-2.4.0-src.zip:$PYTHONPATH
+# Set SPARK_HOME and PYTHONPATH to use 3.2.4 (>= 3.1 is needed for atanh and
+# applyInPandas, >= 3.2 for the parquet bloom filter options)
+export SPARK_HOME=/Users/em21/software/spark-3.2.4-bin-hadoop3.2
+export PYTHONPATH=$SPARK_HOME/python:$SPARK_HOME/python/lib/py4j-0.10.9.5-src.zip:$PYTHONPATH
 '''
 
 import os
 import sys
+import glob
+import shutil
+import tempfile
 import numpy as np
+import pandas as pd
 import argparse
-import pyspark.sql
-from pyspark.sql.types import DoubleType, StructType, StringType, IntegerType
-from pyspark.sql.functions import col, pow, when, regexp_replace, split, lag, udf, log10, sqrt, desc
-from pyspark.sql.window import Window
-from scipy.stats import norm
+import pyarrow as pa
+import pyarrow.parquet as pq
+from common.pics import weighted_r2, neglog_pval, calc_pics, make_ancestry_key
+from common.variant_key import (encode_variants_pd, encode_varids_pd,
+                                split_varids_pd)
+from parquet_writer import LOOKUP_ROW_GROUP_SIZE, LOOKUP_WRITE_OPTIONS
+
+# Population proportion columns of the manifest
+PROP_COLS = ['AFR_prop', 'AMR_prop', 'EAS_prop', 'EUR_prop', 'SAS_prop']
+
+# Columns identifying a locus
+LOCUS_COLS = ['study_id', 'lead_chrom', 'lead_pos', 'lead_ref', 'lead_alt']
+
+# Schema of the output LD table, as written by Spark
+OUT_SCHEMA = pa.schema([
+    ('study_id', pa.string()),
+    ('lead_chrom', pa.string()),
+    ('lead_pos', pa.int32()),
+    ('lead_ref', pa.string()),
+    ('lead_alt', pa.string()),
+    ('tag_chrom', pa.string()),
+    ('tag_pos', pa.int32()),
+    ('tag_ref', pa.string()),
+    ('tag_alt', pa.string()),
+    ('overall_r2', pa.float64()),
+    ('pics_mu', pa.float64()),
+    ('pics_postprob', pa.float64()),
+    ('pics_95perc_credset', pa.bool_()),
+    ('pics_99perc_credset', pa.bool_()),
+    ('AFR_1000G_prop', pa.float64()),
+    ('AMR_1000G_prop', pa.float64()),
+    ('EAS_1000G_prop', pa.float64()),
+    ('EUR_1000G_prop', pa.float64()),
+    ('SAS_1000G_prop', pa.float64())
+])
+
+# Columns passed to calc_pics_locus, and the types they are cast to
+PICS_INPUT_DTYPES = [
+    ('study_id', 'string'),
+    ('lead_chrom', 'string'),
+    ('lead_pos', 'int'),
+    ('lead_ref', 'string'),
+    ('lead_alt', 'string'),
+    ('tag_chrom', 'string'),
+    ('tag_pos', 'int'),
+    ('tag_ref', 'string'),
+    ('tag_alt', 'string'),
+    ('R2_overall', 'double'),
+    ('neglog_p', 'double'),
+    ('AFR_prop', 'double'),
+    ('AMR_prop', 'double'),
+    ('EAS_prop', 'double'),
+    ('EUR_prop', 'double'),
+    ('SAS_prop', 'double')
+]
+
+# Columns returned by calc_pics_locus, and their types
+PICS_OUTPUT_DTYPES = [
+    ('study_id', 'string'),
+    ('lead_chrom', 'string'),
+    ('lead_pos', 'int'),
+    ('lead_ref', 'string'),
+    ('lead_alt', 'string'),
+    ('tag_chrom', 'string'),
+    ('tag_pos', 'int'),
+    ('tag_ref', 'string'),
+    ('tag_alt', 'string'),
+    ('R2_overall', 'double'),
+    ('pics_mu', 'double'),
+    ('pics_postprob', 'double'),
+    ('pics_95perc_credset', 'boolean'),
+    ('pics_99perc_credset', 'boolean'),
+    ('AFR_prop', 'double'),
+    ('AMR_prop', 'double'),
+    ('EAS_prop', 'double'),
+    ('EUR_prop', 'double'),
+    ('SAS_prop', 'double')
+]
+
+# Tag columns nested in each tag set of the nested output
+NESTED_TAG_COLS = ['tag_chrom', 'tag_pos', 'tag_ref', 'tag_alt', 'overall_r2',
+                   'pics_mu', 'pics_postprob', 'pics_95perc_credset',
+                   'pics_99perc_credset']
+
+# Target row group size of the Spark output
+SPARK_ROW_GROUP_BYTES = 32 * 2**20
+
+# Minimum number of LD rows processed at a time by the local engine
+LOCAL_BATCH_ROWS = 5000000
 
 def main():
 
@@ -34,97 +122,68 @@ def main():
     # args.out = 'output/ld_w_crediblesets.parquet'
     # args.min_r2 = 0.5
 
+    # Process without Spark
+    if args.engine == 'local':
+        return process_ld_local(args)
+
+    # Spark is imported by the functions of the Spark engine only, so that
+    # the local engine runs without it
+    from pyspark.sql.functions import col, split, log10, broadcast
+    from common.utils import initialize_sparksession
+    from common.variant_key import (encode_variants_spark, encode_varids_spark,
+                                    check_hash_collisions_spark)
+
     # Make spark session
     global spark
-    spark = (
-        pyspark.sql.SparkSession.builder
-        .config("spark.master", "local[*]")
-        .getOrCreate()
-    )
+    spark = initialize_sparksession(
+        input_paths=[args.in_ld_folder, args.in_manifest, args.in_top_loci])
     print('Spark version: ', spark.version)
     
     #
     # Load data ---------------------------------------------------------------
     #
 
-    # Load LD
+    # Load LD, identifying index variants by their int64 key (see
+    # common.variant_key) rather than their chrom:pos:ref:alt ID
     ld = (
-        load_ld(args.in_ld_folder)
-        .withColumn('index_variant_id', regexp_replace(col('index_variant_id'), ':', '_'))
-        .withColumn('tag_variant_id', regexp_replace(col('tag_variant_id'), ':', '_'))
+        load_ld(args.in_ld_folder, args.in_ld_format, args.in_ld_weighted)
+        .withColumn('index_key', encode_varids_spark('index_variant_id', ':'))
+        .drop('index_variant_id')
         # .limit(10000) # Debug
+        # Partition by index variant once. The joins below broadcast the
+        # small tables, and PICS is grouped by keys that include the index
+        # variant, so the LD rows are not shuffled again.
+        .repartition('index_key')
     )
     
-    # Load manifest
+    # Load manifest. LD index variants are manifest variants, so checking the
+    # manifest's keys for hash collisions also covers the join.
     manifest = (
         load_manifest(args.in_manifest)
-        .withColumnRenamed('variant_id', 'index_variant_id')
+        .withColumn('index_key',
+                    encode_variants_spark('chrom', 'pos', 'ref', 'alt'))
     )
+    check_hash_collisions_spark(manifest, 'index_key', 'ref', 'alt')
     
     #
     # Weight correlations by study population ---------------------------------
     #
 
-    # Join LD to manifest
-    data = manifest.join(
-        ld,
-        on='index_variant_id'
-    )
-
-    # Replace R fields
-    for coln in ['R_AFR', 'R_AMR', 'R_EAS', 'R_EUR', 'R_SAS']:
-        data = (
-            data
-            # Replace all R values == 1 with 0.9999995, otherwise we get error
-            # This is reverted later by rounding to 6 dp
-            .withColumn(coln,
-                when(col(coln) == 1, 0.9999995).otherwise(col(coln))
-            )
-            # Fill nulls with 0
-            .withColumn(coln,
-                when(col(coln).isNull(), 0).otherwise(col(coln))
-            )
-        )
-
-    # Fisher transform correlations to z-scores
-    for coln in ['R_AFR', 'R_AMR', 'R_EAS', 'R_EUR', 'R_SAS']:
-        data = data.withColumn(
-            coln.replace('R_', 'Z_'),
-            arctanh(col(coln))
-        )
-
-    # Compute weighted average across populations
-    data = data.withColumn('Z_overall',
-        (
-            (col('AFR_prop') * col('Z_AFR')) +
-            (col('AMR_prop') * col('Z_AMR')) +
-            (col('EAS_prop') * col('Z_EAS')) +
-            (col('EUR_prop') * col('Z_EUR')) +
-            (col('SAS_prop') * col('Z_SAS'))
-        )
-    )
-
-    # Inverse Fisher transform weigthed z-score back to correlation
-    data = data.withColumn('R_overall', tanh(col('Z_overall')))
-
-    # Round R_overall to 6 dp
-    data = data.withColumn('R_overall', round6dp(col('R_overall')))
-
-    # Convert R to R2
-    data = data.withColumn('R2_overall',
-        pow(col('R_overall'), 2)
-    )
-
-    # Drop rows where R2 is null
-    data = data.filter(col('R2_overall').isNotNull())
-
-    # Filter based on overall R2
-    data = data.filter(col('R2_overall') >= args.min_r2)
+    if args.in_ld_weighted:
+        # LD was weighted and filtered by the LD calculator, once for each
+        # distinct ancestry of each index variant. Filtered again, in case
+        # the calculator was run with a lower min_r2.
+        data = ld.join(
+            broadcast(manifest),
+            on=['index_key', 'ancestry_key']
+        ).filter(col('R2_overall') >= args.min_r2)
+    else:
+        data = weight_by_population(manifest, ld, args.min_r2)
 
     # Drop unneeded columns
     data = data.drop(*['Z_overall', 'R_overall', 'R_AFR',
                        'R_AMR', 'R_EAS', 'R_EUR', 'R_SAS', 'Z_AFR',
-                       'Z_AMR', 'Z_EAS', 'Z_EUR', 'Z_SAS', 'index_variant_id'])
+                       'Z_AMR', 'Z_EAS', 'Z_EUR', 'Z_SAS', 'ancestry_key'])
     
     # Denormalise variant IDs
     data = (
@@ -133,7 +192,7 @@ def main():
         .withColumnRenamed('pos', 'lead_pos')
         .withColumnRenamed('ref', 'lead_ref')
         .withColumnRenamed('alt', 'lead_alt')
-        .withColumn('tag_split', split(col('tag_variant_id'), '_'))
+        .withColumn('tag_split', split(col('tag_variant_id'), ':'))
         .withColumn('tag_chrom', col('tag_split').getItem(0))
         .withColumn('tag_pos', col('tag_split').getItem(1).cast('int'))
         .withColumn('tag_ref', col('tag_split').getItem(2))
@@ -152,9 +211,6 @@ def main():
         and it's LD.
     '''
 
-    # Empiric constant that can be adjusted to fit the curve, 6.4 recommended.
-    k = 6.4
-
     # Load toploci
     toploci = spark.read.parquet(args.in_top_loci)
 
@@ -171,85 +227,24 @@ def main():
                 'lead_alt', 'neglog_p')
     )
     data = data.join(
-        toploci,
-        on=['study_id', 'lead_chrom', 'lead_pos',
-            'lead_ref', 'lead_alt']
-    )
-
-    # Calculate PICS statistics
-    data = (
-        data
-        .withColumn('pics_mu',
-            col('R2_overall') * col('neglog_p')
-        )
-        .withColumn('pics_std',
-            sqrt(1 - sqrt(col('R2_overall'))**k) *
-            sqrt(col('neglog_p')) / 2
-        )
-        .withColumn('pics_relative_prob',
-            when(col('pics_std') == 0, 1.0).otherwise(
-                norm_sf(col('pics_mu'), col('pics_std'), col('neglog_p'))
-            )
-        )
-    )
-
-    # Calculate the sum of the posterior probabilities at each locus
-    pics_prob_sums = (
-        data.groupby('study_id', 'lead_chrom', 'lead_pos',
-                     'lead_ref', 'lead_alt')
-        .agg(sum('pics_relative_prob').alias('pics_relative_prob_sum'))
-    )
-
-    # Merge back onto data
-    data = data.join(
-        pics_prob_sums,
+        broadcast(toploci),
         on=['study_id', 'lead_chrom', 'lead_pos',
             'lead_ref', 'lead_alt']
     )
 
-    # Calculate posterior probability at each locus
+    # Calculate PICS posterior probabilities, cumulative sums and credible
+    # sets, passing each locus to pandas as one batch. Grouping by the index
+    # variant as well as the locus gives the same groups, but uses the
+    # existing partitioning of the LD rows instead of another shuffle.
     data = (
         data
-        .withColumn(
-            'pics_postprob',
-            col('pics_relative_prob') / col('pics_relative_prob_sum')
-        )
-        .drop('pics_relative_prob_sum', 'neglog_p')
-    )
-
-    # Calculate cumulative sum per locus
-    window_spec = (
-        Window.partitionBy('study_id', 'lead_chrom', 'lead_pos',
-                           'lead_ref', 'lead_alt')
-        .orderBy(desc('pics_postprob'))
-        .rowsBetween(Window.unboundedPreceding, Window.currentRow)
-    )
-    data = (
-        data.withColumn(
-            'pics_postprob_cumsum',
-            sum('pics_postprob').over(window_spec)
-        )
-    )
-
-    # Label whether each row is in the 95 and 99% credible sets
-    window_spec = (
-        Window.partitionBy('study_id', 'lead_chrom', 'lead_pos',
-                           'lead_ref', 'lead_alt')
-        .orderBy('pics_postprob_cumsum')
-    )
-    data = (
-        data
-        .withColumn(
-            'pics_95perc_credset',
-            when(
-                lag('pics_postprob_cumsum', 1).over(window_spec) >= 0.95,
-                False).otherwise(True)
-        )
-        .withColumn(
-            'pics_99perc_credset',
-            when(
-                lag('pics_postprob_cumsum', 1).over(window_spec) >= 0.99,
-                False).otherwise(True)
+        .select('index_key',
+                *[col(name).cast(dtype) for name, dtype in PICS_INPUT_DTYPES])
+        .groupBy('index_key', *LOCUS_COLS)
+        .applyInPandas(
+            calc_pics_locus,
+            schema=', '.join('{0} {1}'.format(name, dtype)
+                             for name, dtype in PICS_OUTPUT_DTYPES)
         )
     )
 
@@ -287,51 +282,487 @@ def main():
                 'SAS_1000G_prop')
     )
 
-    # Save output
-    (
+    # Save output, either flat or as loci and deduplicated tag sets
+    if args.out_format == 'nested':
+        loci, tagsets = nest_ld_table(data, manifest)
+        write_ld_table(loci, os.path.join(args.out, 'loci'), args.out_layout,
+                       range_cols=['study_id', 'lead_chrom', 'lead_pos'])
+        write_ld_table(tagsets, os.path.join(args.out, 'tagsets'),
+                       args.out_layout, range_cols=['lead_chrom', 'lead_pos'])
+    else:
+        write_ld_table(data, args.out, args.out_layout,
+                       range_cols=['study_id', 'lead_chrom', 'lead_pos'])
+    
+    return 0
+
+def nest_ld_table(data, manifest):
+    ''' Splits the flat LD table into a table of (study, lead) loci, with the
+        study's ancestry proportions, and a table of tag sets. Studies that
+        share a lead and have identical tags (same ancestry and p-value) share
+        a tag set.
+    Args:
+        data (spark.df): flat LD table
+        manifest (spark.df): LD analysis manifest
+    Returns:
+        (loci, tagsets) spark.dfs
+    '''
+    from pyspark.sql.functions import (col, struct, collect_list, array_sort,
+                                       xxhash64, count, countDistinct)
+
+    lead_cols = ['lead_chrom', 'lead_pos', 'lead_ref', 'lead_alt']
+
+    # Collect each locus' tags, in a fixed order, and identify the tag set by
+    # a hash of its lead and contents. Kept, as it is used twice below and
+    # for the collision check.
+    loci = (
         data
-        .repartitionByRange('study_id', 'lead_chrom', 'lead_pos')
-        .write
-        .parquet(
-            args.out,
-            mode='overwrite'
+        .groupBy(*LOCUS_COLS)
+        .agg(array_sort(collect_list(struct(*NESTED_TAG_COLS))).alias('tags'))
+        .withColumn('tagset_id', xxhash64(*lead_cols, 'tags'))
+        .persist()
+    )
+
+    # Deduplicate on the tag sets themselves, and fail if two different tag
+    # sets have the same hash, rather than merging them
+    tagsets = (
+        loci
+        .select('tagset_id', *lead_cols, 'tags')
+        .dropDuplicates(lead_cols + ['tags'])
+    )
+    counts = tagsets.agg(count('*').alias('n_tagsets'),
+                         countDistinct('tagset_id').alias('n_ids')).first()
+    if counts['n_tagsets'] != counts['n_ids']:
+        raise ValueError(
+            '{0} distinct tag sets have only {1} distinct tagset_ids, '
+            'tagset_id hash collision'.format(counts['n_tagsets'],
+                                              counts['n_ids']))
+
+    # Every (study, lead) in the manifest, with its ancestry proportions and
+    # whether LD is available
+    loci = (
+        manifest
+        .select(
+            'study_id',
+            col('chrom').alias('lead_chrom'),
+            col('pos').alias('lead_pos'),
+            col('ref').alias('lead_ref'),
+            col('alt').alias('lead_alt'),
+            *[col(coln).alias(coln.replace('_prop', '_1000G_prop'))
+              for coln in PROP_COLS]
         )
+        .dropDuplicates(LOCUS_COLS)
+        .join(loci.select(*LOCUS_COLS, 'tagset_id'), on=LOCUS_COLS, how='left')
+        .withColumn('ld_available', col('tagset_id').isNotNull())
     )
-    
-    return 0
 
-@udf(DoubleType())
-def norm_sf(mu, std, neglog_p):
-    ''' Wrap norm(mean, std).sf(neglog_p) * 2 in a UDF'''
-    return float(norm(mu, std).sf(neglog_p) * 2)
+    return loci, tagsets
 
-@udf(DoubleType())
-def round6dp(x):
-    ''' Wrap np.around(x, 6) in a UDF'''
-    try:
-        return float(np.around(x, 6))
-    except TypeError:
-        return None
+def write_ld_table(data, out, layout, range_cols):
+    ''' Writes an LD table, either range partitioned on range_cols, or
+        partitioned by lead chromosome with rows sorted by lead position.
+        Parquet writes column statistics by default, and column (page)
+        indexes from parquet-mr 1.11. The bloom filter for study needs
+        parquet-mr 1.12 (Spark >= 3.2), older versions ignore the options.
+        parquet-mr 1.13 skips it for column chunks that are fully dictionary
+        encoded, which the dictionary filter prunes instead.
+    '''
+    if layout == 'chrom':
+        sort_cols = ['lead_chrom', 'lead_pos'] + \
+            (['study_id'] if 'study_id' in data.columns else [])
+        writer = (
+            data
+            .repartitionByRange('lead_chrom', 'lead_pos')
+            .sortWithinPartitions(*sort_cols)
+            .write
+            .partitionBy('lead_chrom')
+        )
+    else:
+        writer = (
+            data
+            .repartitionByRange(*range_cols)
+            .write
+        )
+    writer = writer.option('parquet.block.size', SPARK_ROW_GROUP_BYTES)
+    if 'study_id' in data.columns:
+        writer = (
+            writer
+            .option('parquet.bloom.filter.enabled#study_id', 'true')
+            .option('parquet.bloom.filter.expected.ndv#study_id',
+                    LOOKUP_WRITE_OPTIONS['bloom_filter_options']['study_id']['ndv'])
+        )
+    writer.parquet(
+        out,
+        mode='overwrite'
+    )
 
-@udf(DoubleType())
-def arctanh(x):
-    ''' Wrap np.arctanh in a UDF'''
+def process_ld_local(args):
+    ''' Produces the same output as the Spark implementation in main(), using
+        pandas/numpy in a single process. LD files are streamed in batches.
+        Each index variant's LD is in a single file, so every locus is
+        complete within a batch.
+    '''
+    # Load the small tables
+    manifest = load_manifest_local(args.in_manifest)
+    toploci = load_toploci_local(args.in_top_loci)
+
+    # Stage and write into temp directories next to the output. The output
+    # replaces args.out once complete, as Spark's mode='overwrite' does, so
+    # files of an earlier run (a larger --max_loci, or the other layout) do
+    # not survive and a failed run does not leave a partial table.
+    parent = os.path.dirname(os.path.abspath(args.out))
+    outtemp = tempfile.mkdtemp(prefix='.process_ld.', dir=parent)
+    staging_dir = tempfile.mkdtemp(prefix='.process_ld.staging.', dir=parent)
     try:
-        return float(np.arctanh(x))
-    except TypeError:
-        return None
+        n_rows = write_ld_local(args, manifest, toploci, outtemp, staging_dir)
+    except BaseException:
+        shutil.rmtree(outtemp)
+        raise
+    finally:
+        shutil.rmtree(staging_dir)
+    if os.path.isdir(args.out):
+        shutil.rmtree(args.out)
+    elif os.path.exists(args.out):
+        os.remove(args.out)
+    os.replace(outtemp, args.out)
+    print('Wrote {0} rows'.format(n_rows))
 
-@udf(DoubleType())
-def tanh(x):
-    ''' Wrap np.tanh in a UDF'''
-    try:
-        return float(np.tanh(x))
-    except TypeError:
-        return None
+    return 0
+
+def write_ld_local(args, manifest, toploci, out_dir, staging_dir):
+    ''' Calculates the LD table of process_ld_local and writes it to out_dir
+        in args.out_layout, staging the LD in staging_dir.
+    Returns:
+        number of rows written
+    '''
+    # Stream LD files in batches, staging them by range of (study, lead)
+    # loci in output order, each range holding at most --max_loci loci: by
+    # study_id for the study layout, or by lead chromosome and lead_pos range
+    # for the chrom layout.
+    if args.out_layout == 'chrom':
+        pos_bounds = make_lead_pos_bounds(manifest, args.max_loci)
+        partition_cols = ['lead_chrom', 'lead_range']
+    else:
+        study_bounds = make_study_bounds(manifest, args.max_loci)
+        partition_cols = ['study_range']
+    n_rows = 0
+    for ld in iter_ld_batches_local(args.in_ld_folder, args.in_ld_format,
+                                    args.in_ld_weighted):
+        data = calc_ld_table_local(ld, manifest, toploci, args.min_r2,
+                                   args.in_ld_weighted)
+        table = pa.Table.from_pandas(data, schema=OUT_SCHEMA,
+                                     preserve_index=False)
+        if args.out_layout == 'chrom':
+            table = table.append_column(
+                'lead_range', pa.array(lead_pos_ranges(data, pos_bounds)))
+        else:
+            table = table.append_column(
+                'study_range', pa.array(study_ranges(data, study_bounds)))
+        pq.write_to_dataset(table, staging_dir, partition_cols=partition_cols)
+        n_rows += data.shape[0]
+
+    # Write each study range to a single file sorted by study, as the Spark
+    # engine range partitions it
+    if args.out_layout == 'study':
+        with pq.ParquetWriter(os.path.join(out_dir, 'part-00000.parquet'),
+                              OUT_SCHEMA, compression='snappy', flavor='spark',
+                              **LOOKUP_WRITE_OPTIONS) as writer:
+            for range_dir in list_range_dirs(staging_dir):
+                range_table = (
+                    pq.read_table(os.path.join(staging_dir, range_dir))
+                    .sort_by([('study_id', 'ascending'),
+                              ('lead_chrom', 'ascending'),
+                              ('lead_pos', 'ascending')])
+                    .select(OUT_SCHEMA.names)
+                    .cast(OUT_SCHEMA)
+                )
+                writer.write_table(range_table,
+                                   row_group_size=LOOKUP_ROW_GROUP_SIZE)
+
+    # Write each lead_pos range of each lead chromosome, sorted by lead
+    # position, as a numbered part of the chromosome
+    if args.out_layout == 'chrom':
+        for chrom_dir in sorted(os.listdir(staging_dir)):
+            range_dirs = list_range_dirs(os.path.join(staging_dir, chrom_dir))
+            os.makedirs(os.path.join(out_dir, chrom_dir), exist_ok=True)
+            for part, range_dir in enumerate(range_dirs):
+                range_table = (
+                    pq.read_table(os.path.join(staging_dir, chrom_dir, range_dir))
+                    .sort_by([('lead_pos', 'ascending'),
+                              ('study_id', 'ascending')])
+                )
+                pq.write_table(
+                    range_table,
+                    os.path.join(out_dir, chrom_dir,
+                                 'part-{0:05d}.parquet'.format(part)),
+                    compression='snappy',
+                    flavor='spark',
+                    row_group_size=LOOKUP_ROW_GROUP_SIZE,
+                    **LOOKUP_WRITE_OPTIONS
+                )
+
+    return n_rows
+
+def make_lead_pos_bounds(manifest, max_loci):
+    ''' Splits each chromosome's (study, lead) loci of the manifest, in
+        lead_pos order, into ranges of at most max_loci. Loci with the same
+        lead_pos are kept in one range, so a range can be larger where more
+        than max_loci share a position.
+    Returns:
+        dict of chrom -> np.array of the first lead_pos of each range after
+        the first
+    '''
+    loci = manifest.loc[:, ['study_id', 'index_variant_id', 'chrom', 'pos']]
+    bounds = {}
+    for chrom, chrom_loci in loci.drop_duplicates().groupby('chrom'):
+        pos = np.sort(chrom_loci['pos'].values)
+        bounds[chrom] = np.unique(pos[max_loci::max_loci])
+    return bounds
+
+def make_study_bounds(manifest, max_loci):
+    ''' Splits the (study, lead) loci of the manifest, in study_id order, into
+        ranges of at most max_loci. Loci of the same study are kept in one
+        range.
+    Returns:
+        np.array of the first study_id of each range after the first
+    '''
+    loci = manifest.loc[:, ['study_id', 'index_variant_id']].drop_duplicates()
+    study_ids = np.sort(loci['study_id'].values.astype(str))
+    return np.unique(study_ids[max_loci::max_loci])
+
+def study_ranges(data, study_bounds):
+    ''' Gets the study range of each row (see make_study_bounds)
+    Returns:
+        np.array of int
+    '''
+    return np.searchsorted(study_bounds, data['study_id'].values.astype(str),
+                           side='right')
+
+def list_range_dirs(indir):
+    ''' Lists the hive partition directories of staged ranges, in range order
+    '''
+    if not os.path.exists(indir):
+        return []
+    return sorted(os.listdir(indir), key=lambda x: int(x.split('=')[1]))
+
+def lead_pos_ranges(data, pos_bounds):
+    ''' Gets the lead_pos range of each row (see make_lead_pos_bounds)
+    Returns:
+        np.array of int
+    '''
+    ranges = np.zeros(data.shape[0], dtype=np.int64)
+    for chrom, is_chrom in data.groupby('lead_chrom').indices.items():
+        ranges[is_chrom] = np.searchsorted(
+            pos_bounds.get(chrom, []), data['lead_pos'].values[is_chrom],
+            side='right')
+    return ranges
+
+def calc_ld_table_local(ld, manifest, toploci, min_r2, weighted):
+    ''' Weights a batch of LD by study population, and calculates PICS
+        credible sets
+    Returns:
+        pd.DataFrame with the columns of OUT_SCHEMA
+    '''
+    # Join on the int64 keys of the index variants (see common.variant_key)
+    ld['index_key'] = encode_varids_pd(ld['index_variant_id'], sep=':')
+    ld = ld.drop(columns='index_variant_id')
+
+    # Weight correlations by study population
+    if weighted:
+        data = pd.merge(manifest, ld, on=['index_key', 'ancestry_key'])
+        data = data.loc[data['R2_overall'] >= min_r2, :]
+    else:
+        data = pd.merge(manifest, ld, on='index_key')
+        data['R2_overall'] = weighted_r2(
+            data.loc[:, ['R_AFR', 'R_AMR', 'R_EAS', 'R_EUR', 'R_SAS']].values,
+            data.loc[:, PROP_COLS].values
+        )
+        data = data.loc[data['R2_overall'] >= min_r2, :]
+
+    if data.shape[0] == 0:
+        return pd.DataFrame(columns=OUT_SCHEMA.names)
+
+    # Denormalise variant IDs
+    data = data.rename(columns={'chrom': 'lead_chrom', 'pos': 'lead_pos',
+                                'ref': 'lead_ref', 'alt': 'lead_alt'})
+    tag_split = split_varids_pd(data['tag_variant_id'], sep=':')
+    data['tag_chrom'] = tag_split['chrom'].values
+    data['tag_pos'] = tag_split['pos'].values
+    data['tag_ref'] = tag_split['ref'].values
+    data['tag_alt'] = tag_split['alt'].values
+
+    # Join the lead p-value and calculate PICS credible sets
+    data = pd.merge(data, toploci, on=LOCUS_COLS)
+    data = calc_pics(data, LOCUS_COLS)
+
+    # Rename columns and format
+    data = data.rename(columns={
+        'AFR_prop': 'AFR_1000G_prop',
+        'AMR_prop': 'AMR_1000G_prop',
+        'EAS_prop': 'EAS_1000G_prop',
+        'EUR_prop': 'EUR_1000G_prop',
+        'SAS_prop': 'SAS_1000G_prop',
+        'R2_overall': 'overall_r2'
+    })
+    return data.loc[:, OUT_SCHEMA.names]
+
+def iter_ld_batches_local(in_ld_folder, in_ld_format='tsv', weighted=False):
+    ''' Reads the LD files, yielding them in batches of at least
+        LOCAL_BATCH_ROWS rows. Files starting with _ or . are skipped, as by
+        Spark.
+    Returns:
+        iterator of pd.DataFrame
+    '''
+    if weighted:
+        dtypes = {'index_variant_id': str, 'tag_variant_id': str,
+                  'ancestry_key': str, 'R2_overall': np.float64}
+    else:
+        dtypes = {'index_variant_id': str, 'tag_variant_id': str,
+                  'R_AFR': np.float64, 'R_AMR': np.float64,
+                  'R_EAS': np.float64, 'R_EUR': np.float64,
+                  'R_SAS': np.float64}
+
+    pattern = '*.parquet' if in_ld_format == 'parquet' else '*'
+    infs = sorted(inf for inf in glob.glob(os.path.join(in_ld_folder, pattern))
+                  if os.path.isfile(inf)
+                  and not os.path.basename(inf).startswith(('_', '.')))
+
+    batch = []
+    batch_rows = 0
+    for inf in infs:
+        if in_ld_format == 'parquet':
+            ld = pq.read_table(inf, columns=list(dtypes)).to_pandas()
+        else:
+            ld = pd.read_csv(inf, sep='\t', header=0, usecols=list(dtypes),
+                             dtype=dtypes)
+        batch.append(ld)
+        batch_rows += ld.shape[0]
+        if batch_rows >= LOCAL_BATCH_ROWS:
+            yield pd.concat(batch, ignore_index=True)
+            batch = []
+            batch_rows = 0
+    if batch:
+        yield pd.concat(batch, ignore_index=True)
+
+def load_manifest_local(inf):
+    ''' Loads the manifest with pandas, as load_manifest()
+    '''
+    # Only empty fields are missing, as when Spark reads the manifest
+    manifest = pd.read_csv(inf, sep='\t', header=0, dtype=str,
+                           keep_default_na=False, na_values=[''])
+    manifest = manifest.loc[:, ['study_id', 'variant_id', 'chrom', 'pos',
+                                'ref', 'alt'] + PROP_COLS]
+    manifest['ancestry_key'] = make_ancestry_key(manifest[PROP_COLS])
+    manifest['pos'] = manifest['pos'].astype('int64')
+    manifest['index_key'] = encode_variants_pd(
+        manifest['chrom'], manifest['pos'], manifest['ref'], manifest['alt'])
+    for coln in PROP_COLS:
+        manifest[coln] = pd.to_numeric(manifest[coln], errors='coerce')
+    return manifest.rename(columns={'variant_id': 'index_variant_id'})
+
+def load_toploci_local(inf):
+    ''' Loads the lead variant p-values from the top loci table
+    '''
+    toploci = pq.read_table(
+        inf,
+        columns=['study_id', 'chrom', 'pos', 'ref', 'alt',
+                 'pval_mantissa', 'pval_exponent']
+    ).to_pandas()
+    toploci['neglog_p'] = neglog_pval(toploci['pval_mantissa'].astype('float64'),
+                                      toploci['pval_exponent'].astype('float64'))
+    toploci['chrom'] = toploci['chrom'].astype(str)
+    toploci['pos'] = toploci['pos'].astype('int64')
+    return (
+        toploci
+        .rename(columns={'chrom': 'lead_chrom', 'pos': 'lead_pos',
+                         'ref': 'lead_ref', 'alt': 'lead_alt'})
+        .loc[:, LOCUS_COLS + ['neglog_p']]
+    )
+
+def weight_by_population(manifest, ld, min_r2):
+    ''' Weights correlations by study population: Fisher transform R in each
+        population, take the weighted mean, inverse transform and filter on
+        the overall R2
+    '''
+    from pyspark.sql.functions import col, pow, when, atanh, tanh, bround, broadcast
+
+    # Join LD to manifest
+    data = ld.join(
+        broadcast(manifest),
+        on='index_key'
+    )
+
+    # Replace R fields
+    for coln in ['R_AFR', 'R_AMR', 'R_EAS', 'R_EUR', 'R_SAS']:
+        data = (
+            data
+            # Replace all R values == 1 with 0.9999995, otherwise we get error
+            # This is reverted later by rounding to 6 dp
+            .withColumn(coln,
+                when(col(coln) == 1, 0.9999995).otherwise(col(coln))
+            )
+            # Fill nulls with 0
+            .withColumn(coln,
+                when(col(coln).isNull(), 0).otherwise(col(coln))
+            )
+        )
+
+    # Fisher transform correlations to z-scores
+    for coln in ['R_AFR', 'R_AMR', 'R_EAS', 'R_EUR', 'R_SAS']:
+        data = data.withColumn(
+            coln.replace('R_', 'Z_'),
+            atanh(col(coln))
+        )
+
+    # Compute weighted average across populations
+    data = data.withColumn('Z_overall',
+        (
+            (col('AFR_prop') * col('Z_AFR')) +
+            (col('AMR_prop') * col('Z_AMR')) +
+            (col('EAS_prop') * col('Z_EAS')) +
+            (col('EUR_prop') * col('Z_EUR')) +
+            (col('SAS_prop') * col('Z_SAS'))
+        )
+    )
+
+    # Inverse Fisher transform weigthed z-score back to correlation
+    data = data.withColumn('R_overall', tanh(col('Z_overall')))
+
+    # Round R_overall to 6 dp (half to even, as np.around)
+    data = data.withColumn('R_overall', bround(col('R_overall'), 6))
+
+    # Convert R to R2
+    data = data.withColumn('R2_overall',
+        pow(col('R_overall'), 2)
+    )
+
+    # Drop rows where R2 is null
+    data = data.filter(col('R2_overall').isNotNull())
+
+    # Filter based on overall R2
+    data = data.filter(col('R2_overall') >= min_r2)
+
+    return data
+
+def calc_pics_locus(locus):
+    ''' Calculates PICS credible sets for the rows of one locus
+    Args:
+        locus (pd.DataFrame): index_key and the columns of
+            PICS_INPUT_DTYPES
+    Returns:
+        pd.DataFrame with the columns of PICS_OUTPUT_DTYPES
+    '''
+    return calc_pics(locus, LOCUS_COLS).loc[
+        :, [name for name, _ in PICS_OUTPUT_DTYPES]]
 
 def load_manifest(inf):
-    ''' Loads manifest file
+    ''' Loads manifest file. The population proportions are also concatenated
+        as text into ancestry_key, which is how the LD calculator identifies
+        distinct ancestries. concat_ws skips nulls, so missing proportions are
+        made empty strings first, as in common.pics.make_ancestry_key.
     '''
+    from pyspark.sql.types import DoubleType, StructType, StringType, IntegerType
+    from pyspark.sql.functions import col, concat_ws, coalesce, lit
+
     # Specify schema
     import_schema = (
         StructType()
@@ -341,11 +772,11 @@ def load_manifest(inf):
         .add('pos', IntegerType())
         .add('ref', StringType())
         .add('alt', StringType())
-        .add('AFR_prop', DoubleType())
-        .add('AMR_prop', DoubleType())
-        .add('EAS_prop', DoubleType())
-        .add('EUR_prop', DoubleType())
-        .add('SAS_prop', DoubleType())
+        .add('AFR_prop', StringType())
+        .add('AMR_prop', StringType())
+        .add('EAS_prop', StringType())
+        .add('EUR_prop', StringType())
+        .add('SAS_prop', StringType())
     )
     # Load
     df = (
@@ -354,32 +785,54 @@ def load_manifest(inf):
                        schema=import_schema,
                        enforceSchema=True,
                        header=True)
+        .withColumn('ancestry_key', concat_ws(
+            '|', *[coalesce(col(coln), lit('')) for coln in PROP_COLS]))
     )
+    for coln in PROP_COLS:
+        df = df.withColumn(coln, col(coln).cast(DoubleType()))
 
     return df
 
-def load_ld(in_ld_folder):
-    ''' Loads all LD information from individual files
+def load_ld(in_ld_folder, in_ld_format='tsv', weighted=False):
+    ''' Loads all LD information from individual files, either a gzipped tsv
+        per variant or parquet shards
     '''
+    from pyspark.sql.types import DoubleType, StructType, StringType
+
     # Specify schema
-    import_schema = (
-        StructType()
-        .add('index_variant_id', StringType())
-        .add('tag_variant_id', StringType())
-        .add('R_AFR', DoubleType())
-        .add('R_AMR', DoubleType())
-        .add('R_EAS', DoubleType())
-        .add('R_EUR', DoubleType())
-        .add('R_SAS', DoubleType())
-    )
+    if weighted:
+        import_schema = (
+            StructType()
+            .add('index_variant_id', StringType())
+            .add('tag_variant_id', StringType())
+            .add('ancestry_key', StringType())
+            .add('R2_overall', DoubleType())
+        )
+    else:
+        import_schema = (
+            StructType()
+            .add('index_variant_id', StringType())
+            .add('tag_variant_id', StringType())
+            .add('R_AFR', DoubleType())
+            .add('R_AMR', DoubleType())
+            .add('R_EAS', DoubleType())
+            .add('R_EUR', DoubleType())
+            .add('R_SAS', DoubleType())
+        )
     # Load
-    df = (
-        spark.read.csv(in_ld_folder,
-                       sep='\t',
-                       schema=import_schema,
-                       enforceSchema=True,
-                       header=True)
-    )
+    if in_ld_format == 'parquet':
+        df = (
+            spark.read.schema(import_schema)
+            .parquet(os.path.join(in_ld_folder, '*.parquet'))
+        )
+    else:
+        df = (
+            spark.read.csv(in_ld_folder,
+                           sep='\t',
+                           schema=import_schema,
+                           enforceSchema=True,
+                           header=True)
+        )
 
     return df
 
@@ -387,11 +840,21 @@ def parse_args():
     """ Load command line args """
     parser = argparse.ArgumentParser()
     parser.add_argument('--in_ld_folder', metavar="<str>", help=("Folder with gzip compressed tsv files with LD information"), type=str, required=True)
+    parser.add_argument('--in_ld_format', metavar="<str>", help=("Format of the LD files: tsv or parquet (default: tsv)"), type=str, choices=['tsv', 'parquet'], default='tsv')
+    parser.add_argument('--in_ld_weighted', help=("LD files were already weighted by population (calc_ld_1000G.v2.py --manifest). --min_r2 is applied again to the weighted R2"), action='store_true')
     parser.add_argument('--in_manifest', metavar="<str>", help=("Input manifest file"), type=str, required=True)
     parser.add_argument('--in_top_loci', metavar="<str>", help=("Input top loci table"), type=str, required=True)
     parser.add_argument('--min_r2', metavar="<float>", help=("Minimum R2"), type=float, required=True)
     parser.add_argument('--out', metavar="<str>", help=("Output file"), type=str, required=True)
+    parser.add_argument('--out_layout', metavar="<str>", help=("Range partition the output by study, or partition it by lead_chrom with rows sorted by lead_pos (default: study)"), type=str, choices=['study', 'chrom'], default='study')
+    parser.add_argument('--out_format', metavar="<str>", help=("Write the flat LD table, or a compact nested table: out/loci with a row per (study, lead) and out/tagsets with the tags of each lead, see expand_ld_table.py (default: flat)"), type=str, choices=['flat', 'nested'], default='flat')
+    parser.add_argument('--engine', metavar="<str>", help=("Run with Spark, or in a single local process without Spark (default: spark)"), type=str, choices=['spark', 'local'], default='spark')
+    parser.add_argument('--max_loci', metavar="<int>", help=("Maximum number of (study, lead) loci sorted at a time by the local engine, and in each output file of its chrom layout (default: 20000)"), type=int, default=20000)
     args = parser.parse_args()
+    if args.out_format == 'nested' and args.engine != 'spark':
+        parser.error('--out_format nested requires --engine spark')
+    if args.max_loci < 1:
+        parser.error('--max_loci must be at least 1')
     return args
 
 if __name__ == '__main__':
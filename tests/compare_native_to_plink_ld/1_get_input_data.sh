@@ -0,0 +1,19 @@
+#!/usr/bin/env bash
+#
+# Copies one autosome and chrX of the 1000G plink files for each population
+#
+
+set -euo pipefail
+
+url_1000G=gs://genetics-portal-input/1000Genomes_phase3/plink_format_b38
+
+for pop in AFR AMR EAS EUR SAS; do
+  mkdir -p input_data/1000Genomep3/$pop
+  for chrom in 22 X; do
+    for ext in bed bim fam; do
+      gsutil cp -n $url_1000G/$pop/$pop.$chrom.1000Gp3.20130502.$ext input_data/1000Genomep3/$pop/
+    done
+  done
+done
+
+echo COMPLETE
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Compares the LD (R) output by calc_ld_1000G.v2.py with `--engine plink` to
+# the native engine, with each kernel and mode, on a region of each of the
+# chromosomes downloaded by 1_get_input_data.sh. R is compared to 6 dp, as
+# written by plink.
+#
+# The 1000G files have no missing calls, so missing calls are added to every
+# 7th variant, and every 500th variant is given the ID of the variant before
+# it. Results are broken down by index variants on chrX, and by pairs with
+# missing calls or duplicated IDs (in the index or tag variant).
+#
+# Usage: python 2_compare_engines.py (see --help)
+#
+# Exits 1 if any output differs, and 2 if plink is not on the PATH, after
+# comparing the native kernels and modes to each other.
+#
+
+import sys
+import os
+import glob
+import shutil
+import argparse
+import subprocess as sp
+import numpy as np
+import pandas as pd
+
+SCRIPTS = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'scripts'))
+sys.path.insert(0, SCRIPTS)
+from common.plink_bed import PlinkBed
+
+POPS = ['AFR', 'AMR', 'EAS', 'EUR', 'SAS']
+R_COLS = ['R_{}'.format(pop) for pop in POPS]
+
+BFILE_NAME = '{pop}/{pop}.{chrom}.1000Gp3.20130502'
+
+# Native engine runs compared to the reference, as (kernel, mode)
+NATIVE_RUNS = [('float', 'variant'), ('popcount', 'variant'),
+               ('float', 'block'), ('popcount', 'block')]
+
+def main():
+
+    # Args
+    args = parse_args()
+    has_plink = shutil.which('plink') is not None
+
+    # Make the edge case reference files and the list of index variants
+    bfile_dir = os.path.join(args.outdir, 'bfiles')
+    edge_cases = make_edge_case_bfiles(args.in_bfile_dir, bfile_dir,
+                                       args.chroms, args.max_variants)
+    varfile = os.path.join(args.outdir, 'variants.txt')
+    varids = select_index_variants(bfile_dir, args.chroms, args.n_variants,
+                                   edge_cases)
+    with open(varfile, 'w') as out_h:
+        for varid in varids:
+            out_h.write(varid + '\n')
+    print('{0} index variants on chromosomes {1}'.format(
+        len(varids), ', '.join(args.chroms)))
+
+    # Run plink, if available, and each native kernel and mode
+    runs = ([('plink', 'float', 'variant')] if has_plink else []) + \
+        [('native', kernel, mode) for kernel, mode in NATIVE_RUNS]
+    results = {}
+    for engine, kernel, mode in runs:
+        name = '{0}.{1}.{2}'.format(engine, kernel, mode) \
+            if engine == 'native' else engine
+        outdir = os.path.join(args.outdir, name)
+        run_calc_ld(varfile, os.path.join(bfile_dir, BFILE_NAME), outdir,
+                    args.ld_window, engine, kernel, mode, args.max_cores)
+        results[name] = load_ld(outdir)
+
+    # Compare every run to plink, or to the native float kernel without plink
+    ref_name = 'plink' if has_plink else 'native.float.variant'
+    n_diffs = 0
+    for name, ld in results.items():
+        if name == ref_name:
+            continue
+        print('\n{0} vs {1}'.format(name, ref_name))
+        n_diffs += compare_ld(results[ref_name], ld, edge_cases)
+
+    if n_diffs > 0:
+        print('\nFAILED: {0} differences'.format(n_diffs))
+        return 1
+    if not has_plink:
+        print('\nSKIPPED: plink is not on the PATH, only the native kernels '
+              'and modes were compared to each other')
+        return 2
+
+    print('COMPLETE')
+
+    return 0
+
+def make_edge_case_bfiles(in_dir, out_dir, chroms, max_variants):
+    ''' Copies the central max_variants variants of each population's
+        chromosome, adding 2% missing calls to every 7th variant, and giving
+        every 500th variant the ID of the variant before it
+    Returns:
+        dict of edge case name -> set of variant IDs
+    '''
+    rng = np.random.default_rng(0)
+    edge_cases = {'chrX': set(), 'missing': set(), 'duplicated': set()}
+    for chrom in chroms:
+        for pop in POPS:
+            in_prefix = os.path.join(in_dir, BFILE_NAME.format(pop=pop, chrom=chrom))
+            out_prefix = os.path.join(out_dir, BFILE_NAME.format(pop=pop, chrom=chrom))
+            os.makedirs(os.path.dirname(out_prefix), exist_ok=True)
+            bed = PlinkBed(in_prefix)
+
+            # Central region of the chromosome
+            start = max(bed.n_variants // 2 - max_variants // 2, 0)
+            stop = min(start + max_variants, bed.n_variants)
+            # Raw genotypes, so that male het calls on chrX are kept for
+            # each engine to mask
+            packed = np.array(bed.packed[start:stop])
+            bim = bed.bim.iloc[start:stop].copy()
+
+            # Missing calls (genotype code 01)
+            for row in range(0, packed.shape[0], 7):
+                samples = np.flatnonzero(rng.random(bed.n_samples) < 0.02)
+                shifts = 2 * (samples % 4)
+                np.bitwise_and.at(packed[row], samples // 4,
+                                  ~(0b11 << shifts).astype(np.uint8))
+                np.bitwise_or.at(packed[row], samples // 4,
+                                 (0b01 << shifts).astype(np.uint8))
+            edge_cases['missing'].update(bim['variant_id'].values[::7])
+
+            # Duplicated IDs
+            dup_rows = np.arange(500, bim.shape[0], 500)
+            bim.iloc[dup_rows, bim.columns.get_loc('variant_id')] = \
+                bim['variant_id'].values[dup_rows - 1]
+            edge_cases['duplicated'].update(bim['variant_id'].values[dup_rows])
+
+            # Write
+            with open(out_prefix + '.bed', 'wb') as out_h:
+                out_h.write(bytes([0x6c, 0x1b, 0x01]))
+                out_h.write(packed.tobytes())
+            bim.to_csv(out_prefix + '.bim', sep='\t', header=False, index=False)
+            shutil.copyfile(in_prefix + '.fam', out_prefix + '.fam')
+
+            if chrom in ['X', '23']:
+                edge_cases['chrX'].update(bim['variant_id'].values)
+
+    return edge_cases
+
+def select_index_variants(bfile_dir, chroms, n_variants, edge_cases):
+    ''' Selects n_variants evenly spaced index variants per chromosome of the
+        EUR files, all variants with duplicated IDs, and their neighbours so
+        that duplicated IDs are also tested as tags
+    '''
+    varids = set(edge_cases['duplicated'])
+    for chrom in chroms:
+        bed = PlinkBed(os.path.join(bfile_dir, BFILE_NAME.format(pop='EUR', chrom=chrom)))
+        rows = np.linspace(0, bed.n_variants - 1, n_variants).astype(int)
+        dup_rows = np.flatnonzero(bed.variant_ids.duplicated(keep=False))
+        rows = np.concatenate([rows, dup_rows - 1, dup_rows + 1])
+        rows = rows[(rows >= 0) & (rows < bed.n_variants)]
+        varids.update(bed.variant_ids[rows])
+    return sorted(varids)
+
+def run_calc_ld(varfile, bfile, outdir, ld_window, engine, kernel, mode, max_cores):
+    ''' Runs calc_ld_1000G.v2.py with all R values that plink reports, from
+        scratch
+    '''
+    if os.path.exists(outdir):
+        shutil.rmtree(outdir)
+    cmd = [
+        sys.executable, os.path.join(SCRIPTS, 'calc_ld_1000G.v2.py'),
+        '--varfile', varfile,
+        '--bfile', bfile.replace('{pop}', 'POPULATION').replace('{chrom}', 'CHROM'),
+        '--pops'] + POPS + [
+        '--ld_window', str(ld_window),
+        '--min_r2', '0',
+        '--outdir', outdir,
+        '--engine', engine,
+        '--kernel', kernel,
+        '--mode', mode,
+        '--max_cores', str(max_cores),
+        '--delete_temp'
+    ]
+    print(' '.join(cmd))
+    sp.run(cmd, check=True)
+
+def load_ld(indir):
+    ''' Loads the per variant LD outputs. Rows with the same index and tag ID
+        (duplicated IDs) are numbered in output order.
+    '''
+    ld = pd.concat([
+        pd.read_csv(inf, sep='\t', header=0)
+        for inf in sorted(glob.glob(os.path.join(indir, '*.ld.tsv.gz')))
+    ], ignore_index=True)
+    ld[R_COLS] = ld[R_COLS].astype('float64')
+    ld['n'] = ld.groupby(['index_variant_id', 'tag_variant_id']).cumcount()
+    return ld
+
+def compare_ld(ref, ld, edge_cases):
+    ''' Prints the number of pairs only in one output, and of R values that
+        differ to 6 dp, for all index variants and for each edge case
+    Returns:
+        total number of differences
+    '''
+    merged = pd.merge(ref, ld, on=['index_variant_id', 'tag_variant_id', 'n'],
+                      how='outer', suffixes=('_ref', ''), indicator=True)
+    is_diff = (merged['_merge'] != 'both').values
+    for coln in R_COLS:
+        x = merged[coln + '_ref'].round(6).values
+        y = merged[coln].round(6).values
+        is_diff = is_diff | ~((x == y) | (np.isnan(x) & np.isnan(y)))
+
+    # Break down by edge case
+    subsets = [('all', np.ones(merged.shape[0], dtype=bool))]
+    for name, varids in edge_cases.items():
+        is_case = merged['index_variant_id'].isin(varids).values
+        if name != 'chrX':
+            is_case = is_case | merged['tag_variant_id'].isin(varids).values
+        subsets.append((name, is_case))
+    for name, is_case in subsets:
+        print(' {0}: {1} pairs, {2} only in one output, {3} differ'.format(
+            name,
+            is_case.sum(),
+            (is_case & (merged['_merge'] != 'both').values).sum(),
+            (is_case & is_diff).sum()))
+
+    if is_diff.any():
+        print(merged.loc[is_diff, :].head(10).to_string())
+
+    return int(is_diff.sum())
+
+def parse_args():
+    """ Load command line args """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--in_bfile_dir', metavar="<dir>", help=("Directory of the 1000G plink files (default: input_data/1000Genomep3)"), type=str, default='input_data/1000Genomep3')
+    parser.add_argument('--chroms', metavar="<str>", help=("Chromosomes to compare (default: 22 X)"), nargs='+', type=str, default=['22', 'X'])
+    parser.add_argument('--max_variants', metavar="<int>", help=("Number of variants of each chromosome to use (default: 20000)"), type=int, default=20000)
+    parser.add_argument('--n_variants', metavar="<int>", help=("Number of index variants per chromosome (default: 200)"), type=int, default=200)
+    parser.add_argument('--ld_window', metavar="<int>", help=("Window to calc LD in (kb, default: 500)"), type=int, default=500)
+    parser.add_argument('--max_cores', metavar="<int>", help=("Maximum cores to use"), type=int, default=os.cpu_count())
+    parser.add_argument('--outdir', metavar="<dir>", help=("Output directory (default: output)"), type=str, default='output')
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+
+    sys.exit(main())
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Runs process_ld.py with the Spark engine (in local mode) and the local
+# engine on the same small LD dataset and checks that they give the same
+# PICS credible sets, in both output layouts. Also checks that the nested
+# output expands back to the flat table with expand_ld_table.py, and that
+# Spark's study_id column chunks can be filtered without a scan.
+#
+# Usage: python tests/compare_spark_local_pics/compare_engines.py
+#
+# Exits 2 without running anything if pyspark is not installed.
+#
+
+import sys
+import os
+import glob
+import gzip
+import tempfile
+import subprocess as sp
+import numpy as np
+import pandas as pd
+
+SCRIPTS = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'scripts'))
+
+POPS = ['AFR', 'AMR', 'EAS', 'EUR', 'SAS']
+
+SORT_COLS = ['study_id', 'lead_chrom', 'lead_pos', 'lead_ref', 'lead_alt',
+             'tag_chrom', 'tag_pos', 'tag_ref', 'tag_alt']
+
+def main():
+
+    try:
+        import pyspark
+    except ImportError:
+        print('SKIPPED: pyspark is not installed, nothing was compared')
+        return 2
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+
+        # Make input data
+        make_inputs(tmpdir)
+        inputs = [
+            '--in_ld_folder', os.path.join(tmpdir, 'ld'),
+            '--in_manifest', os.path.join(tmpdir, 'manifest.tsv'),
+            '--in_top_loci', os.path.join(tmpdir, 'toploci.parquet'),
+            '--min_r2', '0.5'
+        ]
+
+        # Run each engine and format
+        run_script('process_ld.py', *inputs, '--engine', 'local',
+                   '--max_loci', '2',
+                   '--out', os.path.join(tmpdir, 'local.parquet'))
+        run_script('process_ld.py', *inputs, '--engine', 'spark',
+                   '--out', os.path.join(tmpdir, 'spark.parquet'))
+        run_script('process_ld.py', *inputs, '--engine', 'spark',
+                   '--out_format', 'nested',
+                   '--out', os.path.join(tmpdir, 'nested.parquet'))
+        run_script('expand_ld_table.py',
+                   '--in_nested', os.path.join(tmpdir, 'nested.parquet'),
+                   '--out', os.path.join(tmpdir, 'expanded.parquet'))
+        # The local chrom layout is written over an earlier run in the other
+        # layout, with more parts, none of whose files should remain
+        run_script('process_ld.py', *inputs, '--engine', 'local',
+                   '--max_loci', '1',
+                   '--out', os.path.join(tmpdir, 'local_chrom.parquet'))
+        for engine in ['local', 'spark']:
+            run_script('process_ld.py', *inputs, '--engine', engine,
+                       '--out_layout', 'chrom',
+                       '--out', os.path.join(tmpdir, engine + '_chrom.parquet'))
+
+        # Compare
+        spark_ld = load_ld_table(os.path.join(tmpdir, 'spark.parquet'))
+        local_ld = load_ld_table(os.path.join(tmpdir, 'local.parquet'))
+        expanded_ld = load_ld_table(os.path.join(tmpdir, 'expanded.parquet'))
+        print('Spark: {0} rows, local: {1} rows, expanded: {2} rows'.format(
+            spark_ld.shape[0], local_ld.shape[0], expanded_ld.shape[0]))
+        assert spark_ld.shape[0] > 0
+        assert spark_ld['pics_95perc_credset'].any()
+        pd.testing.assert_frame_equal(spark_ld, local_ld, check_exact=False,
+                                      check_dtype=False)
+        pd.testing.assert_frame_equal(spark_ld, expanded_ld, check_exact=False,
+                                      check_dtype=False)
+
+        # The local engine's study layout is sorted by study, as Spark range
+        # partitions it
+        local_study_id = pd.read_parquet(os.path.join(tmpdir, 'local.parquet'),
+                                         columns=['study_id'])['study_id']
+        assert local_study_id.is_monotonic_increasing
+
+        # The chrom layout has the same rows, sorted by lead_pos within each
+        # lead_chrom partition
+        for engine in ['local', 'spark']:
+            outf = os.path.join(tmpdir, engine + '_chrom.parquet')
+            chrom_ld = load_ld_table(outf)[spark_ld.columns]
+            print('{0} chrom layout: {1} rows'.format(engine, chrom_ld.shape[0]))
+            pd.testing.assert_frame_equal(spark_ld, chrom_ld, check_exact=False,
+                                          check_dtype=False)
+            for chrom_dir in glob.glob(os.path.join(outf, 'lead_chrom=*')):
+                lead_pos = pd.concat([
+                    pd.read_parquet(part, columns=['lead_pos'])['lead_pos']
+                    for part in sorted(glob.glob(os.path.join(chrom_dir, '*.parquet')))
+                ])
+                assert lead_pos.is_monotonic_increasing, chrom_dir
+
+        # Spark wrote a bloom filter for study_id, or a dictionary
+        assert has_study_filter(os.path.join(tmpdir, 'spark.parquet'), 'study_id')
+
+        # Every manifest locus is in the nested loci table, and studies with
+        # the same lead, ancestry and p-value share a tag set
+        loci = pd.read_parquet(os.path.join(tmpdir, 'nested.parquet', 'loci'))
+        manifest = pd.read_csv(os.path.join(tmpdir, 'manifest.tsv'), sep='\t')
+        assert loci.shape[0] == manifest.shape[0]
+        assert not loci.loc[loci['study_id'] == 'GCST4', 'ld_available'].any()
+        shared = (
+            loci.loc[loci['study_id'].isin(['GCST1', 'GCST2'])]
+            .groupby('lead_pos')['tagset_id']
+            .nunique()
+        )
+        assert (shared == 1).all()
+
+    print('COMPLETE')
+
+    return 0
+
+def make_inputs(outdir):
+    ''' Writes an LD tsv per index variant, a manifest and a top loci table.
+        GCST2 duplicates GCST1, GCST3 has a different ancestry and GCST4 has a
+        missing proportion.
+    '''
+    rng = np.random.default_rng(0)
+    leads = [('1', 1000000, 'A', 'G'), ('1', 1100000, 'C', 'T'),
+             ('2', 2000000, 'AT', 'A'), ('22', 5000000, 'G', 'A')]
+
+    # LD of each lead with its tags, including R == 1 and missing R
+    os.makedirs(os.path.join(outdir, 'ld'))
+    for chrom, pos, ref, alt in leads:
+        lead_id = '{0}:{1}:{2}:{3}'.format(chrom, pos, ref, alt)
+        tag_pos = np.sort(rng.choice(np.arange(pos - 50000, pos + 50000), 40,
+                                     replace=False))
+        ld = pd.DataFrame({
+            'index_variant_id': lead_id,
+            'tag_variant_id': ['{0}:{1}:A:C'.format(chrom, p) for p in tag_pos]
+        })
+        R = rng.uniform(0.3, 1, size=(len(tag_pos), len(POPS)))
+        R[rng.random(R.shape) < 0.1] = np.nan
+        for i, pop in enumerate(POPS):
+            ld['R_' + pop] = R[:, i].round(6)
+        ld = pd.concat([
+            pd.DataFrame([[lead_id, lead_id] + [1.0] * len(POPS)],
+                         columns=ld.columns),
+            ld
+        ])
+        outf = os.path.join(outdir, 'ld', lead_id.replace(':', '_') + '.tsv.gz')
+        with gzip.open(outf, 'wt') as out_h:
+            ld.to_csv(out_h, sep='\t', index=False)
+
+    # Manifest and top loci, every study has every lead
+    props = {
+        'GCST1': [0.0, 0.0, 0.0, 1.0, 0.0],
+        'GCST2': [0.0, 0.0, 0.0, 1.0, 0.0],
+        'GCST3': [0.2, 0.1, 0.3, 0.25, 0.15],
+        'GCST4': [np.nan, 0.5, 0.0, 0.5, 0.0]
+    }
+    manifest = []
+    toploci = []
+    for study_id, study_props in props.items():
+        for i, (chrom, pos, ref, alt) in enumerate(leads):
+            manifest.append(
+                [study_id, '_'.join([chrom, str(pos), ref, alt]),
+                 chrom, pos, ref, alt] + study_props)
+            exponent = -8 - i if study_id != 'GCST3' else -20
+            toploci.append([study_id, chrom, pos, ref, alt, 2.5, exponent])
+    pd.DataFrame(
+        manifest,
+        columns=['study_id', 'variant_id', 'chrom', 'pos', 'ref', 'alt'] +
+                ['{}_prop'.format(pop) for pop in POPS]
+    ).to_csv(os.path.join(outdir, 'manifest.tsv'), sep='\t', index=False)
+    pd.DataFrame(
+        toploci,
+        columns=['study_id', 'chrom', 'pos', 'ref', 'alt', 'pval_mantissa',
+                 'pval_exponent']
+    ).to_parquet(os.path.join(outdir, 'toploci.parquet'), index=False)
+
+def run_script(script, *args):
+    ''' Runs one of the pipeline scripts, failing if it fails
+    '''
+    cmd = [sys.executable, os.path.join(SCRIPTS, script)] + list(args)
+    print(' '.join(cmd))
+    sp.run(cmd, check=True)
+
+def has_study_filter(inf, column):
+    ''' Checks that every row group of a Spark output has a bloom filter for
+        column, or only dictionary encoded pages (parquet-mr >= 1.13 drops
+        the bloom filter then, as the dictionary filter is exact). Reads the
+        footers with parquet-mr, pyarrow does not expose the bloom filter
+        offset.
+    '''
+    from pyspark.sql import SparkSession
+    spark = SparkSession.builder.master('local[1]').getOrCreate()
+    jvm = spark._jvm
+    conf = spark._jsc.hadoopConfiguration()
+    found = []
+    for part in glob.glob(os.path.join(inf, '*.parquet')):
+        in_file = jvm.org.apache.parquet.hadoop.util.HadoopInputFile.fromPath(
+            jvm.org.apache.hadoop.fs.Path(part), conf)
+        reader = jvm.org.apache.parquet.hadoop.ParquetFileReader.open(in_file)
+        for block in reader.getFooter().getBlocks():
+            for col_chunk in block.getColumns():
+                if col_chunk.getPath().toDotString() == column:
+                    found.append(
+                        col_chunk.getBloomFilterOffset() >= 0 or
+                        not col_chunk.getEncodingStats().hasNonDictionaryEncodedPages())
+        reader.close()
+    spark.stop()
+    return len(found) > 0 and all(found)
+
+def load_ld_table(inf):
+    ''' Loads a flat LD table in a fixed row order
+    '''
+    ld = pd.read_parquet(inf)
+    ld['lead_chrom'] = ld['lead_chrom'].astype(str)
+    return ld.sort_values(SORT_COLS).reset_index(drop=True)
+
+if __name__ == '__main__':
+
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Checks that the scalar, pandas, Arrow and Spark implementations in
+# common/variant_key.py give the same keys, and that keys decode back to the
+# original variants, for SNV-only, mixed (indels, multi-base and N alleles)
+# and MT/M inputs. Also checks that missing alleles are rejected, and that
+# variant ID strings split and join back to the same IDs.
+#
+# Usage: python tests/compare_variant_keys/compare_backends.py
+#
+# Exits 2 after the other backends are checked if pyspark is not installed.
+#
+
+import sys
+import os
+import pandas as pd
+import pyarrow as pa
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..', '..', 'scripts')))
+from common import variant_key as vk
+
+CASES = {
+    'snv_only': [
+        ('1', 10177, 'A', 'C'),
+        ('1', 10177, 'A', 'G'),
+        ('2', 500, 'T', 'G'),
+        ('22', 51000000, 'C', 'A'),
+        ('X', 2700000, 'G', 'T')
+    ],
+    'mixed': [
+        ('1', 10177, 'A', 'AC'),
+        ('1', 10177, 'A', 'C'),
+        ('3', 60000, 'TTTA', 'T'),
+        ('7', 117559590, 'ATCT', 'A'),
+        ('10', 3000, 'N', 'A'),
+        ('Y', 2800000, 'G', 'GAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'),
+        ('22', 16050075, 'A', 'G')
+    ],
+    'mt': [
+        ('MT', 73, 'A', 'G'),
+        ('M', 73, 'A', 'G'),
+        ('MT', 302, 'A', 'AC'),
+        ('M', 302, 'A', 'AC'),
+        ('X', 1, 'C', 'T'),
+        ('Y', 10000, 'CA', 'C')
+    ]
+}
+
+def main():
+
+    for name, variants in CASES.items():
+
+        df = pd.DataFrame(variants, columns=['chrom', 'pos', 'ref', 'alt'])
+        df['varid'] = df.astype(str).apply('_'.join, axis=1)
+        expected = [vk.encode_variant(*x) for x in variants]
+        table = vk.make_allele_table(variants)
+
+        # Keys sort by chrom, then pos
+        assert sorted(expected) == [
+            expected[i] for i in sorted(
+                range(len(variants)),
+                key=lambda i: (vk.CHROM_CODES[variants[i][0]], variants[i][1],
+                               expected[i]))
+        ]
+
+        # Encode
+        pd_keys = vk.encode_variants_pd(df['chrom'], df['pos'], df['ref'],
+                                        df['alt'])
+        assert pd_keys.tolist() == expected, name
+        assert vk.encode_varids_pd(df['varid']).tolist() == expected, name
+        pa_keys = vk.encode_variants_pa(
+            *[pa.array(df[coln]) for coln in ['chrom', 'pos', 'ref', 'alt']])
+        assert pa_keys.to_pylist() == expected, name
+        half = len(variants) // 2
+        chunked_keys = vk.encode_variants_pa(
+            *[pa.chunked_array([df[coln].values[:half], df[coln].values[half:]])
+              for coln in ['chrom', 'pos', 'ref', 'alt']])
+        assert chunked_keys.to_pylist() == expected, name
+
+        # The pandas encoder fills the same allele table, and encodes
+        # repeated IDs with a non-unique index
+        alleles = {}
+        repeated = pd.concat([df['varid'], df['varid']])
+        assert vk.encode_varids_pd(repeated, alleles=alleles).tolist() == \
+            expected + expected, name
+        assert alleles == table, name
+
+        # ID strings
+        parts = vk.split_varids_pd(repeated)
+        assert list(parts.itertuples(index=False, name=None)) == \
+            variants + variants, name
+        assert vk.make_varids_pd(parts['chrom'], parts['pos'], parts['ref'],
+                                 parts['alt']).tolist() == repeated.tolist(), name
+
+        # Decode. M is decoded as MT.
+        decoded = [(vk.CHROMS[vk.CHROM_CODES[chrom] - 1], pos, ref, alt)
+                   for chrom, pos, ref, alt in variants]
+        assert [vk.decode_key(key, table) for key in expected] == decoded, name
+        pd_decoded = vk.decode_keys_pd(pd_keys, table)
+        assert list(pd_decoded.itertuples(index=False, name=None)) == decoded, name
+        pa_decoded = vk.decode_keys_pa(pa_keys, table)
+        assert list(zip(*[pa_decoded[coln].to_pylist()
+                          for coln in pa_decoded.column_names])) == decoded, name
+
+        print('{0}: scalar, pandas and Arrow agree on {1} keys'.format(
+            name, len(expected)))
+
+    # Missing alleles are rejected
+    for ref in [None, float('nan')]:
+        try:
+            vk.encode_variants_pd(pd.Series(['1']), pd.Series([100]),
+                                  pd.Series([ref]), pd.Series(['A']))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('pandas encoded a missing allele')
+    try:
+        vk.encode_variants_pa(pa.array(['1']), pa.array([100]),
+                              pa.array([None], type=pa.string()),
+                              pa.array(['A']))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Arrow encoded a missing allele')
+
+    # Spark
+    try:
+        import pyspark
+    except ImportError:
+        print('SKIPPED: pyspark is not installed, Spark keys were not compared')
+        return 2
+    compare_spark()
+
+    print('COMPLETE')
+
+    return 0
+
+def compare_spark():
+    ''' Checks that the Spark encoder and decoder agree with the scalar
+        functions. Spark can not decode hashed alleles, which are null.
+    '''
+    from pyspark.sql import SparkSession
+    from pyspark.sql import functions as F
+
+    spark = SparkSession.builder.master('local[1]').getOrCreate()
+
+    for name, variants in CASES.items():
+        df = pd.DataFrame(variants, columns=['chrom', 'pos', 'ref', 'alt'])
+        df['varid'] = df.astype(str).apply('_'.join, axis=1)
+        expected = [vk.encode_variant(*x) for x in variants]
+
+        keys = spark.createDataFrame(df).select(
+            vk.encode_variants_spark('chrom', 'pos', 'ref', 'alt').alias('key'),
+            vk.encode_varids_spark('varid').alias('varid_key')
+        )
+        keys = keys.select('key', 'varid_key',
+                           *vk.decode_keys_spark('key')).toPandas()
+        assert keys['key'].tolist() == expected, name
+        assert keys['varid_key'].tolist() == expected, name
+
+        decoded = [
+            vk.decode_key(key) for key in expected
+        ]
+        assert [tuple(x) for x in keys.iloc[:, 2:].values.tolist()] == decoded, name
+
+        print('{0}: Spark agrees on {1} keys'.format(name, len(expected)))
+
+    # Hash collisions of Spark keys are found
+    keys = spark.createDataFrame(
+        [(1, 'A', 'AC'), (1, 'A', 'AG'), (2, 'A', 'AC')],
+        'key long, ref string, alt string'
+    ).withColumn('key', F.col('key').bitwiseOR(vk.HASH_FLAG))
+    try:
+        vk.check_hash_collisions_spark(keys, 'key', 'ref', 'alt')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Spark hash collision was not found')
+
+    # Missing alleles give a null key
+    missing = spark.createDataFrame(
+        [('1', 100, None, 'A'), ('1', 100, 'C', None)],
+        'chrom string, pos long, ref string, alt string'
+    ).select(vk.encode_variants_spark('chrom', 'pos', 'ref', 'alt').alias('key'))
+    assert missing.toPandas()['key'].isnull().all()
+
+    spark.stop()
+
+if __name__ == '__main__':
+
+    sys.exit(main())